@@ -12,6 +12,39 @@ import torch
 
 logger = getLogger()
 
+# order the shards of a ShardedMonolingualDataset are read in, see get_shard_paths
+SHARD_ORDERS = ['sorted', 'shuffle', 'rotate']
+
+
+def sort_by_length(lengths):
+    """
+    Stable sort of the sentences by length. Lengths fit in 16 bits,
+    numpy sorts them in linear time (radix sort).
+    :param lengths: list of length arrays, sentences are sorted by the first one, then by the next ones
+    :return: sentence ids sorted by lengths, in their original order for same lengths
+    """
+    order = np.arange(len(lengths[0]))
+    for l in reversed(lengths):
+        key = l[order]
+        if len(key) > 0 and key.max() <= np.iinfo(np.uint16).max:
+            key = key.astype(np.uint16)
+        order = order[np.argsort(key, kind='stable')]
+    return order
+
+
+def gather_sentences(sent, pos):
+    """
+    Copy the words of the sentences sent[a:b], for each [a, b] of pos, into a flat numpy array.
+    Memory-mapped sentences are numpy arrays, only these words are read from disk.
+    """
+    lengths = pos[:, 1] - pos[:, 0]
+    ends = np.cumsum(lengths)
+    index = np.arange(ends[-1]) + np.repeat(pos[:, 0] - (ends - lengths), lengths)
+    if isinstance(sent, np.ndarray):
+        return sent[index]
+    return sent[torch.from_numpy(index)].numpy()
+
+
 class Dataset(object):
 
     def __init__(self, params):
@@ -23,28 +56,117 @@ class Dataset(object):
         # unused here
         self.batch_size = params.batch_size
 
-    def batch_sentences(self, sentences, lang_id):
+        # if positive, batches are built up to this number of tokens instead of batch_size sentences
+        self.max_tokens = getattr(params, 'max_tokens', -1)
+
+        # words pruned from the dictionary, still present in memory-mapped sentences
+        self.max_vocab = getattr(params, 'max_vocab', -1)
+
+        # in distributed training, each process iterates over its own shard of the sentences
+        self.rank = getattr(params, 'rank', 0)
+        self.world_size = getattr(params, 'world_size', 1)
+
+        # sentences grouped by length, built on the first iterator grouped by size, see get_length_buckets
+        self.length_buckets = None
+
+    def shard_indices(self, indices):
         """
-        Take as input a list of n sentences (torch.LongTensor vectors) and return
-        a tensor of size (s_len, n) where s_len is the length of the longest
-        sentence, and a vector lengths containing the length of each sentence.
+        Keep the sentences of this process, sentence i belongs to process i % world_size.
+        The shards don't depend on the random state, so processes don't need to share it.
+        """
+        if self.world_size == 1:
+            return indices
+        return indices[indices % self.world_size == self.rank]
+
+    def get_length_buckets(self, lengths):
+        """
+        Group the sentences by length, once for the dataset, so iterators don't sort the sentences again.
+        :param lengths: list of length arrays, sentences are sorted by the first one, then by the next ones
+        :return: sentence ids sorted by lengths, in their original order within a bucket of same lengths,
+                 and the boundaries of the buckets
+        """
+        if self.length_buckets is not None:
+            return self.length_buckets
+
+        order = sort_by_length(lengths)
+        keys = np.stack([l[order] for l in lengths])
+        bounds = np.flatnonzero((keys[:, 1:] != keys[:, :-1]).any(0)) + 1
+        self.length_buckets = order, np.concatenate([[0], bounds, [len(order)]])
+        return self.length_buckets
+
+    def group_by_length(self, indices, shuffle, lengths):
+        """
+        Sort indices by length, in linear time with the length buckets of the dataset.
+        Within a bucket, sentences are in random order if shuffle, in their original order otherwise.
+        """
+        order, bounds = self.get_length_buckets(lengths)
+        if shuffle:
+            order = order.copy()
+            for a, b in zip(bounds[:-1], bounds[1:]):
+                np.random.shuffle(order[a:b])
+
+        selected = np.zeros(len(order), dtype=bool)
+        selected[indices] = True
+        return order[selected[order]]
+
+    def get_token_batches(self, indices, lengths):
+        """
+        Split indices into consecutive batches of at most max_tokens tokens.
+        Tokens are counted with padding to the longest sentence of the batch,
+        and with bos / eos. A sentence longer than the budget is in its own batch.
+        :param indices: sentence indices, sorted by length to minimize padding
+        :param lengths: length of each sentence in indices
+        """
+        assert self.max_tokens > 0
+        batches = []
+        start = 0
+        max_len = 0
+        for i, length in enumerate(lengths.tolist()):
+            max_len = max(max_len, length)
+            if i > start and (i - start + 1) * (max_len + 2) > self.max_tokens:
+                batches.append(indices[start:i])
+                start = i
+                max_len = length
+        if start < len(indices):
+            batches.append(indices[start:])
+        return batches
+
+    def batch_sentences(self, sent, pos, lang_id, pin_memory=False):
+        """
+        Gather the sentences sent[a:b], for each [a, b] of pos, and return a tensor of
+        size (n, s_len) where s_len is the length of the longest sentence with bos and eos,
+        and a vector lengths containing the length of each sentence.
+        Memory-mapped sentences are numpy arrays, only the words of the batch are read from disk.
+        :param sent: flat array of the sentences of the dataset
+        :param pos: array of shape (n, 2), beginning and end of each sentence of the batch in sent
+        :param pin_memory: allocate the batch in pinned memory, to copy it to the GPU asynchronously
         """
         assert type(lang_id) is int
-        # add 2 tokens, for bos and eos
-        lengths = torch.LongTensor([len(s) + 2 for s in sentences])
+        lengths = pos[:, 1] - pos[:, 0]
+        offsets = np.arange(lengths.max())
+
+        # index of each word in sent, the padding positions read the last word of their sentence
+        is_word = torch.from_numpy(offsets < lengths[:, None])
+        index = pos[:, :1] + np.minimum(offsets, lengths[:, None] - 1)
 
-        # fill unused sentence spaces with pad token
-        sent = torch.LongTensor(lengths.max(), lengths.size(0)).fill_(self.pad_index)
+        if isinstance(sent, np.ndarray):
+            words = torch.from_numpy(sent[index].astype(np.int64))
+            if self.max_vocab != -1:
+                words.masked_fill_(words >= self.max_vocab, self.unk_index)
+        else:
+            words = sent[torch.from_numpy(index)]
 
-        # fill beginning of sentences with language-specific bos token?
-        sent[0] = self.bos_index[lang_id]
+        # add 2 tokens, for bos and eos
+        lengths = torch.from_numpy(lengths.astype(np.int64) + 2)
+        batch = torch.empty(len(lengths), len(offsets) + 2, dtype=torch.long, pin_memory=pin_memory)
 
-        # copy sentence tokens, don't overwrite bos, add eos
-        for i, s in enumerate(sentences):
-            sent[1:lengths[i] - 1, i].copy_(s)
-            sent[lengths[i] - 1, i] = self.eos_index
+        # language-specific bos, words or padding, eos after the last word
+        batch[:, 0] = self.bos_index[lang_id]
+        batch[:, 1:-1] = words.masked_fill_(~is_word, self.pad_index)
+        batch[:, -1] = self.pad_index
+        batch.scatter_(1, lengths.unsqueeze(1) - 1, self.eos_index)
 
-        return sent, lengths
+        return batch, lengths
 
 class MonolingualDataset(Dataset):
 
@@ -66,13 +188,19 @@ class MonolingualDataset(Dataset):
         self.lengths = self.pos[:, 1] - self.pos[:, 0]
         self.is_parallel = False
 
+        # memory-mapped sentences have no -1 separators, and are not scanned
+        self.is_mmap = isinstance(sent, np.ndarray)
+
         # check number of sentences
-        assert len(self.pos) == (self.sent == -1).sum()
+        assert self.is_mmap or len(self.pos) == (self.sent == -1).sum()
 
         self.remove_empty_sentences()
 
-        assert len(pos) == (sent[torch.from_numpy(pos[:, 1])] == -1).sum()  # check sentences indices
-        assert -1 <= sent.min() < sent.max() < len(dico)                    # check dictionary indices
+        if self.is_mmap:
+            assert len(pos) == 0 or 0 <= pos.min() and pos.max() <= len(sent)  # check sentences indices
+        else:
+            assert len(pos) == (sent[torch.from_numpy(pos[:, 1])] == -1).sum()  # check sentences indices
+            assert -1 <= sent.min() < sent.max() < len(dico)                    # check dictionary indices
         assert self.lengths.min() > 0                                       # check empty sentences
 
     def __len__(self):
@@ -90,6 +218,7 @@ class MonolingualDataset(Dataset):
         indices = indices[self.lengths[indices] > 0]
         self.pos = self.pos[indices]
         self.lengths = self.pos[:, 1] - self.pos[:, 0]
+        self.length_buckets = None
         logger.info("Removed %i empty sentences." % (init_size - len(indices)))
 
     def remove_long_sentences(self, max_len):
@@ -102,6 +231,7 @@ class MonolingualDataset(Dataset):
         indices = indices[self.lengths[indices] <= max_len]
         self.pos = self.pos[indices]
         self.lengths = self.pos[:, 1] - self.pos[:, 0]
+        self.length_buckets = None
         logger.info("Removed %i too long sentences." % (init_size - len(indices)))
 
     def select_data(self, a, b):
@@ -116,22 +246,22 @@ class MonolingualDataset(Dataset):
         else:
             self.pos = torch.LongTensor()
             self.lengths = torch.LongTensor()
+        self.length_buckets = None
 
-    def get_batches_iterator(self, batches):
+    def get_batches_iterator(self, batches, pin_memory=False):
         """
         batches is a list of lists of sentence indices
         Return a sentences iterator, given the associated sentence batches.
         """
         def iterator():
             for sentence_ids in batches:
-                pos = self.pos[sentence_ids]
-                sent = [self.sent[a:b] for a, b in pos]
-                yield self.batch_sentences(sent, self.lang_id)
+                yield self.batch_sentences(self.sent, self.pos[sentence_ids], self.lang_id, pin_memory)
         return iterator
 
-    def get_iterator(self, shuffle, group_by_size=False, n_sentences=-1):
+    def get_iterator(self, shuffle, group_by_size=False, n_sentences=-1, pin_memory=False):
         """
         Return a sentences iterator.
+        :param pin_memory: allocate the batches in pinned memory
         """
         n_sentences = len(self.pos) if n_sentences == -1 else n_sentences
         assert 0 < n_sentences <= len(self.pos)
@@ -142,20 +272,193 @@ class MonolingualDataset(Dataset):
             indices = np.random.permutation(len(self.pos))[:n_sentences]
         else:
             indices = np.arange(n_sentences)
+        indices = self.shard_indices(indices)
 
         # group sentences by lengths
         if group_by_size:
             # new list of indices, sorted by length
-            indices = indices[np.argsort(self.lengths[indices], kind='mergesort')]
+            indices = self.group_by_length(indices, shuffle, [self.lengths])
 
         # create batches / optionally shuffle them
-        batches = np.array_split(indices, math.ceil(len(indices) * 1. / self.batch_size))
+        if self.max_tokens > 0:
+            batches = self.get_token_batches(indices, self.lengths[indices])
+        else:
+            batches = np.array_split(indices, math.ceil(len(indices) * 1. / self.batch_size))
 
         if shuffle:
             np.random.shuffle(batches)
 
         # return the iterator
-        return self.get_batches_iterator(batches)
+        return self.get_batches_iterator(batches, pin_memory)
+
+class ShardedMonolingualDataset(Dataset):
+    """
+    Monolingual dataset split into binarized shards, for corpora larger than the memory.
+
+    Shards are loaded one at a time, and their sentences stream through a shuffle buffer
+    of at most shuffle_buffer sentences. Batches are built from the buffer once it is full,
+    grouped by length within the buffer. Only the current shard and the buffer are in memory.
+    """
+
+    def __init__(self, shard_paths, load_shard, dico, lang_id, params, count_shard=None):
+        """
+        :param shard_paths: paths of the binarized shards
+        :param load_shard: function path -> binarized data, with sentences and positions
+        :param count_shard: function path -> number of sentences of the shard, without loading it,
+                            shards are loaded to count their sentences if None
+        :param dico: Dictionary, shared by the shards
+        :param lang_id:
+        :param params: contains things like special tokens, shuffle buffer size and shard order
+        """
+        super(ShardedMonolingualDataset, self).__init__(params)
+        assert type(lang_id) is int
+        assert len(shard_paths) > 0
+        self.shard_paths = shard_paths
+        self.load_shard = load_shard
+        self.dico = dico
+        self.lang_id = lang_id
+        self.is_parallel = False
+
+        # number of sentences batches are built from, and order the shards are read in at each iterator
+        self.shuffle_buffer = getattr(params, 'shuffle_buffer', 1000000)
+        self.shard_order = getattr(params, 'shard_order', 'shuffle')
+        assert self.shuffle_buffer > 0
+        assert self.shard_order in SHARD_ORDERS
+
+        # sentences are filtered while streaming, see remove_long_sentences and select_data
+        self.max_len = -1
+        self.n_sentences = -1
+
+        # number of sentences of the shards, counted on the first call to __len__
+        self.count_shard = count_shard
+        self.n_shard_sentences = None
+
+    def __len__(self):
+        """
+        Number of sentences in the shards, before removing empty and too long sentences, capped by select_data.
+        """
+        if self.n_shard_sentences is None:
+            count_shard = self.count_shard or (lambda path: len(self.load_shard(path)['positions']))
+            self.n_shard_sentences = sum(count_shard(path) for path in self.shard_paths)
+        if self.n_sentences == -1:
+            return self.n_shard_sentences
+        return min(self.n_shard_sentences, self.n_sentences)
+
+    def remove_long_sentences(self, max_len):
+        """
+        Remove sentences exceeding a certain length, when their shard is read.
+        """
+        assert max_len > 0
+        self.max_len = max_len
+        logger.info("Removing sentences longer than %i words from %i shards." % (max_len, len(self.shard_paths)))
+
+    def select_data(self, a, b):
+        """
+        Only retain the first b sentences read by each iterator.
+        """
+        assert a == 0 and b > 0
+        self.n_sentences = b
+
+    def get_shard_paths(self, shuffle):
+        """
+        Order the shards are read in: sorted, in a new random order at each iterator,
+        or sorted and starting from a random shard
+        """
+        if not shuffle or self.shard_order == 'sorted':
+            return list(self.shard_paths)
+        if self.shard_order == 'shuffle':
+            return [self.shard_paths[i] for i in np.random.permutation(len(self.shard_paths))]
+        start = np.random.randint(len(self.shard_paths))
+        return self.shard_paths[start:] + self.shard_paths[:start]
+
+    def get_shard_sentences(self, path, shuffle):
+        """
+        Load a shard, and return its sentences and the positions of the sentences of this process,
+        without empty and too long sentences, in random order if shuffle
+        """
+        data = self.load_shard(path)
+        sent, pos = data['sentences'], data['positions']
+        lengths = pos[:, 1] - pos[:, 0]
+
+        indices = self.shard_indices(np.arange(len(pos)))
+        indices = indices[lengths[indices] > 0]
+        if self.max_len > 0:
+            indices = indices[lengths[indices] <= self.max_len]
+        if shuffle:
+            indices = np.random.permutation(indices)
+        return sent, pos[indices]
+
+    def get_buffer_batches(self, words, lengths, shuffle, group_by_size, pin_memory):
+        """
+        Build the batches of the sentences of the shuffle buffer.
+        :param words: list of flat arrays of the words of consecutive sentences
+        :param lengths: list of arrays of the lengths of these sentences
+        """
+        sent = np.concatenate(words)
+        lengths = np.concatenate(lengths)
+        ends = np.cumsum(lengths)
+        pos = np.stack([ends - lengths, ends], 1)
+
+        # sentences are already in random order if shuffle
+        indices = np.arange(len(pos))
+        if group_by_size:
+            indices = sort_by_length([lengths])
+
+        if self.max_tokens > 0:
+            batches = self.get_token_batches(indices, lengths[indices])
+        else:
+            batches = np.array_split(indices, math.ceil(len(indices) * 1. / self.batch_size))
+
+        if shuffle:
+            np.random.shuffle(batches)
+
+        for sentence_ids in batches:
+            yield self.batch_sentences(sent, pos[sentence_ids], self.lang_id, pin_memory)
+
+    def get_iterator(self, shuffle, group_by_size=False, n_sentences=-1, pin_memory=False):
+        """
+        Return a sentences iterator, over the shards.
+        :param pin_memory: allocate the batches in pinned memory
+        """
+        n_sentences = self.n_sentences if n_sentences == -1 else n_sentences
+        assert n_sentences == -1 or n_sentences > 0
+        assert type(shuffle) is bool and type(group_by_size) is bool
+
+        def iterator():
+            # words and lengths of the sentences of the buffer, in chunks of consecutive sentences
+            words, lengths = [], []
+            buffer_size = 0
+            n_read = 0
+
+            for path in self.get_shard_paths(shuffle):
+                sent, pos = self.get_shard_sentences(path, shuffle)
+                if n_sentences != -1:
+                    pos = pos[:n_sentences - n_read]
+                    n_read += len(pos)
+
+                # fill the buffer, build the batches once it is full
+                while len(pos) > 0:
+                    chunk, pos = pos[:self.shuffle_buffer - buffer_size], pos[self.shuffle_buffer - buffer_size:]
+                    words.append(gather_sentences(sent, chunk))
+                    lengths.append(chunk[:, 1] - chunk[:, 0])
+                    buffer_size += len(chunk)
+
+                    if buffer_size == self.shuffle_buffer:
+                        for batch in self.get_buffer_batches(words, lengths, shuffle, group_by_size, pin_memory):
+                            yield batch
+                        words, lengths = [], []
+                        buffer_size = 0
+
+                # release the shard before the next one is loaded
+                del sent, pos
+                if n_read == n_sentences:
+                    break
+
+            if buffer_size > 0:
+                for batch in self.get_buffer_batches(words, lengths, shuffle, group_by_size, pin_memory):
+                    yield batch
+
+        return iterator
 
 class ParallelDataset(Dataset):
 
@@ -175,17 +478,23 @@ class ParallelDataset(Dataset):
         self.lengths2 = self.pos2[:, 1] - self.pos2[:, 0]
         self.is_parallel = True
 
-        # check number of sentences
-        assert len(self.pos1) == (self.sent1 == -1).sum()
-        assert len(self.pos2) == (self.sent2 == -1).sum()
+        # check number of sentences, memory-mapped sentences have no -1 separators, and are not scanned
+        assert isinstance(sent1, np.ndarray) or len(self.pos1) == (self.sent1 == -1).sum()
+        assert isinstance(sent2, np.ndarray) or len(self.pos2) == (self.sent2 == -1).sum()
 
         self.remove_empty_sentences()
 
         assert len(pos1) == len(pos2) > 0                                      # check number of sentences
-        assert len(pos1) == (sent1[torch.from_numpy(pos1[:, 1])] == -1).sum()  # check sentences indices
-        assert len(pos2) == (sent2[torch.from_numpy(pos2[:, 1])] == -1).sum()  # check sentences indices
-        assert -1 <= sent1.min() < sent1.max() < len(dico1)                    # check dictionary indices
-        assert -1 <= sent2.min() < sent2.max() < len(dico2)                    # check dictionary indices
+        if isinstance(sent1, np.ndarray):
+            assert 0 <= pos1.min() and pos1.max() <= len(sent1)                # check sentences indices
+        else:
+            assert len(pos1) == (sent1[torch.from_numpy(pos1[:, 1])] == -1).sum()  # check sentences indices
+            assert -1 <= sent1.min() < sent1.max() < len(dico1)                    # check dictionary indices
+        if isinstance(sent2, np.ndarray):
+            assert 0 <= pos2.min() and pos2.max() <= len(sent2)                # check sentences indices
+        else:
+            assert len(pos2) == (sent2[torch.from_numpy(pos2[:, 1])] == -1).sum()  # check sentences indices
+            assert -1 <= sent2.min() < sent2.max() < len(dico2)                    # check dictionary indices
         assert self.lengths1.min() > 0                                         # check empty sentences
         assert self.lengths2.min() > 0                                         # check empty sentences
 
@@ -207,6 +516,7 @@ class ParallelDataset(Dataset):
         self.pos2 = self.pos2[indices]
         self.lengths1 = self.pos1[:, 1] - self.pos1[:, 0]
         self.lengths2 = self.pos2[:, 1] - self.pos2[:, 0]
+        self.length_buckets = None
         logger.info("Removed %i empty sentences." % (init_size - len(indices)))
 
     def remove_long_sentences(self, max_len):
@@ -222,6 +532,7 @@ class ParallelDataset(Dataset):
         self.pos2 = self.pos2[indices]
         self.lengths1 = self.pos1[:, 1] - self.pos1[:, 0]
         self.lengths2 = self.pos2[:, 1] - self.pos2[:, 0]
+        self.length_buckets = None
         logger.info("Removed %i too long sentences." % (init_size - len(indices)))
 
     def select_data(self, a, b):
@@ -239,23 +550,22 @@ class ParallelDataset(Dataset):
             self.pos2 = torch.LongTensor()
             self.lengths1 = torch.LongTensor()
             self.lengths2 = torch.LongTensor()
+        self.length_buckets = None
 
-    def get_batches_iterator(self, batches):
+    def get_batches_iterator(self, batches, pin_memory=False):
         """
         Return a sentences iterator, given the associated sentence batches.
         """
         def iterator():
             for sentence_ids in batches:
-                pos1 = self.pos1[sentence_ids]
-                pos2 = self.pos2[sentence_ids]
-                sent1 = [self.sent1[a:b] for a, b in pos1]
-                sent2 = [self.sent2[a:b] for a, b in pos2]
-                yield self.batch_sentences(sent1, self.lang1_id), self.batch_sentences(sent2, self.lang2_id)
+                yield (self.batch_sentences(self.sent1, self.pos1[sentence_ids], self.lang1_id, pin_memory),
+                       self.batch_sentences(self.sent2, self.pos2[sentence_ids], self.lang2_id, pin_memory))
         return iterator
 
-    def get_iterator(self, shuffle, group_by_size=False, n_sentences=-1):
+    def get_iterator(self, shuffle, group_by_size=False, n_sentences=-1, pin_memory=False):
         """
         Return a sentences iterator.
+        :param pin_memory: allocate the batches in pinned memory
         """
         n_sentences = len(self.pos1) if n_sentences == -1 else n_sentences
         assert 0 < n_sentences <= len(self.pos1)
@@ -266,16 +576,141 @@ class ParallelDataset(Dataset):
             indices = np.random.permutation(len(self.pos1))[:n_sentences]
         else:
             indices = np.arange(n_sentences)
+        indices = self.shard_indices(indices)
 
         # group sentences by lengths
         if group_by_size:
-            indices = indices[np.argsort(self.lengths2[indices], kind='mergesort')]
-            indices = indices[np.argsort(self.lengths1[indices], kind='mergesort')]
+            indices = self.group_by_length(indices, shuffle, [self.lengths1, self.lengths2])
 
         # create batches / optionally shuffle them
-        batches = np.array_split(indices, math.ceil(len(indices) * 1. / self.batch_size))
+        # with a token budget, padding is counted on the longest side
+        if self.max_tokens > 0:
+            batches = self.get_token_batches(indices, np.maximum(self.lengths1[indices], self.lengths2[indices]))
+        else:
+            batches = np.array_split(indices, math.ceil(len(indices) * 1. / self.batch_size))
         if shuffle:
             np.random.shuffle(batches)
 
         # return the iterator
-        return self.get_batches_iterator(batches)
+        return self.get_batches_iterator(batches, pin_memory)
+
+
+if __name__ == "__main__":
+
+    # compare with the former sentence by sentence copy, on sentences in memory and memory-mapped
+    import time
+    from argparse import Namespace
+
+    def former_batch_sentences(sentences, bos_index, eos_index, pad_index):
+        lengths = torch.LongTensor([len(s) + 2 for s in sentences])
+        sent = torch.LongTensor(lengths.max(), lengths.size(0)).fill_(pad_index)
+        sent[0] = bos_index
+        for i, s in enumerate(sentences):
+            sent[1:lengths[i] - 1, i].copy_(s)
+            sent[lengths[i] - 1, i] = eos_index
+        return sent.transpose_(0, 1), lengths
+
+    params = Namespace(eos_index=1, pad_index=2, unk_index=3, bos_index=[0, 4], batch_size=64)
+    dataset = Dataset(params)
+
+    lengths = np.random.randint(1, 100, size=10000)
+    ends = np.cumsum(lengths + 1) - 1
+    pos = np.stack([ends - lengths, ends], 1)
+    sent = torch.randint(5, 1000, (ends[-1] + 1,))
+    sent[torch.from_numpy(ends)] = -1
+
+    n_batches = len(pos) // params.batch_size
+    for sentences in [sent, sent.numpy().astype(np.uint16)]:
+        former_time, time_ = 0, 0
+        for batch_pos in np.array_split(np.random.permutation(len(pos)), n_batches):
+            batch_pos = pos[batch_pos]
+            start = time.perf_counter()
+            batch, batch_lengths = dataset.batch_sentences(sentences, batch_pos, lang_id=1)
+            time_ += time.perf_counter() - start
+
+            start = time.perf_counter()
+            expected, expected_lengths = former_batch_sentences(
+                [torch.from_numpy(sentences[a:b].astype(np.int64)) if isinstance(sentences, np.ndarray)
+                 else sentences[a:b] for a, b in batch_pos], 4, 1, 2)
+            former_time += time.perf_counter() - start
+
+            assert torch.equal(batch, expected) and torch.equal(batch_lengths, expected_lengths)
+        print("%s sentences: batches match the former batches, %.1fms per batch, former %.1fms per batch" %
+              (type(sentences).__name__, time_ * 1000 / n_batches, former_time * 1000 / n_batches))
+
+    # length buckets give the order of the former sorts, without sorting at each iterator
+    def former_group_by_size(indices, lengths1, lengths2):
+        indices = indices[np.argsort(lengths2[indices], kind='mergesort')]
+        return indices[np.argsort(lengths1[indices], kind='mergesort')]
+
+    lengths = list(np.random.randint(1, 100, size=(2, 1000000)))
+    indices = np.random.permutation(len(lengths[0]))[:800000]
+    start = time.perf_counter()
+    dataset.get_length_buckets(lengths)
+    build_time = time.perf_counter() - start
+
+    grouped = dataset.group_by_length(indices, False, lengths)
+    assert np.array_equal(grouped, former_group_by_size(np.sort(indices), *lengths))
+
+    # in random order within the buckets
+    former_time, time_ = 0, 0
+    for _ in range(5):
+        start = time.perf_counter()
+        grouped = dataset.group_by_length(indices, True, lengths)
+        time_ += time.perf_counter() - start
+
+        start = time.perf_counter()
+        expected = former_group_by_size(indices, *lengths)
+        former_time += time.perf_counter() - start
+
+        assert np.array_equal(np.sort(grouped), np.sort(expected))
+        assert all(np.array_equal(l[grouped], l[expected]) for l in lengths)
+    print("length buckets: grouped like the former sorts, built in %.1fms, %.1fms per iterator, former %.1fms" %
+          (build_time * 1000, time_ * 1000 / 5, former_time * 1000 / 5))
+
+    # a sharded dataset reads each sentence once per iterator, whatever the buffer size and shard order
+    shards = {'shard%i' % i: {'sentences': sent, 'positions': pos[i::4]} for i in range(4)}
+    expected = sorted(tuple(sent[a:b].tolist()) for a, b in pos)
+    for shuffle_buffer, shard_order in [(1000, 'shuffle'), (3000, 'rotate'), (100000, 'sorted')]:
+        params.shuffle_buffer, params.shard_order = shuffle_buffer, shard_order
+        sharded = ShardedMonolingualDataset(sorted(shards), shards.get, dico=None, lang_id=1, params=params)
+        for shuffle in [False, True]:
+            sentences = []
+            for batch, batch_lengths in sharded.get_iterator(shuffle=shuffle, group_by_size=True)():
+                assert (batch[:, 0] == 4).all() and batch_lengths.max() == batch.size(1)
+                sentences.extend(tuple(s[1:l - 1].tolist()) for s, l in zip(batch, batch_lengths))
+            assert sorted(sentences) == expected
+    print("sharded dataset: each sentence is read once per iterator")
+
+    # load_data on sharded datasets, in the torch.save and memory-mapped formats
+    import os
+    import tempfile
+    from src.data.dictionary import Dictionary, MMAP_SUFFIX
+    from src.data.loader import check_all_data_params, load_data
+    from src.utils.data_loading import get_parser
+
+    with tempfile.TemporaryDirectory() as tmp:
+        vocab_path = os.path.join(tmp, 'vocab')
+        with open(vocab_path, 'w', encoding='utf-8') as f:
+            f.write(''.join('w%i 1\n' % i for i in range(100)))
+        dico = Dictionary.read_vocab(vocab_path)
+
+        n_shard_sentences = [30, 50, 20]
+        for lang, suffix in [('de', MMAP_SUFFIX), ('en', '.pth')]:
+            for i, n in enumerate(n_shard_sentences):
+                txt_path = os.path.join(tmp, 'train.%i.%s' % (i, lang))
+                with open(txt_path, 'w', encoding='utf-8') as f:
+                    for _ in range(n):
+                        f.write(' '.join('w%i' % w for w in np.random.randint(100, size=np.random.randint(1, 20))) + '\n')
+                Dictionary.index_data(txt_path, txt_path + suffix, dico)
+
+        params = get_parser().parse_args(['--langs', 'de,en', '--n_mono', '-1', '--mono_dataset',
+                                          'de:%s,,;en:%s,,' % (os.path.join(tmp, 'train.*.de' + MMAP_SUFFIX),
+                                                               os.path.join(tmp, 'train.*.en.pth'))])
+        check_all_data_params(params)
+        data = load_data(params, mono_only=True)
+        for lang in ['de', 'en']:
+            sharded = data['mono'][lang]['train']
+            assert len(sharded.shard_paths) == 3 and len(sharded) == sum(n_shard_sentences)
+            assert sum(len(l) for _, l in sharded.get_iterator(shuffle=True, group_by_size=True)()) == len(sharded)
+    print("load_data: sharded datasets are loaded, and their sentences counted from the shards")
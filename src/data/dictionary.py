@@ -6,6 +6,9 @@
 #
 
 import os
+import array
+import multiprocessing
+import numpy as np
 import torch
 from logging import getLogger
 
@@ -21,6 +24,13 @@ UNK_WORD = '<unk>'
 SPECIAL_WORD = '<special%i>'
 SPECIAL_WORDS = 10
 
+# suffix of memory-mapped binarized datasets, and of the files they are made of
+MMAP_SUFFIX = '.mmap'
+MMAP_SENTENCES = '.sent.npy'
+MMAP_POSITIONS = '.pos.npy'
+MMAP_VOCAB = '.vocab'
+MMAP_UNK = '.unk'
+
 
 class Dictionary(object):
 
@@ -32,6 +42,7 @@ class Dictionary(object):
         self.eos_index = word2id[EOS_WORD]
         self.pad_index = word2id[PAD_WORD]
         self.unk_index = word2id[UNK_WORD]
+        self.word_array = None
         self.check_valid()
 
     def __len__(self):
@@ -82,6 +93,15 @@ class Dictionary(object):
         else:
             return self.word2id.get(word, self.unk_index)
 
+    def get_word_array(self):
+        """
+        Returns a numpy array of the words, indexed by word id, to convert batches of ids at once.
+        """
+        # dictionaries saved before the array existed do not have the attribute
+        if getattr(self, 'word_array', None) is None:
+            self.word_array = np.array([self.id2word[i] for i in range(len(self))], dtype=object)
+        return self.word_array
+
     def prune(self, max_vocab):
         """
         Limit the vocabulary size.
@@ -91,6 +111,7 @@ class Dictionary(object):
         # are words sorted by frequency?
         self.id2word = {k: v for k, v in self.id2word.items() if k < max_vocab}
         self.word2id = {v: k for k, v in self.id2word.items()}
+        self.word_array = None
         self.check_valid()
 
     @staticmethod
@@ -126,44 +147,214 @@ class Dictionary(object):
             logger.warning("Skipped %i empty lines!" % skipped)
         return dico
 
+    def write_vocab(self, vocab_path):
+        """
+        Write the dictionary to a vocabulary file that can be reloaded with read_vocab.
+        Special words are not written, word counts are unknown and set to 0.
+        """
+        with open(vocab_path, 'w', encoding='utf-8') as f:
+            for i in range(4 + SPECIAL_WORDS, len(self.id2word)):
+                f.write('%s 0\n' % self.id2word[i])
+
     @staticmethod
-    def index_data(path, bin_path, dico):
+    def load_mmap(prefix):
+        """
+        Open a dataset written by index_data in the memory-mapped format:
+            - prefix.sent.npy: token indices, uint16 if the dictionary is small enough, int32 otherwise
+            - prefix.pos.npy: int64 array of shape (n_sentences, 2), [beginning, end] of each sentence
+            - prefix.vocab / prefix.unk: dictionary and unknown words counts
+        Unlike the torch.save format, sentences are not separated by -1.
+        Sentences and positions are not read into memory, they are memory-mapped
+        and shared by all the processes reading them.
+        """
+        assert os.path.isfile(prefix + MMAP_SENTENCES), prefix
+        unk_words = {}
+        with open(prefix + MMAP_UNK, 'r', encoding='utf-8') as f:
+            for line in f:
+                w, c = line.rstrip().split()
+                unk_words[w] = int(c)
+        return {
+            'dico': Dictionary.read_vocab(prefix + MMAP_VOCAB),
+            'positions': np.load(prefix + MMAP_POSITIONS, mmap_mode='r'),
+            'sentences': np.load(prefix + MMAP_SENTENCES, mmap_mode='r'),
+            'unk_words': unk_words,
+        }
+
+    @staticmethod
+    def index_data(path, bin_path, dico, n_workers=1):
         """
 
         :param path: path to file containing sentences
         :param bin_path: path to file containing indexed sentences
         :param dico: dictionary to index sentences with
+        :param n_workers: number of processes, each indexing a shard of the file
         :return:
         """
         """
         Index sentences with a dictionary.
         """
+        # save to the memory-mapped format if bin_path ends with MMAP_SUFFIX
+        is_mmap = bin_path.endswith(MMAP_SUFFIX)
+
         # if bin path already exists, check that sentences were indexed with specified dictionary
-        if os.path.isfile(bin_path):
+        if is_mmap and os.path.isfile(bin_path + MMAP_SENTENCES):
+            print("Loading data from %s ..." % bin_path)
+            data = Dictionary.load_mmap(bin_path)
+            assert dico == data['dico']
+            return data
+
+        if not is_mmap and os.path.isfile(bin_path):
             print("Loading data from %s ..." % bin_path)
             data = torch.load(bin_path)
             assert dico == data['dico']
             return data
 
-        positions = []
-        sentences = []
-        unk_words = {}
+        # split the file into shards of whole lines, index them in parallel,
+        # each shard writes its word ids and sentence lengths to temporary files
+        offsets = get_shard_offsets(path, n_workers)
+        shards = [(path, offsets[i], offsets[i + 1], '%s.shard%i' % (bin_path, i))
+                  for i in range(len(offsets) - 1)]
+
+        # the temporary files are removed even if indexing or merging fails
+        try:
+            if n_workers > 1 and len(shards) > 1:
+                with multiprocessing.Pool(n_workers, initializer=init_index_worker, initargs=(dico,)) as pool:
+                    results = pool.map(index_shard_worker, shards)
+            else:
+                results = [index_shard(dico, *shard) for shard in shards]
+
+            # merge unknown words counts and shard sizes
+            unk_words = {}
+            for _, _, shard_unk_words in results:
+                for w, c in shard_unk_words.items():
+                    unk_words[w] = unk_words.get(w, 0) + c
+
+            lengths = np.concatenate([read_shard(tmp_prefix + SHARD_LENGTHS, np.int64)
+                                      for _, _, tmp_prefix in shards])
+            n_words = int(lengths.sum())
+
+            print("Saving the data to %s ..." % bin_path)
+            if is_mmap:
+                # positions holds [index of beginning of sentence in sentences, index of end of sentence]
+                ends = np.cumsum(lengths)
+                np.save(bin_path + MMAP_POSITIONS, np.stack([ends - lengths, ends], 1))
+
+                # copy the shards to the memory-mapped array, without loading the whole corpus
+                dtype = np.uint16 if len(dico) <= np.iinfo(np.uint16).max + 1 else np.int32
+                sentences = np.lib.format.open_memmap(bin_path + MMAP_SENTENCES, mode='w+',
+                                                      dtype=dtype, shape=(n_words,))
+                start = 0
+                for _, _, tmp_prefix in shards:
+                    shard_sentences = read_shard(tmp_prefix + SHARD_SENTENCES, np.int32)
+                    sentences[start:start + len(shard_sentences)] = shard_sentences
+                    start += len(shard_sentences)
+                sentences.flush()
+                del sentences
+
+                dico.write_vocab(bin_path + MMAP_VOCAB)
+                write_unk_words(unk_words, bin_path + MMAP_UNK)
+                data = Dictionary.load_mmap(bin_path)
+
+            else:
+                # word ids from all sentences are concatenated, but separated by -1
+                ends = np.cumsum(lengths + 1) - 1
+                sentences = np.full(n_words + len(lengths), -1, dtype=np.int64)
+                is_word = np.ones(len(sentences), dtype=bool)
+                is_word[ends] = False
+                sentences[is_word] = np.concatenate([read_shard(tmp_prefix + SHARD_SENTENCES, np.int32)
+                                                     for _, _, tmp_prefix in shards])
+
+                # tensorize data
+                data = {
+                    'dico': dico,
+                    'positions': torch.from_numpy(np.stack([ends - lengths, ends], 1)),
+                    'sentences': torch.from_numpy(sentences),
+                    'unk_words': unk_words,
+                }
+                torch.save(data, bin_path)
+
+        finally:
+            for _, _, tmp_prefix in shards:
+                for suffix in [SHARD_SENTENCES, SHARD_LENGTHS]:
+                    if os.path.isfile(tmp_prefix + suffix):
+                        os.remove(tmp_prefix + suffix)
+
+        return data
 
-        # index sentences
-        f = open(path, 'r', encoding='utf-8')
-        for i, line in enumerate(f):
-            if i % 1000000 == 0 and i > 0:
-                print(i)
-            s = line.rstrip().split()
+
+# suffixes of the temporary files written by index_shard
+SHARD_SENTENCES = '.sent.tmp'
+SHARD_LENGTHS = '.len.tmp'
+
+# dictionary of the index_shard_worker processes, sent once when the pool is created
+worker_dico = None
+
+
+def write_unk_words(unk_words, path):
+    """
+    Write unknown words counts, one "word count" per line.
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        for w, c in unk_words.items():
+            f.write('%s %i\n' % (w, c))
+
+
+def get_shard_offsets(path, n_shards):
+    """
+    Split a file into at most n_shards chunks of whole lines.
+    Returns the byte offsets of the chunks boundaries, starting with 0 and ending with the file size.
+    """
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_shards):
+            f.seek(max(size * i // n_shards, offsets[-1]))
+            # move to the beginning of the next line
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()
+            if offsets[-1] < f.tell() < size:
+                offsets.append(f.tell())
+    offsets.append(size)
+    return offsets
+
+
+def read_shard(path, dtype):
+    """
+    Read a temporary file written by index_shard.
+    """
+    return np.fromfile(path, dtype=dtype)
+
+
+def index_shard(dico, path, start, end, tmp_prefix, flush_size=1000000):
+    """
+    Index the lines of a file between byte offsets start and end.
+    Word ids and sentence lengths are streamed to tmp_prefix + SHARD_SENTENCES / SHARD_LENGTHS
+    as raw int32 / int64 arrays, so that the shard is never held in memory as a Python list.
+    Returns the number of sentences, the number of words and the unknown words counts.
+    """
+    n_sentences = 0
+    n_words = 0
+    unk_words = {}
+    indexed = array.array('i')
+    lengths = array.array('q')
+
+    with open(path, 'rb') as f, open(tmp_prefix + SHARD_SENTENCES, 'wb') as f_sent, \
+            open(tmp_prefix + SHARD_LENGTHS, 'wb') as f_len:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if n_sentences % 1000000 == 0 and n_sentences > 0:
+                print("%s: %i" % (tmp_prefix, n_sentences))
+            s = line.decode('utf-8').rstrip().split()
 
             # skip empty sentences
             if len(s) == 0:
-                print("Empty sentence in line %i." % i)
+                print("Empty sentence in line %i of %s." % (n_sentences, tmp_prefix))
                 # continue
 
             # index sentence words
-            count_unk = 0
-            indexed = []
+            length = 0
             for w in s:
                 # get index of the word according to word2id
                 word_id = dico.index(w, no_unk=False)
@@ -173,33 +364,33 @@ class Dictionary(object):
                     logger.warning('Found unexpected special word "%s" (%i)!!' % (w, word_id))
                     continue
 
-                # else, add word_id to list of indexed words of the sentence
+                # else, add word_id to the indexed words of the shard
                 indexed.append(word_id)
+                length += 1
                 if word_id == dico.unk_index:
                     unk_words[w] = unk_words.get(w, 0) + 1
-                    count_unk += 1
 
-            # positions holds [index of beginning of sentence in sentences, index of end of sentence]
-            positions.append([len(sentences), len(sentences) + len(indexed)])
+            lengths.append(length)
+            n_sentences += 1
+            n_words += length
 
-            # word id's from all sentences are just appended to one list
-            sentences.extend(indexed)
+            # stream indexed words to disk
+            if len(indexed) >= flush_size:
+                indexed.tofile(f_sent)
+                lengths.tofile(f_len)
+                indexed = array.array('i')
+                lengths = array.array('q')
 
-            # but separated by -1
-            sentences.append(-1)
+        indexed.tofile(f_sent)
+        lengths.tofile(f_len)
 
-        f.close()
+    return n_sentences, n_words, unk_words
 
-        # tensorize data
-        positions = torch.LongTensor(positions)
-        sentences = torch.LongTensor(sentences)
-        data = {
-            'dico': dico,
-            'positions': positions,
-            'sentences': sentences,
-            'unk_words': unk_words,
-        }
-        print("Saving the data to %s ..." % bin_path)
-        torch.save(data, bin_path)
 
-        return data
+def init_index_worker(dico):
+    global worker_dico
+    worker_dico = dico
+
+
+def index_shard_worker(shard):
+    return index_shard(worker_dico, *shard)
@@ -17,6 +17,10 @@ from .dictionary import *
 
 logger = getLogger()
 
+# binary cache of text embedding files
+EMB_VECTORS = '.vectors.npy'
+EMB_WORDS = '.words'
+
 def reload_pth_emb(path, dim):
     """
     Reload pretrained embeddings from a PyTorch binary file.
@@ -34,33 +38,70 @@ def reload_txt_emb(path, dim):
     Reload pretrained embeddings from a text file.
     """
     assert os.path.isfile(path) and dim > 0
-    word2id = {}
-    vectors = []
 
     logger.info("Reloading embeddings from %s ..." % path)
 
-    # load pretrained embeddings
+    # load pretrained embeddings, the vectors of all the words are parsed at once
     with open(path, encoding='UTF-8') as f:
-        for i, line in enumerate(f):
-            if i == 0:
-                split = line.split()
-                assert len(split) == 2
-                assert dim == int(split[1])
-                n_words = int(split[0])
-            else:
-                word, vect = line.rstrip().split(' ', 1)
-                vect = np.fromstring(vect, sep=' ').astype(np.float32)
-                if np.linalg.norm(vect) == 0:  # avoid to have null embeddings
-                    logger.warning('Found NULL embedding for "%s" in line %i.' % (word, i))
-                    vect[0] = 0.01
-                assert word not in word2id
-                assert vect.shape == (dim,), i
-                word2id[word] = len(word2id)
-                vectors.append(vect[None])
-        assert len(vectors) == n_words
-
-    vectors = np.concatenate(vectors, 0)
-    assert vectors.shape == (n_words, dim)
+        split = f.readline().split()
+        assert len(split) == 2
+        assert dim == int(split[1])
+        n_words = int(split[0])
+        words, vectors = zip(*(line.rstrip().split(' ', 1) for line in f))
+    assert len(words) == n_words
+
+    vectors = np.fromstring(' '.join(vectors), sep=' ', dtype=np.float32)
+    assert vectors.shape == (n_words * dim,)
+    vectors = vectors.reshape(n_words, dim)
+
+    # avoid to have null embeddings
+    for i in np.nonzero(np.linalg.norm(vectors, axis=1) == 0)[0]:
+        logger.warning('Found NULL embedding for "%s" in line %i.' % (words[i], i + 1))
+        vectors[i, 0] = 0.01
+
+    word2id = {word: i for i, word in enumerate(words)}
+    assert len(word2id) == n_words
+
+    logger.info("Reloaded %i embeddings." % len(vectors))
+    return vectors, word2id
+
+
+def get_emb_cache_paths(path):
+    """
+    Binary cache of a text embedding file:
+        - path.vectors.npy: float32 array of shape (n_words, dim), memory-mapped
+        - path.words: one word per line, in the order of the vectors
+    """
+    return path + EMB_VECTORS, path + EMB_WORDS
+
+
+def reload_cached_emb(path, dim):
+    """
+    Reload pretrained embeddings from the binary cache of a text file,
+    the text file is converted the first time, and again when it is modified.
+    """
+    vectors_path, words_path = get_emb_cache_paths(path)
+
+    if not (os.path.isfile(vectors_path) and os.path.isfile(words_path)) or \
+            os.path.getmtime(vectors_path) < os.path.getmtime(path):
+        vectors, word2id = reload_txt_emb(path, dim)
+
+        # write to temporary files and rename, so concurrent processes never read a partial cache
+        logger.info("Caching embeddings in %s ..." % vectors_path)
+        pid = str(os.getpid())
+        np.save(vectors_path + pid, vectors)
+        os.replace(vectors_path + pid + '.npy', vectors_path)
+        with open(words_path + pid, 'w', encoding='UTF-8', newline='\n') as f:
+            f.write('\n'.join(word2id) + '\n')
+        os.replace(words_path + pid, words_path)
+        return vectors, word2id
+
+    logger.info("Reloading embeddings from %s ..." % vectors_path)
+    vectors = np.load(vectors_path, mmap_mode='r')
+    assert vectors.ndim == 2 and vectors.shape[1] == dim
+    with open(words_path, encoding='UTF-8', newline='\n') as f:
+        word2id = {line.rstrip('\n'): i for i, line in enumerate(f)}
+    assert len(word2id) == len(vectors)
 
     logger.info("Reloaded %i embeddings." % len(vectors))
     return vectors, word2id
@@ -73,7 +114,40 @@ def reload_embeddings(path, dim):
     if path.endswith('pth'):
         return reload_pth_emb(path, dim)
     else:
-        return reload_txt_emb(path, dim)
+        return reload_cached_emb(path, dim)
+
+
+def get_emb_rows(dico, n_words, word2id):
+    """
+    Map the words of a dictionary to the rows of pretrained embeddings,
+    words not found are looked up lowercased.
+    :return: ids of the words found, their rows in the embeddings, number of words found after lowercasing
+    """
+    word_ids = []
+    rows = []
+    n_lower = 0
+    for word_id, word in enumerate(dico.get_word_array()[:n_words]):
+        row = word2id.get(word)
+        if row is None:
+            row = word2id.get(word.lower())
+            if row is None:
+                continue
+            n_lower += 1
+        word_ids.append(word_id)
+        rows.append(row)
+
+    return np.array(word_ids, dtype=np.int64), np.array(rows, dtype=np.int64), n_lower
+
+
+def set_emb_rows(to_update, word_ids, vectors):
+    """
+    Copy the pretrained vectors to the rows word_ids of each weight to update.
+    :param vectors: array of shape (len(word_ids), dim)
+    """
+    word_ids = torch.from_numpy(word_ids)
+    vectors = torch.from_numpy(np.ascontiguousarray(vectors))
+    for x in to_update:
+        x.index_copy_(0, word_ids.to(x.device), vectors.to(x.device, x.dtype))
 
 
 def initialize_embeddings(encoder, decoder, params, data):
@@ -133,31 +207,10 @@ def initialize_embeddings(encoder, decoder, params, data):
         if not params.share_decpro_emb and params.pretrained_out:
             to_update.append(decoder.proj[i].weight.data)
 
-        # for every word in that language
-        for word_id in range(params.n_words[i]):
-            word = dico[word_id]
-
-            # if word is in the dictionary of that language
-            if word in word2id[i]:
-
-                # count the number of words found for each language
-                found[i] += 1
-
-                # get the embedding vector for that word
-                vec = torch.from_numpy(pretrained[i][word2id[i][word]]).cuda()
-
-                # for each embedding layer to update
-                # set the word_id's word vector to vec
-                for x in to_update:
-                    x[word_id] = vec
-
-            # if word requires lowercasing
-            elif word.lower() in word2id[i]:
-                found[i] += 1
-                lower[i] += 1
-                vec = torch.from_numpy(pretrained[i][word2id[i][word.lower()]]).cuda()
-                for x in to_update:
-                    x[word_id] = vec
+        # copy the vectors of all the words found, with a single indexed copy per weight
+        word_ids, rows, lower[i] = get_emb_rows(dico, params.n_words[i], word2id[i])
+        found[i] = len(word_ids)
+        set_emb_rows(to_update, word_ids, pretrained[i][rows])
 
     # print summary
     for i, lang in enumerate(params.langs):
@@ -170,7 +223,15 @@ def initialize_embeddings(encoder, decoder, params, data):
 
 if __name__ == "__main__":
 
-    # test loading embeddings from txt file
-    vectors, word2id = reload_embeddings(path="corpora/mono/all.en-fr.60000.vec", dim=512)
-    print(vectors.shape())
-    print(word2id)
\ No newline at end of file
+    # time loading embeddings from txt file, then from the binary cache
+    import time
+    path = sys.argv[1] if len(sys.argv) > 1 else "corpora/mono/all.en-fr.60000.vec"
+    for _ in range(2):
+        start = time.perf_counter()
+        vectors, word2id = reload_embeddings(path=path, dim=512)
+        print("%i embeddings of dim %i loaded in %.2fs" % (vectors.shape[0], vectors.shape[1],
+                                                           time.perf_counter() - start))
+
+    # the cache holds the same embeddings as the text file
+    txt_vectors, txt_word2id = reload_txt_emb(path, dim=512)
+    assert txt_word2id == word2id and np.array_equal(txt_vectors, vectors)
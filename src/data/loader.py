@@ -6,12 +6,15 @@
 #
 
 import os
+import glob
 from logging import getLogger
+import numpy as np
 import torch
 
 from .utils import create_word_masks
-from .dataset import MonolingualDataset, ParallelDataset
+from .dataset import MonolingualDataset, ShardedMonolingualDataset, ParallelDataset
 from .dictionary import BOS_WORD, EOS_WORD, PAD_WORD, UNK_WORD, SPECIAL_WORD, SPECIAL_WORDS
+from .dictionary import Dictionary, MMAP_SUFFIX, MMAP_SENTENCES, MMAP_POSITIONS
 
 
 logger = getLogger()
@@ -20,21 +23,30 @@ logger = getLogger()
 loaded_data = {}  # store binarized datasets in memory in case of multiple reloadings
 
 
-def load_binarized(path, params):
+def load_binarized(path, params, cache=True):
     """
     Load a binarized dataset and log main statistics.
+    :param cache: keep the dataset in memory for the next reloadings, shards of a sharded dataset are not kept
     """
     if path in loaded_data:
         logger.info("Reloading data loaded from %s ..." % path)
         return loaded_data[path]
 
-    assert os.path.isfile(path), path
-    logger.info("Loading data from %s ..." % path)
-    data = torch.load(path)
-    data['positions'] = data['positions'].numpy()
+    # memory-mapped datasets are not read, sentences are separated by -1 only in torch.save datasets
+    if path.endswith(MMAP_SUFFIX):
+        logger.info("Memory-mapping data from %s ..." % path)
+        data = Dictionary.load_mmap(path)
+        n_words = len(data['sentences'])
+
+    else:
+        assert os.path.isfile(path), path
+        logger.info("Loading data from %s ..." % path)
+        data = torch.load(path)
+        data['positions'] = data['positions'].numpy()
+        n_words = len(data['sentences']) - len(data['positions'])
 
     logger.info("%i words (%i unique) in %i sentences. %i unknown words (%i unique)." % (
-        len(data['sentences']) - len(data['positions']),
+        n_words,
         len(data['dico']), len(data['positions']),
         sum(data['unk_words'].values()), len(data['unk_words'])
     ))
@@ -43,13 +55,17 @@ def load_binarized(path, params):
         assert params.max_vocab > 0
         logger.info("Selecting %i most frequent words ..." % params.max_vocab)
         data['dico'].prune(params.max_vocab)
+
+    # memory-mapped sentences are read-only, pruned words are replaced when batches are created
+    if params.max_vocab != -1 and not path.endswith(MMAP_SUFFIX):
         data['sentences'].masked_fill_((data['sentences'] >= params.max_vocab), data['dico'].index(UNK_WORD))
         unk_count = (data['sentences'] == data['dico'].index(UNK_WORD)).sum()
         logger.info("Now %i unknown words covering %.2f%% of the data." % (
-            unk_count, 100. * unk_count / (len(data['sentences']) - len(data['positions']))
+            unk_count, 100. * unk_count / n_words
         ))
 
-    loaded_data[path] = data
+    if cache:
+        loaded_data[path] = data
     return data
 
 
@@ -223,8 +239,8 @@ def load_back_data(params, data):
     for (lang1, lang2), (src_path, tgt_path) in params.back_dataset.items():
 
         assert lang1 in params.langs and lang2 in params.langs
-        assert os.path.isfile(src_path)
-        assert os.path.isfile(tgt_path)
+        assert is_binarized(src_path)
+        assert is_binarized(tgt_path)
 
         logger.info('============ Back-parallel data (%s - %s)' % (lang1, lang2))
 
@@ -286,8 +302,15 @@ def load_mono_data(params, data):
                 datasets.append((name, None))
                 continue
 
+            # sharded training data, the shards are loaded one at a time by the iterators
+            shard_paths = get_shard_paths(path) if is_sharded(path) else None
+            if shard_paths is not None:
+                assert name == 'train'
+                logger.info("%i shards in %s" % (len(shard_paths), path))
+                path = shard_paths[0]
+
             # load data
-            mono_data = load_binarized(path, params)
+            mono_data = load_binarized(path, params, cache=shard_paths is None)
             set_parameters(params, mono_data['dico'])
             # print(mono_data['sentences'])
             # print(data['dico'][lang].word2id)
@@ -300,8 +323,13 @@ def load_mono_data(params, data):
                 assert data['dico'][lang] == mono_data['dico']
 
             # monolingual data
-            mono_data = MonolingualDataset(mono_data['sentences'], mono_data['positions'],
-                                           data['dico'][lang], params.lang2id[lang], params)
+            if shard_paths is not None:
+                mono_data = ShardedMonolingualDataset(shard_paths, lambda p: load_binarized(p, params, cache=False),
+                                                      data['dico'][lang], params.lang2id[lang], params,
+                                                      count_shard=count_binarized)
+            else:
+                mono_data = MonolingualDataset(mono_data['sentences'], mono_data['positions'],
+                                               data['dico'][lang], params.lang2id[lang], params)
 
             # remove too long sentences (train / valid only, test must remain unchanged)
             if name != 'test':
@@ -319,6 +347,44 @@ def load_mono_data(params, data):
     logger.info('')
 
 
+def is_sharded(path):
+    """
+    Sharded datasets are given as a glob pattern of their shards, e.g. train.*.en.pth
+    """
+    return glob.has_magic(path)
+
+
+def get_shard_paths(pattern):
+    """
+    Sorted paths of the binarized shards matching a glob pattern, in the torch.save or in the memory-mapped format.
+    """
+    if pattern.endswith(MMAP_SUFFIX):
+        return sorted(p[:-len(MMAP_SENTENCES)] for p in glob.glob(pattern + MMAP_SENTENCES))
+    return sorted(glob.glob(pattern))
+
+
+def count_binarized(path):
+    """
+    Number of sentences of a binarized dataset. Only the header of memory-mapped positions is read,
+    torch.save datasets have no header and are loaded.
+    """
+    if path.endswith(MMAP_SUFFIX):
+        return len(np.load(path + MMAP_POSITIONS, mmap_mode='r'))
+    return len(torch.load(path)['positions'])
+
+
+def is_binarized(path):
+    """
+    Check that a binarized dataset exists, in the torch.save or in the memory-mapped format.
+    For a sharded dataset, check that at least one shard exists.
+    """
+    if is_sharded(path):
+        return len(get_shard_paths(path)) > 0
+    if path.endswith(MMAP_SUFFIX):
+        return os.path.isfile(path + MMAP_SENTENCES)
+    return os.path.isfile(path)
+
+
 def check_all_data_params(params):
     """
     Check datasets parameters.
@@ -339,7 +405,7 @@ def check_all_data_params(params):
         assert all(lang in params.langs for lang in params.mono_dataset.keys())
         assert all(len(v.split(',')) == 3 for v in params.mono_dataset.values())
         params.mono_dataset = {k: tuple(v.split(',')) for k, v in params.mono_dataset.items()}
-        assert all(all(((i > 0 and path == '') or os.path.isfile(path)) for i, path in enumerate(paths))
+        assert all(all(((i > 0 and path == '') or is_binarized(path)) for i, path in enumerate(paths))
                    for paths in params.mono_dataset.values())
 
     # check parallel datasets
@@ -351,12 +417,12 @@ def check_all_data_params(params):
     assert not (params.n_para == 0) ^ (all(v[0] == '' for v in params.para_dataset.values()))
     for (lang1, lang2), (train_path, valid_path, test_path) in params.para_dataset.items():
         assert lang1 < lang2 and lang1 in params.langs and lang2 in params.langs
-        assert train_path == '' or os.path.isfile(train_path.replace('XX', lang1))
-        assert train_path == '' or os.path.isfile(train_path.replace('XX', lang2))
-        assert os.path.isfile(valid_path.replace('XX', lang1))
-        assert os.path.isfile(valid_path.replace('XX', lang2))
-        assert os.path.isfile(test_path.replace('XX', lang1))
-        assert os.path.isfile(test_path.replace('XX', lang2))
+        assert train_path == '' or is_binarized(train_path.replace('XX', lang1))
+        assert train_path == '' or is_binarized(train_path.replace('XX', lang2))
+        assert is_binarized(valid_path.replace('XX', lang1))
+        assert is_binarized(valid_path.replace('XX', lang2))
+        assert is_binarized(test_path.replace('XX', lang1))
+        assert is_binarized(test_path.replace('XX', lang2))
 
     # check back-parallel datasets
     params.back_dataset = {k: v for k, v in [x.split(':') for x in params.back_dataset.split(';') if len(x) > 0]}
@@ -370,8 +436,8 @@ def check_all_data_params(params):
     }
     for (lang1, lang2), (src_path, tgt_path) in params.back_dataset.items():
         assert lang1 in params.langs and lang2 in params.langs
-        assert os.path.isfile(src_path)
-        assert os.path.isfile(tgt_path)
+        assert is_binarized(src_path)
+        assert is_binarized(tgt_path)
 
     # check parallel directions
     # params.para_directions = [x.split('-') for x in params.para_directions.split(',') if len(x) > 0]
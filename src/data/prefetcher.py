@@ -0,0 +1,148 @@
+from logging import getLogger
+import threading
+import queue
+import torch
+
+logger = getLogger()
+
+# marks the end of the batches in the queues
+END_OF_DATA = object()
+
+
+class Prefetcher(object):
+    """
+    Prepares the next batches in background threads while the model is computing.
+
+    Batch i of the source iterator is prepared by worker i % n_workers, and the consumer
+    reads the workers round-robin, so batches come out in the order of the source iterator.
+    Each worker draws its randomness from its own generator, seeded with seed + worker_id,
+    so for a given seed and number of workers the prepared batches are reproducible.
+
+    The threads hold the prefetcher until close is called, or the end of the data is reached,
+    so a prefetcher dropped before the end of the data must be closed by its owner.
+    """
+
+    def __init__(self, iterator, prepare, device, n_workers=1, prefetch=2, seed=0):
+        """
+        :param iterator: iterator over raw batches
+        :param prepare: function (batch, generator) -> dict of CPU tensors
+        :param device: device the tensors of the batch dict are moved to
+        :param n_workers: number of threads preparing batches
+        :param prefetch: number of prepared batches each worker keeps ahead
+        :param seed: seed of the worker generators
+        """
+        assert n_workers >= 1 and prefetch >= 1
+        self.iterator = iterator
+        self.prepare = prepare
+        self.device = torch.device(device)
+        self.n_workers = n_workers
+        self.pin_memory = self.device.type == 'cuda'
+
+        self.stop = threading.Event()
+        self.in_queues = [queue.Queue(prefetch) for _ in range(n_workers)]
+        self.out_queues = [queue.Queue(prefetch) for _ in range(n_workers)]
+        self.next_worker = 0
+
+        self.threads = [threading.Thread(target=self.read, daemon=True)]
+        for i in range(n_workers):
+            generator = torch.Generator()
+            generator.manual_seed(seed + i)
+            self.threads.append(threading.Thread(target=self.work, args=(i, generator), daemon=True))
+
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, q, item):
+        """
+        Put an item in a bounded queue, gives up when the prefetcher is closed
+        """
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q):
+        """
+        Get an item from a queue, returns END_OF_DATA when the prefetcher is closed
+        """
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return END_OF_DATA
+
+    def read(self):
+        """
+        Dispatch the raw batches to the workers, round-robin
+        """
+        n_batches = 0
+        try:
+            for batch in self.iterator:
+                if not self.put(self.in_queues[n_batches % self.n_workers], batch):
+                    return
+                n_batches += 1
+
+        except Exception as e:
+            # the consumer gets the exception in place of the next batch
+            logger.exception("message")
+            self.put(self.in_queues[n_batches % self.n_workers], e)
+
+        for q in self.in_queues:
+            self.put(q, END_OF_DATA)
+
+    def work(self, worker_id, generator):
+        """
+        Prepare the batches of one worker, pin them if they are going to the GPU
+        """
+        while True:
+            batch = self.get(self.in_queues[worker_id])
+
+            if batch is END_OF_DATA or isinstance(batch, Exception):
+                self.put(self.out_queues[worker_id], batch)
+                return
+
+            try:
+                batch_dict = self.prepare(batch, generator)
+                # batches built in pinned memory are not copied again
+                if self.pin_memory:
+                    batch_dict = {k: v.pin_memory() if torch.is_tensor(v) else v for k, v in batch_dict.items()}
+
+            except Exception as e:
+                logger.exception("message")
+                self.put(self.out_queues[worker_id], e)
+                return
+
+            if not self.put(self.out_queues[worker_id], batch_dict):
+                return
+
+    def close(self):
+        """
+        Stop the background threads
+        """
+        self.stop.set()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch_dict = self.out_queues[self.next_worker].get()
+        self.next_worker = (self.next_worker + 1) % self.n_workers
+
+        if batch_dict is END_OF_DATA:
+            self.close()
+            raise StopIteration
+
+        if isinstance(batch_dict, Exception):
+            self.close()
+            raise batch_dict
+
+        # copies from pinned memory are asynchronous with respect to the host
+        return {k: v.to(self.device, non_blocking=True) if torch.is_tensor(v) else v
+                for k, v in batch_dict.items()}
+
+    def __del__(self):
+        self.close()
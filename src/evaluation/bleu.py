@@ -0,0 +1,130 @@
+import re
+import math
+from collections import Counter
+from logging import getLogger
+
+logger = getLogger()
+
+# same substitution as sed -r 's/(@@ )|(@@ ?$)//g'
+BPE_PATTERN = re.compile(r'(@@ )|(@@ ?$)')
+
+MAX_ORDER = 4
+
+
+def restore_segmentation_text(sentences):
+    """
+    Take a list of sentences segmented with BPE and restore them to their original segmentation.
+    """
+    return [BPE_PATTERN.sub('', s) for s in sentences]
+
+
+def get_ngrams(words, max_order=MAX_ORDER):
+    """
+    Count the n-grams of a sentence, for n from 1 to max_order.
+    """
+    ngrams = Counter()
+    for n in range(1, max_order + 1):
+        for start in range(len(words) - n + 1):
+            ngrams[tuple(words[start:start + n])] += 1
+    return ngrams
+
+
+def get_bleu_stats(hypotheses, references, max_order=MAX_ORDER):
+    """
+    Compute the corpus statistics of BLEU, as multi-bleu.perl does.
+    :param hypotheses: list of sentences
+    :param references: list of reference sentences, or of lists of reference sentences
+    :return: correct and total n-gram counts (index n - 1), hypothesis and reference lengths
+    """
+    assert len(hypotheses) == len(references), (len(hypotheses), len(references))
+    correct = [0] * max_order
+    total = [0] * max_order
+    hyp_len = 0
+    ref_len = 0
+
+    for hyp, refs in zip(hypotheses, references):
+        if isinstance(refs, str):
+            refs = [refs]
+
+        words = hyp.split()
+        hyp_len += len(words)
+
+        # take the closest reference length, the shorter one on ties
+        ref_ngrams = Counter()
+        closest_diff, closest_len = 9999, 9999
+        for ref in refs:
+            ref_words = ref.split()
+            diff = abs(len(words) - len(ref_words))
+            if diff < closest_diff or (diff == closest_diff and len(ref_words) < closest_len):
+                closest_diff, closest_len = diff, len(ref_words)
+
+            # n-grams are clipped by their max count over the references
+            ref_ngrams |= get_ngrams(ref_words, max_order)
+        ref_len += closest_len
+
+        for ngram, count in get_ngrams(words, max_order).items():
+            total[len(ngram) - 1] += count
+            correct[len(ngram) - 1] += min(count, ref_ngrams[ngram])
+
+    return correct, total, hyp_len, ref_len
+
+
+def corpus_bleu(hypotheses, references, max_order=MAX_ORDER):
+    """
+    Corpus BLEU score, matches the score printed by multi-bleu.perl, rounded to 2 decimals.
+    """
+    correct, total, hyp_len, ref_len = get_bleu_stats(hypotheses, references, max_order)
+
+    if ref_len == 0:
+        logger.warning("Empty references, BLEU is 0")
+        return 0.
+
+    # multi-bleu.perl does not smooth, a precision of 0 gives a score of 0
+    precisions = [c / t if t > 0 else 0 for c, t in zip(correct, total)]
+    if min(precisions) == 0:
+        return 0.
+
+    brevity_penalty = math.exp(1 - ref_len / hyp_len) if hyp_len < ref_len else 1
+    bleu = brevity_penalty * math.exp(sum(math.log(p) for p in precisions) / max_order)
+    return float("%.2f" % (100 * bleu))
+
+
+if __name__ == "__main__":
+
+    # compare with multi-bleu.perl on random sentences
+    import os
+    import random
+    import subprocess
+    import tempfile
+
+    BLEU_SCRIPT_PATH = 'src/evaluation/multi-bleu.perl'
+    vocab = ['w%i' % i for i in range(20)] + ['w%i@@' % i for i in range(5)]
+
+    def random_sentence():
+        return ' '.join(random.choice(vocab) for _ in range(random.randint(0, 25)))
+
+    def noisy_copy(sentence, p):
+        words = [w if random.random() > p else random.choice(vocab) for w in sentence.split()]
+        return ' '.join(w for w in words if random.random() > p / 2)
+
+    for i in range(20):
+        refs = [random_sentence() for _ in range(100)]
+        hyps = restore_segmentation_text([noisy_copy(s, p=i / 20) for s in refs])
+        refs = restore_segmentation_text(refs)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            ref_path = os.path.join(tmp, 'ref.txt')
+            hyp_path = os.path.join(tmp, 'hyp.txt')
+            with open(ref_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(refs) + '\n')
+            with open(hyp_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(hyps) + '\n')
+            command = 'perl ' + BLEU_SCRIPT_PATH + ' %s < %s'
+            p = subprocess.Popen(command % (ref_path, hyp_path), stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL, shell=True)
+            result = p.communicate()[0].decode("utf-8")
+
+        bleu = corpus_bleu(hyps, refs)
+        moses_bleu = float(result[7:result.index(',')])
+        print("BLEU %.2f, multi-bleu.perl %.2f" % (bleu, moses_bleu))
+        assert bleu == moses_bleu
@@ -19,13 +19,14 @@ from src.utils.logger import create_logger
 from src.trainers.unsupervised_trainer import UnsupervisedTrainer
 import logging
 from src.model.beam_search_wrapper import MyBeamSearch
+from src.model.masks import Masks
+from src.evaluation.bleu import corpus_bleu, restore_segmentation_text
 
 
 logger = getLogger()
 
 TOOLS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools')
 BLEU_SCRIPT_PATH = 'src/evaluation/multi-bleu.perl'
-assert os.path.isfile(BLEU_SCRIPT_PATH), "Moses not found. Please be sure you downloaded Moses in %s" % TOOLS_PATH
 
 def restore_segmentation(path):
     """
@@ -37,19 +38,24 @@ def restore_segmentation(path):
 
 class EvaluatorMT(object):
 
-    def __init__(self, transformer, params, exp_name, device):
+    def __init__(self, transformer, params, exp_name, device, dump_files=False):
         """
         Initialize evaluator.
+        :param dump_files: also write the references and hypotheses to files in exp_name
         """
-        self.encoder = transformer.module.encoder
-        self.decoder = transformer.module.decoder
-        self.decode = transformer.module.decode
-
-        self.data = transformer.module.data
-        self.dico = transformer.module.data['dico']
+        # the transformer may be wrapped in DataParallel or DistributedDataParallel
+        transformer = getattr(transformer, 'module', transformer)
+        self.encoder = transformer.encoder
+        self.decoder = transformer.decoder
+        self.decode = transformer.decode
+
+        self.data = transformer.data
+        self.dico = transformer.data['dico']
         self.params = params
         self.exp_name = exp_name
         self.device = device
+        self.dump_files = dump_files
+        self.masks = Masks(params.pad_index, params.max_len)
 
         # create reference files for BLEU evaluation
         self.create_reference_files()
@@ -69,25 +75,11 @@ class EvaluatorMT(object):
 
     def get_src_mask(self, src_batch):
 
-        mask = torch.ones_like(src_batch)
-        mask.masked_fill_(src_batch == self.params.pad_index, 0).unsqueeze_(-2).unsqueeze_(-2)
-        #print("mask", mask)
-        return mask
+        return self.masks.get_src_mask(src_batch)
 
     def get_tgt_mask(self, tgt_batch):
 
-        batch_size, sent_len = tgt_batch.shape
-
-        # hide future words
-        tgt_m = np.tril(np.ones((batch_size, sent_len, sent_len)), k=0).astype(np.uint8)
-        #print("tgt_m", tgt_m)
-
-        tgt_m = torch.from_numpy(tgt_m)
-
-        # hide padding
-        tgt_m.masked_fill_(tgt_batch.unsqueeze(-1) == self.params.pad_index, 0).unsqueeze_(1)
-        #print("tgt_m", tgt_m)
-        return tgt_m
+        return self.masks.get_tgt_mask(tgt_batch)
 
     def compute_sent_len(self, sentences):
         """
@@ -111,7 +103,7 @@ class EvaluatorMT(object):
         """
         output, len = self.beam_search(src_batch, src_mask, src_lang=src_lang, tgt_lang=tgt_lang)
 
-        return output.transpose_(0, 1), len
+        return output, len
 
     def mono_iterator(self, data_type, lang):
         """
@@ -149,6 +141,7 @@ class EvaluatorMT(object):
         """
         params = self.params
         params.ref_paths = {}
+        params.ref_txt = {}
 
         for (lang1, lang2), v in self.data['para'].items():
 
@@ -173,19 +166,24 @@ class EvaluatorMT(object):
                 lang1_txt = [x.replace('<unk>', '<<unk>>') for x in lang1_txt]
                 lang2_txt = [x.replace('<unk>', '<<unk>>') for x in lang2_txt]
 
-                # export hypothesis
-                with open(lang1_path, 'w', encoding='utf-8') as f:
-                    f.write('\n'.join(lang1_txt) + '\n')
-                with open(lang2_path, 'w', encoding='utf-8') as f:
-                    f.write('\n'.join(lang2_txt) + '\n')
-
                 # restore original segmentation
-                restore_segmentation(lang1_path)
-                restore_segmentation(lang2_path)
+                lang1_txt = restore_segmentation_text(lang1_txt)
+                lang2_txt = restore_segmentation_text(lang2_txt)
+
+                # store references
+                params.ref_txt[(lang2, lang1, data_type)] = lang1_txt
+                params.ref_txt[(lang1, lang2, data_type)] = lang2_txt
 
-                # store data paths
-                params.ref_paths[(lang2, lang1, data_type)] = lang1_path
-                params.ref_paths[(lang1, lang2, data_type)] = lang2_path
+                if self.dump_files:
+                    # export references
+                    with open(lang1_path, 'w', encoding='utf-8') as f:
+                        f.write('\n'.join(lang1_txt) + '\n')
+                    with open(lang2_path, 'w', encoding='utf-8') as f:
+                        f.write('\n'.join(lang2_txt) + '\n')
+
+                    # store data paths
+                    params.ref_paths[(lang2, lang1, data_type)] = lang1_path
+                    params.ref_paths[(lang1, lang2, data_type)] = lang2_path
 
     def eval_para(self, lang1, lang2, data_type, scores):
         """
@@ -210,10 +208,11 @@ class EvaluatorMT(object):
 
             # batch
             (sent1, len1), (sent2, len2) = batch
-            sent1, sent2 = sent1.transpose_(0, 1).cuda(), sent2.transpose_(0, 1).cuda()
+            sent1, sent2 = sent1.to(self.device), sent2.to(self.device)
 
-            src_mask = self.get_src_mask(sent1.cpu()).cuda()
-            tgt_mask = self.get_tgt_mask(sent2.cpu()).cuda()
+            # masks are built on the device
+            src_mask = self.get_src_mask(sent1)
+            tgt_mask = self.get_tgt_mask(sent2)
 
             # encode / decode / generatef
             sent2_ , len2_= self.generate_parallel(src_batch=sent1, src_mask=src_mask, src_lang=lang1_id, tgt_lang=lang2_id)
@@ -225,19 +224,21 @@ class EvaluatorMT(object):
             # convert to text
             txt.extend(convert_to_text(sent2_, len2_, self.dico[lang2], lang2_id, self.params))
 
-        # hypothesis / reference paths
-        hyp_name = 'hyp{0}.{1}-{2}.{3}.txt'.format(scores['epoch'], lang1, lang2, data_type)
-        hyp_path = os.path.join(self.exp_name, hyp_name)
-        ref_path = params.ref_paths[(lang1, lang2, data_type)]
-
-        # export sentences to hypothesis file / restore BPE segmentation
-        with open(hyp_path, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(txt) + '\n')
-        restore_segmentation(hyp_path)
+        # restore BPE segmentation
+        txt = restore_segmentation_text(txt)
 
         # evaluate BLEU score
-        bleu = eval_moses_bleu(ref_path, hyp_path)
-        logger.info("BLEU %s %s : %f" % (hyp_path, ref_path, bleu))
+        bleu = corpus_bleu(txt, params.ref_txt[(lang1, lang2, data_type)])
+        logger.info("BLEU %s -> %s (%s) : %f" % (lang1, lang2, data_type, bleu))
+
+        if self.dump_files:
+            # export sentences to hypothesis file
+            hyp_name = 'hyp{0}.{1}-{2}.{3}.txt'.format(scores['epoch'], lang1, lang2, data_type)
+            hyp_path = os.path.join(self.exp_name, hyp_name)
+            with open(hyp_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(txt) + '\n')
+            logger.info("Hypotheses written to %s, references in %s"
+                        % (hyp_path, params.ref_paths[(lang1, lang2, data_type)]))
 
         # update scores
         scores['ppl_%s_%s_%s' % (lang1, lang2, data_type)] = np.exp(xe_loss / count)
@@ -248,7 +249,9 @@ def eval_moses_bleu(ref, hyp):
     """
     Given a file of hypothesis and reference files,
     evaluate the BLEU score using Moses scripts.
+    Evaluation uses corpus_bleu, this is kept to check dumped files.
     """
+    assert os.path.isfile(BLEU_SCRIPT_PATH), "Moses not found. Please be sure you downloaded Moses in %s" % TOOLS_PATH
     assert os.path.isfile(ref) and os.path.isfile(hyp)
     command = BLEU_SCRIPT_PATH + ' %s < %s'
     p = subprocess.Popen(command % (ref, hyp), stdout=subprocess.PIPE, shell=True)
@@ -262,26 +265,26 @@ def eval_moses_bleu(ref, hyp):
 
 def convert_to_text(batch, lengths, dico, lang_id, params):
     """
-    Convert a batch of sentences to a list of text sentences.
+    Convert a batch of sentences, of size (bs, slen), to a list of text sentences.
     """
     batch = batch.cpu().numpy()
     lengths = lengths.cpu().numpy()
     bos_index = params.bos_index[lang_id]
 
-    slen, bs = batch.shape
+    bs, slen = batch.shape
     assert lengths.max() == slen and lengths.shape[0] == bs
-    assert (batch[0] == bos_index).sum() == bs
+    assert (batch[:, 0] == bos_index).sum() == bs
     # assert (batch == params.eos_index).sum() == bs
-    sentences = []
-
-    for j in range(bs):
-        words = []
-        for k in range(1, lengths[j]):
-            if batch[k, j] == params.eos_index:
-                break
-            words.append(dico[batch[k, j]])
-        sentences.append(" ".join(words))
-    return sentences
+
+    # words of each sentence, without bos, shape = bs, slen - 1
+    batch = batch[:, 1:]
+    words = dico.get_word_array()[batch]
+
+    # sentences stop at the first eos, or at their length
+    is_end = (batch == params.eos_index) | (np.arange(slen - 1)[None] >= lengths[:, None] - 1)
+    ends = np.where(is_end.any(1), is_end.argmax(1), slen - 1)
+
+    return [" ".join(words[j, :ends[j]]) for j in range(bs)]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+"""
+Benchmark of the attention forward / backward, fused projections and scaled dot product attention kernel
+against the former implementation with separate projections.
+
+usage: python -m src.model.attention_benchmark [N_ITER]
+"""
+import sys
+import time
+from src.model.sublayers import *
+from src.utils.config import params
+
+
+class UnfusedSelfAttention(torch.nn.Module):
+    """
+    Former attention, separate q, k, v projections, scores materialized and masked out of place.
+    """
+
+    def __init__(self, params):
+        super(UnfusedSelfAttention, self).__init__()
+        self.d_model = params["d_model"]
+        self.d_k = params["d_k"]
+        self.heads = params["h"]
+
+        self.W_q = torch.nn.Linear(self.d_model, self.d_model, bias=False)
+        self.W_k = torch.nn.Linear(self.d_model, self.d_model, bias=False)
+        self.W_v = torch.nn.Linear(self.d_model, self.d_model, bias=False)
+        self.W_o = torch.nn.Linear(self.d_model, self.d_model, bias=False)
+
+    def forward(self, x_q, x_k, x_v, mask=None):
+        batch_size = x_q.shape[0]
+        Q = self.W_q(x_q).view(batch_size, -1, self.heads, self.d_k).transpose(1, 2)
+        K = self.W_k(x_k).view(batch_size, -1, self.heads, self.d_k).transpose(1, 2)
+        V = self.W_v(x_v).view(batch_size, -1, self.heads, self.d_k).transpose(1, 2)
+
+        scores = torch.matmul(Q, K.transpose(2, -1)) / np.sqrt(self.d_k)
+        if mask is not None:
+            scores = scores.masked_fill(mask == 0, -1e9)
+
+        scores = torch.nn.functional.softmax(scores, dim=-1)
+        attention = torch.matmul(scores, V).transpose(1, 2)
+        attention = attention.contiguous().view(batch_size, -1, self.d_model)
+        return self.W_o(attention)
+
+
+def time_attention(attn, x, y, mask, n_iter):
+    """
+    :return: average time of a forward / backward pass of self-attention over x and attention from x over y
+    """
+    for i in range(n_iter + 1):
+        # the first iteration is a warm up
+        if i == 1:
+            if x.is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+
+        out = attn(x, x, x, mask=mask[0]) + attn(x, y, y, mask=mask[1])
+        out.sum().backward()
+
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / n_iter
+
+
+if __name__ == '__main__':
+
+    n_iter = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+
+    unfused = UnfusedSelfAttention(params).to(device)
+    fused = SelfAttention(params).to(device)
+    fused.load_state_dict(unfused.state_dict())
+    fused_sdpa = SelfAttention(params).to(device)
+    fused_sdpa.load_state_dict(fused.state_dict())
+    fused.use_sdpa = False
+
+    # same outputs from a checkpoint of the former attention
+    batch_size, d_model = 32, params["d_model"]
+    x = torch.randn(batch_size, 30, d_model, device=device)
+    y = torch.randn(batch_size, 40, d_model, device=device)
+    tgt_mask = torch.ones(30, 30, dtype=torch.bool, device=device).tril_().expand(batch_size, 1, 30, 30)
+    src_mask = (torch.arange(40, device=device) < torch.randint(1, 41, (batch_size, 1, 1, 1), device=device))
+    for attn in [fused, fused_sdpa]:
+        for q, kv, mask in [(x, x, tgt_mask), (x, y, src_mask)]:
+            out, expected = attn(q, kv, kv, mask=mask), unfused(q, kv, kv, mask=mask)
+            assert torch.allclose(out, expected, atol=1e-5), (out - expected).abs().max()
+    print("fused attention matches the former attention, sdpa available: %s" % fused_sdpa.use_sdpa)
+
+    for batch_size in [32, 64]:
+        for sent_len in [30, 100]:
+            x = torch.randn(batch_size, sent_len, d_model, device=device, requires_grad=True)
+            y = torch.randn(batch_size, sent_len, d_model, device=device)
+            tgt_mask = torch.ones(sent_len, sent_len, dtype=torch.bool, device=device).tril_()
+            tgt_mask = tgt_mask.expand(batch_size, 1, sent_len, sent_len)
+            src_mask = torch.arange(sent_len, device=device) < torch.randint(1, sent_len + 1, (batch_size, 1, 1, 1),
+                                                                              device=device)
+            times = [time_attention(attn, x, y, (tgt_mask, src_mask), n_iter) for attn in [unfused, fused, fused_sdpa]]
+            print("batch_size %i sent_len %i: former %.2fms, fused %.2fms, fused + sdpa %.2fms" %
+                  (batch_size, sent_len, times[0] * 1000, times[1] * 1000, times[2] * 1000))
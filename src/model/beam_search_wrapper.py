@@ -1,10 +1,16 @@
 from src.model.transformer import *
 from src.onmt.translate.beam import *
 from src.onmt.translate.beam_search import BeamSearch
+from src.onmt.translate.random_sampling import RandomSampling
+from torch.nn.utils.rnn import pad_sequence
 from logging import getLogger
 from src.utils.beam_search_utils import tile
 import torch.nn as nn
 
+# decoding strategies to generate sentences
+DECODINGS = ['greedy', 'sample', 'beam']
+
+
 class MyBeamSearch(torch.nn.Module):
     '''
     Wrapper around OpenNMT beam search that suits our purposes
@@ -15,41 +21,253 @@ class MyBeamSearch(torch.nn.Module):
         mb_device: the type of device. See https://pytorch.org/docs/stable/tensor_attributes.html#torch.torch.device
         encoding_lengths: LongTensor of encoding lengths
         max_length: Longest acceptable sequence, not counting begin-of-sentence (presumably there has been no EOS yet if max_length is used as a cutoff)
+        decoding: default decoding strategy, greedy (argmax, no beam bookkeeping), sample (top-k / temperature
+                  sampling with RandomSampling) or beam
+        sampling_temp: temperature of the sampling
+        keep_topk: sample among the keep_topk best words (-1 for all words)
+        bucket_size: decode the batch in buckets of at most bucket_size sentences of similar source lengths
+                     (0 for a single bucket)
+        max_len_a, max_len_b: the generated sentences are at most max_len_a * source length + max_len_b long,
+                              capped by max_length (max_len_a = 0 for max_length only)
     '''
     def __init__(self, transformer, beam_size, n_best,
-                 encoding_lengths, max_length, logger):
+                 encoding_lengths, max_length, logger,
+                 decoding='beam', sampling_temp=1.0, keep_topk=-1, bucket_size=0,
+                 max_len_a=0, max_len_b=10):
 
         super(MyBeamSearch, self).__init__()
+        assert decoding in DECODINGS
         self.beam_size = beam_size
         self.max_length = max_length
         self.logger = logger
 
-        self.pad_index = transformer.module.pad_index
-        self.eos_index = transformer.module.eos_index
-        self.bos_index = transformer.module.bos_index
-        self.id2lang = transformer.module.id2lang
-        self.transformer = transformer.module.eval()
+        # the transformer may be wrapped in DataParallel
+        transformer = getattr(transformer, 'module', transformer)
+        self.pad_index = transformer.pad_index
+        self.eos_index = transformer.eos_index
+        self.bos_index = transformer.bos_index
+        self.id2lang = transformer.id2lang
+        self.transformer = transformer.eval()
 
         self.n_best = n_best
         self.encoding_lengths = encoding_lengths
         self.max_length = max_length
 
+        self.decoding = decoding
+        self.sampling_temp = sampling_temp
+        self.keep_topk = keep_topk
+        self.bucket_size = bucket_size
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+
     '''
-    Performs beam search on a batch of sequences
-    Adapted from _translate_batch in translator.py from onmt
-    Returns: hypotheses (list[list[Tuple[Tensor]]]): Contains a tuple
-            of score (float), sequence (long), and attention (float or None).
+    Generates sentences for a batch of sequences
+    :param random: for beam search, pick a random hypothesis among the n_best of each sentence
+    :param decoding: decoding strategy, defaults to self.decoding
+    Returns: sentences (LongTensor): generated sentence of each sentence, with bos and eos, shape batch_size x max_len
+             lengths (LongTensor): length of each sentence
     '''
-    def forward(self, batch, src_mask, src_lang, tgt_lang, random=False):
+    def forward(self, batch, src_mask, src_lang, tgt_lang, random=False, decoding=None):
 
-        batch_size = batch.size(0)
+        decoding = self.decoding if decoding is None else decoding
+        assert decoding in DECODINGS
 
-        # get device
-        if batch.is_cuda:
-            device = batch.get_device()
+        batch_size = batch.size(0)
+        if self.bucket_size <= 0 or batch_size <= self.bucket_size:
+            seqs, lengths = self.decode_batch(batch, src_mask, src_lang, tgt_lang, random, decoding)
 
         else:
-            device = torch.device('cpu')
+            # sentences of similar lengths are decoded together, so little padding is decoded
+            src_lengths = self.get_src_lengths(src_mask)
+            order = src_lengths.argsort(descending=True)
+            buckets = []
+            for bucket in order.split(self.bucket_size):
+                src_len = src_lengths[bucket[0]].item()
+                buckets.append((bucket, self.decode_batch(batch[bucket, :src_len], src_mask[bucket, ..., :src_len],
+                                                          src_lang, tgt_lang, random, decoding)))
+
+            # put the sentences back in the order of the batch
+            max_len = max(bucket_seqs.size(1) for _, (bucket_seqs, _) in buckets)
+            seqs = batch.new_full((batch_size, max_len), self.pad_index)
+            lengths = batch.new_zeros(batch_size)
+            for bucket, (bucket_seqs, bucket_lengths) in buckets:
+                seqs[bucket, :bucket_seqs.size(1)] = bucket_seqs
+                lengths[bucket] = bucket_lengths
+
+        sentences, len = self.format_sentences(seqs, lengths, tgt_lang=tgt_lang)
+        return sentences, len
+
+    def decode_batch(self, batch, src_mask, src_lang, tgt_lang, random, decoding):
+        """
+        Encodes the batch and decodes it with the given strategy
+        :return: generated words, padded, shape = batch_size, len, and number of words of each sentence
+        """
+
+        # disable gradient tracking
+        with torch.set_grad_enabled(False):
+
+            # (1) Run the encoder on the src.
+            enc_out = self.transformer.encode(batch,
+                                          src_mask=src_mask,
+                                          src_lang=src_lang,
+                                          n_samples=1,
+                                          return_kl=False)
+
+            #self.logger.info("enc_out batch size %i " % (enc_out.size(0)))
+
+            max_lengths = self.get_max_lengths(src_mask)
+
+            if decoding == 'greedy':
+                return self.greedy_search(enc_out, src_mask, tgt_lang, max_lengths)
+
+            elif decoding == 'sample':
+                return self.sample(enc_out, src_mask, tgt_lang, max_lengths)
+
+            else:
+                return self.beam_search(enc_out, src_mask, tgt_lang, random, max_lengths)
+
+    def get_max_lengths(self, src_mask):
+        """
+        :return: max number of generated words of each sentence, max_len_a * source length + max_len_b,
+                 None when only max_length applies
+        """
+        if self.max_len_a <= 0:
+            return None
+
+        max_lengths = (self.max_len_a * self.get_src_lengths(src_mask).float()).long() + self.max_len_b
+        return max_lengths.clamp(min=1, max=self.max_length)
+
+    @staticmethod
+    def get_src_lengths(src_mask):
+        """
+        :param src_mask: shape = batch_size, 1, 1, src_len
+        :return: number of source columns each sentence needs, up to its last non padding position
+        """
+        src_mask = src_mask[:, 0, 0] != 0
+        positions = torch.arange(1, src_mask.size(-1) + 1, device=src_mask.device)
+        return (src_mask.long() * positions).max(dim=-1)[0]
+
+    def remove_finished(self, cache, src_mask, select_indices):
+        """
+        Keeps the decoder states of the paths in select_indices, called when sentences are finished,
+        and drops the padding columns of the source no sentence left needs
+        :return: src_mask of the paths left
+        """
+        self.transformer.decoder.reorder_cache(cache, select_indices)
+        src_mask = src_mask.index_select(0, select_indices)
+
+        src_len = self.get_src_lengths(src_mask).max().item()
+        if src_len < src_mask.size(-1):
+            src_mask = src_mask[..., :src_len]
+            self.transformer.decoder.trim_src_cache(cache, src_len)
+
+        return src_mask
+
+    def greedy_search(self, enc_out, src_mask, tgt_lang, max_lengths=None):
+        """
+        Picks the best word at each step, finished sentences are removed from the batch
+        :param max_lengths: max number of generated words of each sentence, max_length if None
+        :return: generated words, padded, shape = batch_size, max_length, and number of words of each sentence
+        """
+        batch_size = enc_out.size(0)
+        device = enc_out.device
+
+        seqs = torch.full((batch_size, self.max_length), self.pad_index, dtype=torch.long, device=device)
+        lengths = torch.full((batch_size,), self.max_length, dtype=torch.long, device=device)
+
+        # index in the batch of the sentences left
+        batch_index = torch.arange(batch_size, device=device)
+        if max_lengths is None:
+            max_lengths = lengths.clone()
+
+        # per layer keys / values of the words generated so far, and of enc_out
+        cache = self.transformer.decoder.init_cache()
+        dec_in = torch.full((batch_size, 1), self.bos_index[tgt_lang], dtype=torch.long, device=device)
+
+        for step in range(self.max_length):
+
+            # enc_out is only read at the first step, then its keys / values come from the cache
+            scores = self.transformer.decode(dec_in, enc_out, src_mask,
+                                             tgt_mask=None, tgt_lang=tgt_lang,
+                                             cache=cache, step=step)[:, -1, :]
+
+            next_words = scores.argmax(dim=-1)
+            seqs[batch_index, step] = next_words
+
+            # the eos is part of the generated words, sentences reaching their max length end without eos
+            finished = (next_words == self.eos_index) | (max_lengths <= step + 1)
+            if finished.any():
+                lengths[batch_index[finished]] = step + 1
+                alive = (~finished).nonzero().view(-1)
+                if alive.size(0) == 0:
+                    break
+
+                batch_index = batch_index[alive]
+                max_lengths = max_lengths[alive]
+                next_words = next_words[alive]
+                src_mask = self.remove_finished(cache, src_mask, alive)
+
+            dec_in = next_words.unsqueeze(-1)
+
+        return seqs, lengths
+
+    def sample(self, enc_out, src_mask, tgt_lang, max_lengths=None):
+        """
+        Samples the next word among the keep_topk best words, with temperature sampling_temp
+        :param max_lengths: max number of generated words of each sentence, max_length if None
+        :return: generated words, padded, shape = batch_size, len, and number of words of each sentence
+        """
+        batch_size = enc_out.size(0)
+        device = enc_out.device
+
+        randomSampling = RandomSampling(pad=self.pad_index,
+                                        bos=self.bos_index[tgt_lang],
+                                        eos=self.eos_index,
+                                        batch_size=batch_size, device=device,
+                                        min_length=0, block_ngram_repeat=0,
+                                        exclusion_tokens=set(), return_attention=False,
+                                        max_length=self.max_length,
+                                        sampling_temp=self.sampling_temp,
+                                        keep_topk=self.keep_topk,
+                                        memory_length=self.encoding_lengths,
+                                        max_lengths=max_lengths)
+
+        cache = self.transformer.decoder.init_cache()
+        dec_in = randomSampling.alive_seq[:, -1:]
+
+        for step in range(self.max_length):
+
+            log_probs = self.transformer.decode(dec_in, enc_out, src_mask,
+                                                tgt_mask=None, tgt_lang=tgt_lang,
+                                                cache=cache, step=step)[:, -1, :]
+
+            log_probs = F.log_softmax(log_probs.float(), dim=-1)
+            randomSampling.advance(log_probs, None)
+
+            # finished sentences are removed from the batch
+            if randomSampling.is_finished.any():
+                randomSampling.update_finished()
+                if randomSampling.done:
+                    break
+
+                src_mask = self.remove_finished(cache, src_mask, randomSampling.select_indices)
+
+            dec_in = randomSampling.alive_seq[:, -1:]
+
+        seqs = [predictions[0] for predictions in randomSampling.predictions]
+        lengths = torch.tensor([s.size(0) for s in seqs], dtype=torch.long, device=device)
+        return pad_sequence(seqs, batch_first=True, padding_value=self.pad_index), lengths
+
+    def beam_search(self, enc_out, src_mask, tgt_lang, random=False, max_lengths=None):
+        """
+        Performs beam search on a batch of sequences
+        Adapted from _translate_batch in translator.py from onmt
+        :param max_lengths: max number of generated words of each sentence, max_length if None
+        :return: best hypothesis of each sentence, padded, shape = batch_size, max_length, and their lengths
+        """
+
+        batch_size = enc_out.size(0)
+        device = enc_out.device
 
         # if parallel, each BeamSearch object lives on the device of the input batch
         beamSearch = BeamSearch(self.beam_size, batch_size,
@@ -62,111 +280,101 @@ class MyBeamSearch(torch.nn.Module):
                                      block_ngram_repeat=0,
                                      exclusion_tokens=set(),
                                      memory_lengths=self.encoding_lengths,
-                                     stepwise_penalty=False, ratio=0.)
+                                     stepwise_penalty=False, ratio=0.,
+                                     max_lengths=max_lengths)
 
-        # disable gradient tracking
-        with torch.set_grad_enabled(False):
+        # (2) Repeat src objects `beam_size` times. along dim 0
+        # We use batch_size x beam_size, the beams of a sentence are contiguous, as BeamSearch expects
+        enc_out = tile(enc_out, self.beam_size, dim=0)
+        src_mask = tile(src_mask, self.beam_size, dim=0)
+        #print("enc out", enc_out[:, :, 0])
 
-            # (1) Run the encoder on the src.
-            enc_out = self.transformer.encode(batch,
-                                          src_mask=src_mask,
-                                          src_lang=src_lang,
-                                          n_samples=1,
-                                          return_kl=False)
+        # per layer keys / values of the words generated so far, and of enc_out
+        cache = self.transformer.decoder.init_cache()
 
-            #self.logger.info("enc_out batch size %i " % (enc_out.size(0)))
+        # only the last generated word is fed to the decoder, previous ones are in the cache
+        # in this first case it should be batch_size x beam_size, 1 since it's just the first word generated
+        dec_in = torch.ones(batch_size*self.beam_size, 1,
+                            dtype=torch.int64,
+                            device=device)*self.bos_index[tgt_lang]
 
-            # (2) Repeat src objects `beam_size` times. along dim 0
-            # We use batch_size x beam_size
-            enc_out = enc_out.repeat(self.beam_size, 1, 1)
-            src_mask = src_mask.repeat(self.beam_size, 1, 1, 1)
-            #print("enc out", enc_out[:, :, 0])
-
-            # dec_output should be batch_size x beam_size, dec_seq_len
-            # in this first case it should be batch_size x 1 x hidden_size since it's just the first word generated
-            dec_out = torch.ones(batch_size*self.beam_size, 1,
-                                 dtype=torch.int64,
-                                 device=batch.device)*self.bos_index[tgt_lang]
-
-            for step in range(self.max_length):
-
-                # decoder_input = self.beamSearch.current_predictions.view(-1, 1)
-                # print("decoder_input", decoder_input.shape)
-
-                # in case of inference tgt_len = 1, batch = beam times batch_size
-                log_probs = self.transformer.decode(dec_out, enc_out, src_mask,
-                                               tgt_mask=None, tgt_lang=tgt_lang)[:, -1, :]
-
-                log_probs = F.log_softmax(log_probs, dim=-1)
-                #print("log probs", log_probs.shape)
-
-                #advance takes input of size batch_size*beam_size x vocab_size
-                beamSearch.advance(log_probs, None)
-
-                # check if any beam is finished (last output selected was eos)
-                # note that this removes this node from select_indices
-                # also adds the sentence to list of hypetheses, so you don't need to deal with it anymore
-                any_beam_is_finished = beamSearch.is_finished.any()
-                if any_beam_is_finished:
-                    beamSearch.update_finished()
-                    if beamSearch.done:
-                        break
-
-                # get chosen words by beam search
-                next_word = beamSearch.current_predictions.unsqueeze_(-1)
-                #next_word = self.beamSearch.current_predictions.view(self.batch_size*self.beam_size, -1)
-
-                # get indices of expanded nodes, for each input sentence
-                select_indices = beamSearch.current_origin
-                #print("select_indices", select_indices)
-
-                # select previous output of expanded nodes
-                #self.logger.info("dec_out batch size %i" % (dec_out.size(0)))
-                dec_out = dec_out[select_indices]
-                enc_out = enc_out[select_indices]
-                src_mask = src_mask[select_indices]
-                # self.logger.info("select_indices %s" %(','.join(map(str, select_indices.data))))
-                # self.logger.info("dec_out batch size %i" % (dec_out.size(0)))
-                #print("dec_out", dec_out)
-
-                #dec out should be batch_size x (previous_sentence_len + 1) x hidden_size
-                dec_out = torch.cat((dec_out, next_word), 1)
-                #print("current predictions" + str(self.beamSearch.current_predictions))
-                #print("dec out", dec_out)
-
-        # (batch_size) list of (beam_size) lists of tuples
-        hypotheses = beamSearch.hypotheses
-        sentences, len = self.format_sentences(hypotheses=hypotheses,
-                                               tgt_lang=tgt_lang,
-                                               device=batch.device)
-        return sentences, len
+        for step in range(self.max_length):
+
+            # in case of inference tgt_len = 1, batch = beam times batch_size
+            # enc_out is only read at the first step, then its keys / values come from the cache
+            log_probs = self.transformer.decode(dec_in, enc_out, src_mask,
+                                           tgt_mask=None, tgt_lang=tgt_lang,
+                                           cache=cache, step=step)[:, -1, :]
+
+            log_probs = F.log_softmax(log_probs.float(), dim=-1)
+            #print("log probs", log_probs.shape)
+
+            #advance takes input of size batch_size*beam_size x vocab_size
+            beamSearch.advance(log_probs, None)
+
+            # check if any beam is finished (last output selected was eos)
+            # note that this removes this node from select_indices
+            # also adds the sentence to list of hypetheses, so you don't need to deal with it anymore
+            any_beam_is_finished = beamSearch.is_finished.any()
+            if any_beam_is_finished:
+                beamSearch.update_finished()
+                if beamSearch.done:
+                    break
 
-    def format_sentences(self, hypotheses, device, tgt_lang, random=False):
+            # get chosen words by beam search
+            dec_in = beamSearch.current_predictions.unsqueeze(-1)
+
+            # get indices of expanded nodes, for each input sentence
+            select_indices = beamSearch.current_origin
+
+            # the beams of a sentence share the source, its cached keys / values only change
+            # when finished sentences are removed from the batch
+            if select_indices.size(0) < src_mask.size(0):
+                src_mask = self.remove_finished(cache, src_mask, select_indices)
+
+            else:
+                self.transformer.decoder.reorder_cache(cache, select_indices, attn_types=("self",))
+
+        return self.select_hypotheses(beamSearch, random)
+
+    def select_hypotheses(self, beamSearch, random=False):
         """
 
-        :param hypotheses: list of lists
-        :param random:
-        :return:
+        :param beamSearch: finished BeamSearch, holds the best hypotheses of each sentence
+        :param random: pick a random hypothesis among the n_best of each sentence, instead of the best one
+        :return: hypothesis of each sentence, padded, shape = batch_size, max_length, and their lengths
         """
+        hyp_seqs = beamSearch.hyp_seqs
+        batch_size = hyp_seqs.size(0)
 
-        # get lengths of sentences
         if random:
-            indices = np.random.randint(low=0, high=self.beam_size, size=self.batch_size)
-            sentences = list(map(lambda beams: beams[indices[i]][1]) for i, beams in enumerate(hypotheses))
-            lengths = torch.cuda.LongTensor([s[indices[i]].shape[0] + 2 for i, s in enumerate(hypotheses)], device=device)
+            n_hyps = beamSearch.hyp_count.clamp(max=self.n_best)
+            index = (torch.rand(batch_size, device=hyp_seqs.device) * n_hyps.float()).long()
 
         else:
-            sentences = list(map(lambda beams: beams[-1][1], hypotheses))
-            lengths = torch.cuda.LongTensor([s.shape[0] + 2 for s in sentences], device=device)
+            index = torch.zeros(batch_size, dtype=torch.long, device=hyp_seqs.device)
+
+        batch_index = torch.arange(batch_size, device=hyp_seqs.device)
+        return hyp_seqs[batch_index, index], beamSearch.hyp_lengths[batch_index, index]
+
+    def format_sentences(self, seqs, lengths, tgt_lang):
+        """
+
+        :param seqs: generated words, padded, shape = batch_size, len
+        :param lengths: number of generated words of each sentence
+        :return: sentences with bos and eos, padded, shape = batch_size, max_len, and their lengths
+        """
+
+        # get lengths of sentences, with bos and eos
+        lengths = lengths + 2
 
-        # fill unused sentence spaces with pad token
-        sent = torch.cuda.LongTensor(lengths.size(0), lengths.max(), device=device).fill_(self.pad_index)
+        # leave room for bos at the start, and for eos at the end
+        sent = F.pad(seqs, (1, 1), value=self.pad_index)
+        sent = sent[:, :lengths.max().item()]
 
-        # copy sentence tokens, don't overwrite bos, add eos
-        for i, s in enumerate(sentences):
-            sent[i, 0] = self.bos_index[tgt_lang]
-            sent[i, 1:lengths[i] - 1].copy_(s)
-            sent[i, lengths[i] - 1] = self.eos_index
+        # add bos and eos
+        sent[:, 0] = self.bos_index[tgt_lang]
+        sent.scatter_(1, (lengths - 1).unsqueeze(1), self.eos_index)
 
         return sent, lengths
 
@@ -190,5 +398,6 @@ if __name__ == "__main__":
     beam = MyBeamSearch(transformer, beam_size=3, n_best=2,
                         encoding_lengths=512, max_length=40, logger=None)
 
-    sent, len = beam(x, src_m, src_lang=1, tgt_lang=1)
-    print(sent, len)
+    for decoding in DECODINGS:
+        sent, len = beam(x, src_m, src_lang=1, tgt_lang=1, decoding=decoding)
+        print(decoding, sent, len)
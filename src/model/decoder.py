@@ -17,17 +17,28 @@ class DecoderLayer(torch.nn.Module):
         self.layer_norm_3 = torch.nn.LayerNorm(normalized_shape=self.d_model)
         self.dropout = torch.nn.Dropout(params["dropout"])
 
-    def forward(self, prev_output, enc_output, src_mask, tgt_mask):
+    def forward(self, prev_output, enc_output, src_mask, tgt_mask, cache=None):
+        """
+
+        :param cache: in case of incremental decoding, dict with the "self" and "src" attention caches,
+                      prev_output then only holds the new positions
+        :return:
+        """
+        self_cache = None if cache is None else cache["self"]
+        src_cache = None if cache is None else cache["src"]
 
         out = self.layer_norm_1(self.dropout(self.masked_attn(x_q=prev_output,
                                                  x_k=prev_output,
                                                  x_v=prev_output,
-                                                 mask=tgt_mask)) + prev_output)
+                                                 mask=tgt_mask,
+                                                 cache=self_cache)) + prev_output)
 
         out = self.layer_norm_2(self.dropout(self.attn(x_q=out,
                                           x_k = enc_output,
                                           x_v = enc_output,
-                                          mask=src_mask)) + out)
+                                          mask=src_mask,
+                                          cache=src_cache,
+                                          static_kv=True)) + out)
 
         out = self.layer_norm_3(self.dropout(self.ffnn(out)) + out)
         return out
@@ -58,22 +69,59 @@ class StackedDecoder(torch.nn.Module):
         self.pos_enc = PositionalEncoding(params)
         self.decoder_layers = torch.nn.ModuleList([DecoderLayer(params) for _ in range(n_layers)])
 
-    def forward(self, prev_output, enc_output, src_mask, tgt_mask, lang_id):
+    def init_cache(self):
+        """
+        Returns an empty key / value cache for incremental decoding, with one entry per decoder layer
+        """
+        return [{"self": {}, "src": {}} for _ in self.decoder_layers]
+
+    @staticmethod
+    def reorder_cache(cache, indices, attn_types=("self", "src")):
+        """
+        Selects the cached keys / values of the paths kept by the decoding strategy
+        :param cache: cache returned by init_cache
+        :param indices: LongTensor of indices along the batch dim, e.g. select_indices of beam search
+        :param attn_types: caches to reorder, the "src" keys / values only change when sentences are removed
+        """
+        for layer_cache in cache:
+            for attn_type in attn_types:
+                attn_cache = layer_cache[attn_type]
+                for k, v in attn_cache.items():
+                    attn_cache[k] = v.index_select(0, indices)
+
+    @staticmethod
+    def trim_src_cache(cache, src_len):
+        """
+        Drops the cached keys / values of the source positions after src_len, padding of every sentence left
+        :param cache: cache returned by init_cache
+        :param src_len: length of the longest source sentence left
+        """
+        for layer_cache in cache:
+            attn_cache = layer_cache["src"]
+            for k, v in attn_cache.items():
+                attn_cache[k] = v[:, :, :src_len]
+
+    def forward(self, prev_output, enc_output, src_mask, tgt_mask, lang_id, cache=None, step=0):
         """
 
         :param dec_outputs: in case of inference: words generated so far
                             in case of training: target sentence
         :param enc_outputs: latent vectors generated by encoder
         :param mask:
+        :param cache: cache returned by init_cache, for incremental decoding,
+                      in which case prev_output only holds the words generated at this step
+        :param step: position of the first word of prev_output
         :return:
         """
         prev_output = self.emb_scale * self.embedding_layers[lang_id](prev_output)
-        prev_output = self.pos_enc(prev_output)
-        for layer in self.decoder_layers:
+        prev_output = self.pos_enc(prev_output, start=step)
+        layer_caches = cache if cache is not None else [None] * len(self.decoder_layers)
+        for layer, layer_cache in zip(self.decoder_layers, layer_caches):
             dec_outputs = layer(prev_output=prev_output,
                                 enc_output=enc_output,
                                 src_mask = src_mask,
-                                tgt_mask = tgt_mask)
+                                tgt_mask = tgt_mask,
+                                cache=layer_cache)
 
         return dec_outputs
 
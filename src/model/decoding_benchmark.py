@@ -0,0 +1,85 @@
+"""
+Benchmark of the back-translation decoding, in sentences / sec, for each decoding strategy and batch size.
+
+usage: python -m src.model.decoding_benchmark [N_BATCHES]
+"""
+import sys
+import time
+from src.model.beam_search_wrapper import *
+
+
+def random_batch(transformer, batch_size, max_len, device):
+    """
+    :return: batch of random sentences of random lengths, with bos and eos, and their source mask
+    """
+    vocab_size = transformer.vocab_size[0]
+    lengths = torch.randint(3, max_len + 1, (batch_size,), device=device)
+    positions = torch.arange(max_len, device=device)
+    x = torch.randint(6, vocab_size, (batch_size, max_len), device=device)
+    x[:, 0] = transformer.bos_index[0]
+    x.masked_fill_(positions >= lengths.unsqueeze(1), transformer.pad_index)
+    x.scatter_(1, (lengths - 1).unsqueeze(1), transformer.eos_index)
+    src_mask = (x != transformer.pad_index).unsqueeze(1).unsqueeze(1)
+    return x, src_mask
+
+
+def time_decoding(beam, batches, decoding):
+    """
+    :return: number of sentences decoded per second
+    """
+    n_sentences = 0
+    start = time.perf_counter()
+    for x, src_mask in batches:
+        beam(x, src_mask, src_lang=0, tgt_lang=1, decoding=decoding)
+        n_sentences += x.size(0)
+
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return n_sentences / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+
+    n_batches = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+
+    transformer = Transformer(data_params=None, logger=getLogger(), is_variational=False).to(device).eval()
+
+    # an untrained model rarely generates eos, make sentences finish at various steps
+    with torch.no_grad():
+        transformer.linear_layers[1].bias[transformer.eos_index] += 4
+
+    beam = MyBeamSearch(transformer, beam_size=4, n_best=1, encoding_lengths=512, max_length=50, logger=getLogger())
+    bucketed_beam = MyBeamSearch(transformer, beam_size=4, n_best=1, encoding_lengths=512, max_length=50,
+                                 logger=getLogger(), bucket_size=32)
+    length_beam = MyBeamSearch(transformer, beam_size=4, n_best=1, encoding_lengths=512, max_length=50,
+                               logger=getLogger(), max_len_a=1.2, max_len_b=5)
+
+    # removing finished sentences and padding columns must not change the generated sentences
+    x, src_mask = random_batch(transformer, 8, 20, device)
+    for decoding in ['greedy', 'beam']:
+        sent, len = beam(x, src_mask, src_lang=0, tgt_lang=1, decoding=decoding)
+        for i in range(x.size(0)):
+            src_len = src_mask[i].sum().item()
+            sent_i, len_i = beam(x[i:i + 1, :src_len], src_mask[i:i + 1, ..., :src_len],
+                                 src_lang=0, tgt_lang=1, decoding=decoding)
+            assert len_i[0] == len[i]
+            assert (sent_i[0] == sent[i, :sent_i.size(1)]).all()
+        print("%s: batched decoding matches sentence by sentence decoding" % decoding)
+
+    for batch_size in [16, 64, 256]:
+        batches = [random_batch(transformer, batch_size, 50, device) for _ in range(n_batches)]
+        for decoding in DECODINGS:
+            print("batch_size %i %s: %.1f sentences/sec, bucketed %.1f sentences/sec, "
+                  "source length max lengths %.1f sentences/sec" %
+                  (batch_size, decoding, time_decoding(beam, batches, decoding),
+                   time_decoding(bucketed_beam, batches, decoding), time_decoding(length_beam, batches, decoding)))
+
+    # no sentence is longer than its max length
+    x, src_mask = random_batch(transformer, 64, 20, device)
+    max_lengths = length_beam.get_max_lengths(src_mask)
+    for decoding in DECODINGS:
+        sent, len = length_beam(x, src_mask, src_lang=0, tgt_lang=1, decoding=decoding)
+        assert (len - 2 <= max_lengths).all(), decoding
+    print("source length max lengths ok")
@@ -0,0 +1,76 @@
+import torch
+
+
+class Masks(object):
+    """
+    Builds attention masks on the device of the batches, True where attention is allowed.
+
+    The causal mask is allocated once per device, for sentences up to max_len,
+    and the masks of a batch are broadcast views of it and of the padding mask,
+    so building them never requires a host to device copy.
+    """
+
+    def __init__(self, pad_index, max_len=175):
+        self.pad_index = pad_index
+        self.max_len = max_len
+        self.causal_masks = {}
+
+    def get_causal_mask(self, sent_len, device):
+        """
+        :return: BoolTensor of shape (1, 1, sent_len, sent_len), hides future words
+        """
+        device = torch.device(device)
+        causal_mask = self.causal_masks.get(device, None)
+
+        # longer sentences than max_len grow the cached mask
+        if causal_mask is None or causal_mask.size(0) < sent_len:
+            size = max(sent_len, self.max_len)
+            causal_mask = torch.ones(size, size, dtype=torch.bool, device=device).tril_()
+            self.causal_masks[device] = causal_mask
+
+        return causal_mask[:sent_len, :sent_len].unsqueeze(0).unsqueeze(0)
+
+    def get_src_mask(self, src_batch):
+        """
+        :param src_batch: shape = batch_size, sent_len
+        :return: BoolTensor of shape (batch_size, 1, 1, sent_len), hides padding
+        """
+        return (src_batch != self.pad_index).unsqueeze(1).unsqueeze(1)
+
+    def get_tgt_mask(self, tgt_batch):
+        """
+        Padding only comes after the eos token, so hiding future words also hides
+        padding from every word of the sentence. Padding positions still attend to the
+        sentence, their outputs are not used by the loss.
+
+        :param tgt_batch: input to the decoder, shape = batch_size, sent_len
+        :return: BoolTensor of shape (batch_size, 1, sent_len, sent_len), an expanded view
+                 of the causal mask, so it can still be scattered along the batch by DataParallel
+        """
+        batch_size, sent_len = tgt_batch.shape
+        return self.get_causal_mask(sent_len, tgt_batch.device).expand(batch_size, -1, -1, -1)
+
+
+if __name__ == "__main__":
+
+    # compare with the former per batch numpy masks, on non padding positions
+    import numpy as np
+    pad_index = 2
+    masks = Masks(pad_index, max_len=8)
+    tgt_batch = torch.tensor([[0, 5, 6, 1, 2, 2], [0, 5, 6, 7, 8, 1]])
+
+    tgt_m = torch.from_numpy(np.tril(np.ones((2, 6, 6)), k=0).astype(np.uint8))
+    tgt_m.masked_fill_(tgt_batch.unsqueeze(-1) == pad_index, 0).unsqueeze_(1)
+    not_pad = (tgt_batch != pad_index).unsqueeze(1).unsqueeze(-1)
+
+    tgt_mask = masks.get_tgt_mask(tgt_batch)
+    assert tgt_mask.shape == (2, 1, 6, 6)
+    assert ((tgt_mask & not_pad) == tgt_m.bool()).all()
+
+    src_m = torch.ones_like(tgt_batch)
+    src_m.masked_fill_(tgt_batch == pad_index, 0).unsqueeze_(-2).unsqueeze_(-2)
+    assert (masks.get_src_mask(tgt_batch) == src_m.bool()).all()
+
+    # longer sentences than max_len
+    assert masks.get_tgt_mask(torch.zeros(2, 10, dtype=torch.long)).shape == (2, 1, 10, 10)
+    print("masks ok")
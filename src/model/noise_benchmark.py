@@ -0,0 +1,278 @@
+"""
+Benchmark of the batched noise model against the former per-sentence implementation.
+
+usage: python -m src.model.noise_benchmark [N_BATCHES]
+"""
+import sys
+import time
+from argparse import Namespace
+from src.model.noise_model import *
+from src.data.dictionary import SPECIAL_WORD, SPECIAL_WORDS
+
+
+class LoopNoiseModel(NoiseModel):
+    """
+    Former noise model, loops over the sentences of the batch on the CPU.
+    It draws from the numpy random state, the generator of the batched noise model is ignored.
+    """
+
+    def init_bpe(self):
+        super(LoopNoiseModel, self).init_bpe()
+        self.bpe_end = [bpe_end.numpy() for bpe_end in self.bpe_end]
+
+    def word_shuffle(self, x, l, lang_id, generator=None):
+        """
+        verified
+        :param x: batch of sentences shape (batch_size, max_len), containing indices of bpe tokens
+        :param l: vector of length for eah sentence
+        :param lang_id: language of input sentence batch
+        :return:
+        """
+        if self.params.word_shuffle== 0:
+            return x, l
+
+        # define noise word scores
+        # use x.size(0) - 1 to avoid eos
+        noise = np.random.uniform(0, self.params.word_shuffle, size=(x.size(0), x.size(1)-1))
+        noise[:, 0] = -1  # do not move start sentence symbol
+
+        # be sure to shuffle entire words
+        # get the bpe_end boolean indiators from indices in batch x
+        bpe_end = self.bpe_end[lang_id][x]
+
+        # count the number of non-end of words,
+        # the number in each cell indicates the word (order) index that this token belongs to
+        word_idx = bpe_end[:, ::-1].cumsum(1)[:, ::-1]
+        word_idx = word_idx.max(1)[:, None] - word_idx
+
+        assert self.params.word_shuffle > 1
+        x2 = x.clone()
+
+        # for each sentence i in the batch
+        for i in range(l.size(0)):
+            # generate a random permutation
+
+            # for each element of word_idx for sent i, add noise
+            # noise is indexed using word_idx so tokens from the same word get the same score
+            scores = word_idx[i, :l[i] - 1] + noise[i, word_idx[i, :l[i] - 1]]
+            scores += 1e-6 * np.arange(l[i] - 1)
+
+            # sort the scores, get indices from sorted array
+            # since word_idx assigns the same int to tokens of the same word
+            # tokens from the same word remain contiguous
+            permutation = scores.argsort()
+
+            # get sentence tokens (except bos and eos and padding)
+            # use indies from permutation to shuffle the words
+            x2[i, :l[i] - 1].copy_(x2[i, :l[i] - 1][torch.from_numpy(permutation)])
+
+        return x2, l
+
+    def word_dropout(self, x, l, lang_id, generator=None):
+        """
+        verified
+        :param x: batch of sentences shape (batch_size, max_len), containing indices of bpe tokens
+        :param l: vector of length for each sentence
+        :param lang_id:
+        :return:
+        """
+        if self.params.word_dropout == 0:
+            return x, l
+        assert 0 < self.params.word_dropout < 1
+
+        assert (x[0, 0] == self.params.bos_index[lang_id])
+        assert (x[:, 0] == self.params.bos_index[lang_id]).sum() == l.size(0)
+
+        # get boolean array for words to keep, with prob (1 - word_dropout)
+        keep = np.random.rand(x.size(0), x.size(1) - 1) >= self.params.word_dropout
+        keep[:, 0] = 1  # do not drop the start sentence symbol
+
+        # index tokens based on which word they belong to
+        bpe_end = self.bpe_end[lang_id][x]
+        word_idx = bpe_end[:, ::-1].cumsum(1)[:, ::-1]
+        word_idx = word_idx.max(1)[:, None] - word_idx
+
+        sentences = []
+        lengths = []
+        # for each sentence in the batch
+        # here "words" refers to bpe tokens
+        for i in range(l.size(0)):
+            assert x[i, l[i] - 1] == self.params.eos_index
+            words = x[i, :l[i] - 1].tolist()
+
+            # randomly drop words from the input
+            # use word_idx to index keep, to drop entire words
+            new_s = [w for j, w in enumerate(words) if keep[i, word_idx[i, j]]]
+
+            # we need to have at least one word in the sentence (more than the start / end sentence symbols)
+            if len(new_s) == 1:
+                # this is fine, since tokens of the same word have the same number in word_idx
+                new_s.append(words[np.random.randint(1, len(words))])
+
+            new_s.append(self.params.eos_index)
+            assert len(new_s) >= 3 and new_s[0] == self.params.bos_index[lang_id] and new_s[-1] == self.params.eos_index
+            sentences.append(new_s)
+            lengths.append(len(new_s))
+
+        # re-construct input
+        l2 = torch.LongTensor(lengths)
+        x2 = torch.LongTensor(l2.size(0), l2.max()).fill_(self.params.pad_index)
+
+        for i in range(l2.size(0)):
+            x2[i, :l2[i]].copy_(torch.LongTensor(sentences[i]))
+        return x2, l2
+
+    def word_blank(self, x, l, lang_id, generator=None):
+        """
+        Randomly blank input words.
+        """
+        if self.params.word_blank == 0:
+            return x, l
+        assert 0 < self.params.word_blank < 1
+
+        # define words to blank
+        bos_index = self.params.bos_index[lang_id]
+        assert (x[:, 0] == bos_index).sum() == l.size(0)
+        keep = np.random.rand(x.size(0), x.size(1) - 1) >= self.params.word_blank
+        keep[:, 0] = 1  # do not blank the start sentence symbol
+
+        # be sure to blank entire words
+        bpe_end = self.bpe_end[lang_id][x]
+        word_idx = bpe_end[:, ::-1].cumsum(1)[:, ::-1]
+        word_idx = word_idx.max(1)[:, None] - word_idx
+
+        sentences = []
+        for i in range(l.size(0)):
+            assert x[i, l[i] - 1] == self.params.eos_index
+            words = x[i, :l[i] - 1].tolist()
+            # randomly blank words from the input
+            new_s = [w if keep[i, word_idx[i, j]] else self.params.blank_index for j, w in enumerate(words)]
+            new_s.append(self.params.eos_index)
+            assert len(new_s) == l[i] and new_s[0] == bos_index and new_s[-1] == self.params.eos_index
+            sentences.append(new_s)
+
+        # re-construct input
+        x2 = torch.LongTensor(l.size(0), l.max()).fill_(self.params.pad_index)
+        for i in range(l.size(0)):
+            x2[i, :l[i]].copy_(torch.LongTensor(sentences[i]))
+        return x2, l
+
+def build_noise_params(vocab_size, bpe_rate):
+    """
+    Build a synthetic dictionary where a fraction bpe_rate of the tokens are BPE continuations
+    """
+    word2id = {BOS_WORD: 0, EOS_WORD: 1, PAD_WORD: 2, UNK_WORD: 3}
+    for i in range(SPECIAL_WORDS):
+        word2id[SPECIAL_WORD % i] = 4 + i
+    n_special = len(word2id)
+    for i in range(vocab_size - n_special):
+        word2id['w%i' % i + ('@@' if np.random.rand() < bpe_rate else '')] = n_special + i
+    id2word = {v: k for k, v in word2id.items()}
+    dico = Dictionary(id2word, word2id)
+
+    params = Namespace(word_shuffle=3, word_dropout=0.1, word_blank=0.2,
+                       bos_index=[dico.index(SPECIAL_WORD % 0)], eos_index=dico.eos_index,
+                       pad_index=dico.pad_index, blank_index=dico.index(SPECIAL_WORD % 1))
+    return {'dico': {'en': dico}}, params
+
+
+def random_batch(params, batch_size, vocab_size, max_len, device):
+    """
+    Random batch of sentences, shape (batch_size, max_len)
+    """
+    lengths = torch.randint(3, max_len + 1, (batch_size,))
+    lengths[0] = max_len
+    x = torch.randint(4 + SPECIAL_WORDS, vocab_size, (batch_size, max_len))
+    x[:, 0] = params.bos_index[0]
+    x[torch.arange(max_len)[None] >= lengths[:, None]] = params.pad_index
+    x[torch.arange(batch_size), lengths - 1] = params.eos_index
+    return x.to(device), lengths.to(device)
+
+
+def distinct_batch(params, batch_size, vocab_size, max_len):
+    """
+    Random batch of sentences where token j of sentence i is n_special + (start[i] + j) % n_words,
+    so the tokens of a sentence are distinct and their original position can be recovered
+    :return: batch, lengths, start of each sentence
+    """
+    x, l = random_batch(params, batch_size, vocab_size, max_len, 'cpu')
+    n_special = 4 + SPECIAL_WORDS
+    start = torch.randint(0, vocab_size - n_special, (batch_size,))
+    is_token = (torch.arange(max_len)[None] >= 1) & (torch.arange(max_len)[None] < l[:, None] - 1)
+    tokens = n_special + (start[:, None] + torch.arange(max_len)[None]) % (vocab_size - n_special)
+    return torch.where(is_token, tokens, x), l, start
+
+
+def noise_statistics(model, bpe_end, vocab_size, x, l, start):
+    """
+    :return: fraction of the tokens kept by word_dropout, fraction of the tokens blanked by word_blank,
+             mean displacement of the tokens moved by word_shuffle, and fraction of the BPE pieces
+             followed by the next piece of their word after word_shuffle
+    """
+    n_tokens = (l - 2).sum().double()
+    _, l2 = model.word_dropout(x, l, 0)
+    x3, _ = model.word_blank(x, l, 0)
+    keep_rate = (l2 - 2).sum().double() / n_tokens
+    blank_rate = (x3 == model.params.blank_index).sum().double() / n_tokens
+
+    # original position of each token of the shuffled sentences
+    x4, _ = model.word_shuffle(x, l, 0)
+    n_special = 4 + SPECIAL_WORDS
+    positions = torch.arange(x.size(1))[None]
+    is_token = (positions >= 1) & (positions < l[:, None] - 1)
+    original = (x4 - n_special - start[:, None]) % (vocab_size - n_special)
+    displacement = (original - positions).abs()[is_token].double().mean()
+
+    # pieces of a word, except the last token of the sentence, must be followed by the next piece
+    is_piece = is_token & ~bpe_end[x4] & (original < l[:, None] - 2)
+    followed = original[:, 1:] == original[:, :-1] + 1
+    piece_rate = followed[is_piece[:, :-1]].double().mean()
+
+    return keep_rate.item(), blank_rate.item(), displacement.item(), piece_rate.item()
+
+
+def time_noise(model, batches):
+    start = time.time()
+    for x, l in batches:
+        model.add_noise(x, l, 0)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start) / len(batches)
+
+
+if __name__ == '__main__':
+
+    n_batches = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    vocab_size = 30000
+    data, params = build_noise_params(vocab_size, bpe_rate=0.3)
+    loop_model = LoopNoiseModel(data, params)
+    batched_model = NoiseModel(data, params)
+
+    # both implementations draw the noise from the same distributions
+    x, l, start = distinct_batch(params, 2000, vocab_size, 50)
+    bpe_end = batched_model.bpe_end[0]
+    loop_stats = noise_statistics(loop_model, bpe_end, vocab_size, x, l, start)
+    batched_stats = noise_statistics(batched_model, bpe_end, vocab_size, x, l, start)
+    for name, stats in [('loop', loop_stats), ('batched', batched_stats)]:
+        print("%s: %.4f kept by dropout, %.4f blanked, mean shuffle displacement %.3f, "
+              "%.4f BPE pieces stay with their word" % ((name,) + stats))
+
+    (loop_keep, loop_blank, loop_displacement, loop_piece), (keep, blank, displacement, piece) = \
+        loop_stats, batched_stats
+    # words are dropped / blanked as a whole, the rates are close to the word rates
+    assert abs(keep - loop_keep) < 0.01 and abs(keep - (1 - params.word_dropout)) < 0.02
+    assert abs(blank - loop_blank) < 0.01 and abs(blank - params.word_blank) < 0.02
+    assert abs(displacement - loop_displacement) < 0.05 * loop_displacement
+    assert piece == loop_piece == 1
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    for batch_size in [32, 64, 128]:
+        for max_len in [50, 175]:
+            batches = [random_batch(params, batch_size, vocab_size, max_len, 'cpu') for _ in range(n_batches)]
+            loop_time = time_noise(loop_model, batches)
+            for device in devices:
+                device_batches = [(x.to(device), l.to(device)) for x, l in batches]
+                batched_time = time_noise(batched_model, device_batches)
+                print("batch_size %i max_len %i: loop %.2fms, batched (%s) %.2fms, speedup %.1fx" %
+                      (batch_size, max_len, loop_time * 1000, device, batched_time * 1000,
+                       loop_time / batched_time))
@@ -29,11 +29,40 @@ class NoiseModel():
 
             # for each token in the dictionary, indicate if it does not end with @@
             # indicate which tokens are at the end of a word
-            self.bpe_end.append(np.array([not dico[i].endswith('@@') for i in range(len(dico))]))
+            self.bpe_end.append(torch.tensor([not dico[i].endswith('@@') for i in range(len(dico))], dtype=torch.bool))
+
+        # copies of bpe_end on the devices of the noised batches
+        self.bpe_end_devices = {}
 
         # print("bpe_end is " + str(self.bpe_end))
 
-    def word_shuffle(self, x, l, lang_id):
+    def get_word_idx(self, x, lang_id):
+        """
+        Index tokens based on which word they belong to
+        :param x: batch of sentences shape (batch_size, max_len)
+        :return: LongTensor of the shape of x, tokens from the same word get the same number,
+                 which is the word (order) index in the sentence
+        """
+        key = (lang_id, x.device)
+        if key not in self.bpe_end_devices:
+            self.bpe_end_devices[key] = self.bpe_end[lang_id].to(x.device)
+
+        # get the bpe_end boolean indiators from indices in batch x
+        bpe_end = self.bpe_end_devices[key][x].long()
+
+        # count the number of end of words on the right of each token
+        word_idx = bpe_end.flip(1).cumsum(1).flip(1)
+        return word_idx.max(1, keepdim=True)[0] - word_idx
+
+    def get_sentence_mask(self, x, l):
+        """
+        :return: BoolTensor of shape (batch_size, max_len - 1), True for the bos and tokens of each sentence,
+                 False for eos and padding
+        """
+        positions = torch.arange(x.size(1) - 1, device=x.device)
+        return positions.unsqueeze(0) < (l.to(x.device) - 1).unsqueeze(1)
+
+    def word_shuffle(self, x, l, lang_id, generator=None):
         """
         verified
         :param x: batch of sentences shape (batch_size, max_len), containing indices of bpe tokens
@@ -44,48 +73,39 @@ class NoiseModel():
         if self.params.word_shuffle== 0:
             return x, l
 
+        assert self.params.word_shuffle > 1
+        bs, slen = x.size()
+
         # define noise word scores
-        # use x.size(0) - 1 to avoid eos
-        noise = np.random.uniform(0, self.params.word_shuffle, size=(x.size(0), x.size(1)-1))
+        # use x.size(1) - 1 to avoid eos
+        noise = torch.rand(bs, slen - 1, dtype=torch.float64, device=x.device, generator=generator) * self.params.word_shuffle
         noise[:, 0] = -1  # do not move start sentence symbol
 
         # be sure to shuffle entire words
-        # get the bpe_end boolean indiators from indices in batch x
-        bpe_end = self.bpe_end[lang_id][x]
+        # word indices of bos and sentence tokens are at most slen - 2, clamp the ones of eos and padding
+        word_idx = self.get_word_idx(x, lang_id)[:, :slen - 1].clamp(max=slen - 2)
+        in_sent = self.get_sentence_mask(x, l)
 
-        # count the number of non-end of words,
-        # the number in each cell indicates the word (order) index that this token belongs to
-        word_idx = bpe_end[:, ::-1].cumsum(1)[:, ::-1]
-        # print("word_idx is ")
-        # print(word_idx)
-        word_idx = word_idx.max(1)[:, None] - word_idx
-        # print("word_idx is ")
-        # print(word_idx)
-
-        assert self.params.word_shuffle > 1
-        x2 = x.clone()#
+        # for each element of word_idx, add noise
+        # noise is indexed using word_idx so tokens from the same word get the same score
+        positions = torch.arange(slen - 1, dtype=torch.float64, device=x.device)
+        scores = word_idx.double() + noise.gather(1, word_idx) + 1e-6 * positions
 
-        # for each sentence i in the batch
-        for i in range(l.size(0)):
-            # generate a random permutation
+        # eos and padding are sorted after the sentence tokens, and keep their order
+        scores = torch.where(in_sent, scores, slen + self.params.word_shuffle + 1 + positions)
 
-            # for each element of word_idx for sent i, add noise
-            # noise is indexed using word_idx so tokens from the same word get the same score
-            scores = word_idx[i, :l[i] - 1] + noise[i, word_idx[i, :l[i] - 1]]
-            scores += 1e-6 * np.arange(l[i] - 1)
+        # sort the scores, get indices from sorted array
+        # since word_idx assigns the same int to tokens of the same word
+        # tokens from the same word remain contiguous
+        permutation = scores.argsort(1)
 
-            # sort the scores, get indices from sorted array
-            # since word_idx assigns the same int to tokens of the same word
-            # tokens from the same word remain contiguous
-            permutation = scores.argsort()
-
-            # get sentence tokens (except bos and eos and padding)
-            # use indies from permutation to shuffle the words
-            x2[i, :l[i] - 1].copy_(x2[i, :l[i] - 1][torch.from_numpy(permutation)])
+        # use indices from permutation to shuffle the words of each sentence
+        x2 = x.clone()
+        x2[:, :slen - 1] = x[:, :slen - 1].gather(1, permutation)
 
         return x2, l
 
-    def word_dropout(self, x, l, lang_id):
+    def word_dropout(self, x, l, lang_id, generator=None):
         """
         verified
         :param x: batch of sentences shape (batch_size, max_len), containing indices of bpe tokens
@@ -97,49 +117,40 @@ class NoiseModel():
             return x, l
         assert 0 < self.params.word_dropout < 1
 
-        assert (x[0, 0] == self.params.bos_index[lang_id])
         assert (x[:, 0] == self.params.bos_index[lang_id]).sum() == l.size(0)
+        bs, slen = x.size()
+        lengths = l.to(x.device)
+        assert (x.gather(1, (lengths - 1).unsqueeze(1)) == self.params.eos_index).all()
 
         # get boolean array for words to keep, with prob (1 - word_dropout)
-        keep = np.random.rand(x.size(0), x.size(1) - 1) >= self.params.word_dropout
+        keep = torch.rand(bs, slen - 1, device=x.device, generator=generator) >= self.params.word_dropout
         keep[:, 0] = 1  # do not drop the start sentence symbol
 
-        # index tokens based on which word they belong to
-        bpe_end = self.bpe_end[lang_id][x]
-        word_idx = bpe_end[:, ::-1].cumsum(1)[:, ::-1]
-        word_idx = word_idx.max(1)[:, None] - word_idx
-
-        sentences = []
-        lengths = []
-        # for each sentence in the batch
+        # use word_idx to index keep, to drop entire words
         # here "words" refers to bpe tokens
-        for i in range(l.size(0)):
-            assert x[i, l[i] - 1] == self.params.eos_index
-            words = x[i, :l[i] - 1].tolist()
+        word_idx = self.get_word_idx(x, lang_id)[:, :slen - 1].clamp(max=slen - 2)
+        keep = keep.gather(1, word_idx) & self.get_sentence_mask(x, l)
 
-            # randomly drop words from the input
-            # use word_idx to index keep, to drop entire words
-            new_s = [w for j, w in enumerate(words) if keep[i, word_idx[i, j]]]
+        # we need to have at least one word in the sentence (more than the start / end sentence symbols)
+        # keep a random token, this is fine, since tokens of the same word have the same number in word_idx
+        only_bos = keep.sum(1) == 1
+        random_pos = 1 + (torch.rand(bs, device=x.device, generator=generator) * (lengths - 2).double()).long()
+        positions = torch.arange(slen - 1, device=x.device)
+        keep |= only_bos.unsqueeze(1) & (positions.unsqueeze(0) == random_pos.unsqueeze(1))
 
-            # we need to have at least one word in the sentence (more than the start / end sentence symbols)
-            if len(new_s) == 1:
-                # this is fine, since tokens of the same word have the same number in word_idx
-                new_s.append(words[np.random.randint(1, len(words))])
+        # new length, with eos
+        l2 = keep.sum(1) + 1
 
-            new_s.append(self.params.eos_index)
-            assert len(new_s) >= 3 and new_s[0] == self.params.bos_index[lang_id] and new_s[-1] == self.params.eos_index
-            sentences.append(new_s)
-            lengths.append(len(new_s))
-
-        # re-construct input
-        l2 = torch.LongTensor(lengths)
-        x2 = torch.LongTensor(l2.size(0), l2.max()).fill_(self.params.pad_index)
+        # re-construct input, kept tokens are moved to the left, dropped ones to an extra column
+        dest = torch.where(keep, keep.long().cumsum(1) - 1, torch.full_like(positions, slen).expand(bs, -1))
+        x2 = x.new_full((bs, slen + 1), self.params.pad_index)
+        x2.scatter_(1, dest, x[:, :slen - 1])
+        x2.scatter_(1, (l2 - 1).unsqueeze(1), self.params.eos_index)
+        x2 = x2[:, :l2.max().item()]
 
-        for i in range(l2.size(0)):
-            x2[i, :l2[i]].copy_(torch.LongTensor(sentences[i]))
-        return x2, l2
+        return x2, l2.to(l.device)
 
-    def word_blank(self, x, l, lang_id):
+    def word_blank(self, x, l, lang_id, generator=None):
         """
         Randomly blank input words.
         """
@@ -150,37 +161,27 @@ class NoiseModel():
         # define words to blank
         bos_index = self.params.bos_index[lang_id]
         assert (x[:, 0] == bos_index).sum() == l.size(0)
-        keep = np.random.rand(x.size(0), x.size(1) - 1) >= self.params.word_blank
+        bs, slen = x.size()
+        keep = torch.rand(bs, slen - 1, device=x.device, generator=generator) >= self.params.word_blank
         keep[:, 0] = 1  # do not blank the start sentence symbol
 
-        # be sure to blank entire words
-        bpe_end = self.bpe_end[lang_id][x]
-        word_idx = bpe_end[:, ::-1].cumsum(1)[:, ::-1]
-        word_idx = word_idx.max(1)[:, None] - word_idx
-
-        sentences = []
-        for i in range(l.size(0)):
-            assert x[i, l[i] - 1] == self.params.eos_index
-            words = x[i, :l[i] - 1].tolist()
-            # randomly blank words from the input
-            new_s = [w if keep[i, word_idx[i, j]] else self.params.blank_index for j, w in enumerate(words)]
-            new_s.append(self.params.eos_index)
-            assert len(new_s) == l[i] and new_s[0] == bos_index and new_s[-1] == self.params.eos_index
-            sentences.append(new_s)
+        # be sure to blank entire words, eos and padding are never blanked
+        word_idx = self.get_word_idx(x, lang_id)[:, :slen - 1].clamp(max=slen - 2)
+        keep = keep.gather(1, word_idx) | ~self.get_sentence_mask(x, l)
 
         # re-construct input
-        x2 = torch.LongTensor(l.size(0), l.max()).fill_(self.params.pad_index)
-        for i in range(l.size(0)):
-            x2[i, :l[i]].copy_(torch.LongTensor(sentences[i]))
+        x2 = x.clone()
+        x2[:, :slen - 1].masked_fill_(~keep, self.params.blank_index)
         return x2, l
 
-    def add_noise(self, words, lengths, lang_id):
+    def add_noise(self, words, lengths, lang_id, generator=None):
         """
         Add noise to the encoder input.
+        :param generator: optional torch.Generator on the device of words, to draw the noise from
         """
-        words, lengths = self.word_shuffle(words, lengths, lang_id)
-        words, lengths = self.word_dropout(words, lengths, lang_id)
-        words, lengths = self.word_blank(words, lengths, lang_id)
+        words, lengths = self.word_shuffle(words, lengths, lang_id, generator)
+        words, lengths = self.word_dropout(words, lengths, lang_id, generator)
+        words, lengths = self.word_blank(words, lengths, lang_id, generator)
         return words, lengths
 
     def test_noise(self, lang):
@@ -190,7 +191,6 @@ class NoiseModel():
 
         lang_id = self.params.lang2id[lang]
         sent1, len1 = self.get_batch('encdec', lang, None)
-        sent1 = sent1.transpose_(0, 1)
         print(sent1.shape)
         print("sent1 before noise is ")
         print(sent1)
@@ -1,3 +1,4 @@
+import math
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -26,15 +27,16 @@ class PositionalEncoding(torch.nn.Module):
         self.register_buffer('pe', torch.Tensor(self.pos_enc))
         self.dropout = torch.nn.Dropout(params["dropout"])
 
-    def forward(self, x):
+    def forward(self, x, start=0):
         """
 
         :param x: input sequence of embeddings of shape (batch_size, seq_len, d_model)
+        :param start: position of the first element of x, used for incremental decoding
         :return:
         """
         len = x.shape[1]
         batch_size = x.shape[0]
-        t = self.pe[0:len, :]
+        t = self.pe[start:start + len, :]
         return self.dropout(x + t)
 
     def visualize(self):
@@ -42,6 +44,17 @@ class PositionalEncoding(torch.nn.Module):
         plt.matshow(self.pos_enc)
         plt.show()
 
+def sample_diagonal_gaussian(mean, var, n_samples):
+    """
+    samples a gaussian of diagonal covariance with the reparameterization trick,
+    the gradient is propagated to mean and var
+    :param mean: shape = *, dim
+    :param var: diagonal of the covariance, same shape as mean
+    :return: shape = n_samples, *, dim
+    """
+    eps = torch.randn((n_samples,) + mean.shape, dtype=mean.dtype, device=mean.device)
+    return mean + var.sqrt() * eps
+
 class FFNN(torch.nn.Module):
 
     def __init__(self, params):
@@ -62,49 +75,108 @@ class SelfAttention(torch.nn.Module):
         self.d_model = params["d_model"]
         self.d_k = params["d_k"]
         self.heads = params["h"]
+        self.scale = 1 / math.sqrt(self.d_k)
 
-        # compute queries, keys and values for all attention heads in parallel
-        self.W_q = torch.nn.Linear(self.d_model, self.d_model, bias=False)
-        self.W_k = torch.nn.Linear(self.d_model, self.d_model, bias=False)
-        self.W_v = torch.nn.Linear(self.d_model, self.d_model, bias=False)
+        # fused scaled dot product attention kernel, when this version of torch has it
+        self.use_sdpa = params.get("use_sdpa", True) and hasattr(F, "scaled_dot_product_attention")
+
+        # compute queries, keys and values for all attention heads in parallel,
+        # with a single projection, stacked in the order q, k, v
+        self.W_qkv = torch.nn.Parameter(torch.empty(3 * self.d_model, self.d_model))
         self.W_o = torch.nn.Linear(self.d_model, self.d_model, bias=False)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same initialization as separate q, k, v linear layers
+        for W in self.W_qkv.data.chunk(3, dim=0):
+            torch.nn.init.xavier_uniform_(W)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the fused projection have separate W_q, W_k, W_v layers
+        keys = [prefix + name + ".weight" for name in ["W_q", "W_k", "W_v"]]
+        if all(key in state_dict for key in keys):
+            state_dict[prefix + "W_qkv"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
 
-    def forward(self, x_q, x_k, x_v, mask=None):
+        super(SelfAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def split_heads(self, x):
+        """
+        :param x: shape = batch_size, sentence_len, n * d_model
+        :return: n tensors of shape = batch_size, heads, sentence_len, d_k
+        """
+        batch_size = x.shape[0]
+        x = x.view(batch_size, x.shape[1], -1, self.heads, self.d_k).permute(2, 0, 3, 1, 4)
+        return x.unbind(0)
+
+    def forward(self, x_q, x_k, x_v, mask=None, cache=None, static_kv=False):
         """
         shapes = (batch_size, sentence_len, d_model)
         :param x_q: input used to form query
         :param x_k: input used to form key
         :param x_v: input used to form value
+        :param mask: attention is allowed where mask is non zero, broadcast to (batch_size, heads, len_q, len_k)
+        :param cache: dict holding the keys and values of previous decoding steps, updated in place
+        :param static_kv: keys and values don't change across steps (encoder output),
+                          compute them once and reuse them from the cache
         :return:
         """
         batch_size = x_q.shape[0]
-        # output of matmul has shape batch_size, sentence_len, d_model
+        W_q, W_k, W_v = self.W_qkv.chunk(3, dim=0)
+        cached_kv = cache is not None and static_kv and "k" in cache
+
+        # output of the projections has shape batch_size, sentence_len, d_model
         # split d_model into heads and d_k, then transpose to do the attention operations
         # final shape = batch_size, heads, sentence_len, d_k
-        Q = self.W_q(x_q).view(batch_size, -1, self.heads, self.d_k).transpose(1, 2)
-        K = self.W_k(x_k).view(batch_size, -1, self.heads, self.d_k).transpose(1, 2)
-        V = self.W_v(x_v).view(batch_size, -1, self.heads, self.d_k).transpose(1, 2)
-
-        # Q K.T has shape (batch_size, self.heads, len, len), apply softmax row-wise
-        # note that matmul does batch-wize matrix multiplication, ignoring the first two dimensions
-        # scores has shape batch_size, heads, sentence_len, sentence_len
-        scores = torch.matmul(Q, K.transpose(2, -1)) / np.sqrt(self.d_k)
-        if mask is not None:
-            # set to -inf, where mask value is 0
-            scores = scores.masked_fill(mask == 0, -1e9)
-
-        #print("scores", scores[0, 0, :, :])
-        scores = torch.nn.functional.softmax(scores, dim=-1)
-
-        # matmul has shape = batch_size, heads, sentence_len, d_k
-        # for each attention head, for each position, we have an encoding of dimension d_k
-        attention = torch.matmul(scores, V).transpose(1, 2)
-        #print(attention.shape)
-        attention = attention.contiguous().view(batch_size, -1, self.d_model)
-        #print(attention.shape)
-        attention = self.W_o(attention)
-        #print(attention.shape)
-        return attention
+        if cached_kv:
+            Q, = self.split_heads(F.linear(x_q, W_q))
+            K, V = cache["k"], cache["v"]
+
+        elif x_q is x_k and x_k is x_v:
+            # self-attention, one projection for queries, keys and values
+            Q, K, V = self.split_heads(F.linear(x_q, self.W_qkv))
+
+        elif x_k is x_v:
+            # attention over the encoder output, one projection for keys and values
+            Q, = self.split_heads(F.linear(x_q, W_q))
+            K, V = self.split_heads(F.linear(x_k, self.W_qkv[self.d_model:]))
+
+        else:
+            Q, = self.split_heads(F.linear(x_q, W_q))
+            K, = self.split_heads(F.linear(x_k, W_k))
+            V, = self.split_heads(F.linear(x_v, W_v))
+
+        if cache is not None and not cached_kv:
+            # append keys and values of the new positions to the ones of previous steps
+            if not static_kv and "k" in cache:
+                K = torch.cat((cache["k"], K), dim=2)
+                V = torch.cat((cache["v"], V), dim=2)
+
+            cache["k"], cache["v"] = K, V
+
+        if mask is not None and mask.dtype != torch.bool:
+            mask = mask != 0
+
+        if self.use_sdpa:
+            # the kernel doesn't materialize the scores when it can avoid it
+            attention = F.scaled_dot_product_attention(Q, K, V, attn_mask=mask)
+
+        else:
+            # Q K.T has shape (batch_size, self.heads, len_q, len_k), apply softmax row-wise
+            # note that matmul does batch-wize matrix multiplication, ignoring the first two dimensions
+            # scaling Q is cheaper than scaling the scores
+            scores = torch.matmul(Q * self.scale, K.transpose(2, -1))
+            if mask is not None:
+                # set to the lowest value of the dtype, where mask value is 0, -1e9 overflows in half precision
+                scores.masked_fill_(~mask, torch.finfo(scores.dtype).min)
+
+            scores = torch.nn.functional.softmax(scores, dim=-1)
+
+            # matmul has shape = batch_size, heads, sentence_len, d_k
+            # for each attention head, for each position, we have an encoding of dimension d_k
+            attention = torch.matmul(scores, V)
+
+        attention = attention.transpose(1, 2).reshape(batch_size, -1, self.d_model)
+        return self.W_o(attention)
 
 class VariationalAttention(torch.nn.Module):
     """
@@ -131,13 +203,9 @@ class VariationalAttention(torch.nn.Module):
 
         # shape = batch_size, len, d_model
         a_det = self.det_attn(x_q, x_k, x_v, mask)
-        print("a_det", a_det.shape)
 
-        # make sigma a diagonal matrix of shape batch size, seq len, dim, dim
+        # diagonal of sigma, shape = batch size, seq len, dim
         sigma = self.compute_sigma(a_det)
-        sigma = sigma.unsqueeze(-1).expand(*sigma.size(), self.d_model)
-        sigma = sigma*torch.eye(self.d_model)
-        print("sigma", sigma.shape)
 
         z = self.sample(a_det=a_det, sigma=sigma, n_samples=n_samples)
 
@@ -147,11 +215,8 @@ class VariationalAttention(torch.nn.Module):
 
         # sample latent code
         # shape = n_samples, batch_size, len, d_model
-        z = torch.distributions.MultivariateNormal(loc=a_det, covariance_matrix=sigma)
-
         # samples z using reparameterization trick, the gradient will be propagated back
-        return z.rsample(sample_shape=torch.Size([n_samples]))
-        #return z.sample_n(n_samples)
+        return sample_diagonal_gaussian(a_det, sigma, n_samples)
 
 if __name__ == "__main__":
 
@@ -172,12 +237,27 @@ if __name__ == "__main__":
     out = att(x, x, x, mask=mask)
     print(out)
 
+    # masked self-attention in mixed precision, on CPU with bfloat16
+    x = torch.randn(3, 5, 512, dtype=torch.float32)
+    out = att(x, x, x, mask=mask)
+    with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+        amp_out = att(x, x, x, mask=mask)
+    assert amp_out.dtype == torch.bfloat16 and torch.isfinite(amp_out).all()
+    print("bf16 max abs error", (amp_out.float() - out).abs().max().item())
+
     # test variational attention
     att = VariationalAttention(params)
     x = torch.ones(3, 5, 512, dtype=torch.float32)
     a = att(x, x, x, n_samples=2)
     print('a', a.shape)
 
+    # samples have the mean and variance of the former multivariate normal with diagonal covariance
+    mean, var = torch.randn(4, 8, dtype=torch.float64), torch.rand(4, 8, dtype=torch.float64) + 0.1
+    samples = sample_diagonal_gaussian(mean, var, n_samples=200000)
+    dist = torch.distributions.MultivariateNormal(loc=mean, covariance_matrix=torch.diag_embed(var))
+    assert torch.allclose(samples.mean(dim=0), dist.mean, atol=0.02)
+    assert torch.allclose(samples.var(dim=0), dist.variance, rtol=0.05)
+
     # test self-attention with masking
     mask = np.tril(np.ones((3, 5, 5)), k=0).astype(np.uint8)
     mask = torch.from_numpy(mask).unsqueeze_(1)
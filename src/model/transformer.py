@@ -117,13 +117,15 @@ class Transformer(torch.nn.Module):
             else:
                 return new_z
 
-    def decode(self, prev_output, latent_seq, src_mask, tgt_mask, tgt_lang):
+    def decode(self, prev_output, latent_seq, src_mask, tgt_mask, tgt_lang, cache=None, step=0):
 
         dec_output = self.decoder(prev_output,
                                   latent_seq,
                                   src_mask=src_mask,
                                   tgt_mask=tgt_mask,
-                                  lang_id=tgt_lang)
+                                  lang_id=tgt_lang,
+                                  cache=cache,
+                                  step=step)
 
         return self.linear_layers[tgt_lang](dec_output)
 
@@ -148,34 +150,20 @@ class Transformer(torch.nn.Module):
         sent_emb = torch.mean(z, dim=1)
 
         # compute diagonal elements of sigma, returns vectors of dim d_model
+        # sigma is the variance of the posterior, of mean sent_emb
         sigma = self.compute_sigma(sent_emb)
 
-        # make sigma a diagonal matrix of shape batch size, dim, dim
-        sigma = sigma.unsqueeze(-1).expand(*sigma.size(), self.d_model)
-        sigma = sigma * torch.eye(self.d_model, device=sigma.device)
+        # samples the shift with the reparameterization trick, the gradient will be propagated back
+        # shape = n_samples, batch_size, d_model
+        shift = sample_diagonal_gaussian(torch.zeros_like(sent_emb), sigma, n_samples)
 
-        shift_dist = torch.distributions.MultivariateNormal(loc=torch.zeros_like(sent_emb),
-                                                            covariance_matrix=sigma)
-
-        posterior = torch.distributions.MultivariateNormal(loc=sent_emb,
-                                                           covariance_matrix=sigma)
-
-        prior = torch.distributions.MultivariateNormal(loc=torch.zeros(self.d_model, device=sent_emb.device),
-                                                       covariance_matrix=torch.eye(self.d_model, device=sent_emb.device))
-
-        # samples z using reparameterization trick, the gradient will be propagated back
-        shift = shift_dist.rsample(sample_shape=torch.Size([n_samples]))
-
-        # repeat shift on the len dim, n_samples, batch_size, ?, d_model
-        shift = shift.unsqueeze_(2).repeat(1, 1, z.size(1), 1)
-
-        # repeat z on the sample dim, allocates more memory
-        z = z.unsqueeze_(0).repeat(n_samples, 1, 1, 1)
-
-        # shift all the z's by the new avg
-        z = z + shift
+        # shift all the z's by the new avg, broadcast on the len dim
+        z = z.unsqueeze(0) + shift.unsqueeze(2)
         z = z.view(n_samples*z.size(1), -1, self.d_model)
-        kl_div = torch.mean(kl_divergence(prior, posterior))
+
+        # KL(prior || posterior) between N(0, I) and N(sent_emb, diag(sigma)), in closed form
+        kl_div = 0.5 * (torch.log(sigma) + (1 + sent_emb ** 2) / sigma - 1).sum(dim=-1)
+        kl_div = torch.mean(kl_div)
 
         return z, kl_div
 
@@ -271,7 +259,7 @@ class Transformer(torch.nn.Module):
             pretrained = []
             word2id = []
             for path in split:
-                pretrained_i, word2id_i = reload_embeddings(path, self.emb_dim)
+                pretrained_i, word2id_i = reload_embeddings(path, self.d_model)
                 pretrained.append(pretrained_i)
                 word2id.append(word2id_i)
 
@@ -293,31 +281,10 @@ class Transformer(torch.nn.Module):
             to_update.append(self.decoder.embedding_layers[i].weight.data)
             to_update.append(self.linear_layers[i].weight.data)
 
-            # for every word in that language
-            for word_id in range(self.vocab_size[i]):
-                word = dico[word_id]
-
-                # if word is in the dictionary of that language
-                if word in word2id[i]:
-
-                    # count the number of words found for each language
-                    found[i] += 1
-
-                    # get the embedding vector for that word
-                    vec = torch.from_numpy(pretrained[i][word2id[i][word]])
-
-                    # for each embedding layer to update
-                    # set the word_id's word vector to vec
-                    for x in to_update:
-                        x[word_id] = vec
-
-                # if word requires lowercasing
-                elif word.lower() in word2id[i]:
-                    found[i] += 1
-                    lower[i] += 1
-                    vec = torch.from_numpy(pretrained[i][word2id[i][word.lower()]])
-                    for x in to_update:
-                        x[word_id] = vec
+            # copy the vectors of all the words found, with a single indexed copy per weight
+            word_ids, rows, lower[i] = get_emb_rows(dico, self.vocab_size[i], word2id[i])
+            found[i] = len(word_ids)
+            set_emb_rows(to_update, word_ids, pretrained[i][rows])
 
         # print summary
         for i in range(self.n_langs):
@@ -348,8 +315,29 @@ if __name__ == "__main__":
     # parser = get_parser()
     # data_params = parser.parse_args()
     # check_all_data_params(data_params)
-    model = Transformer(data_params=None, embd_file=None, logger=logging)
+    model = Transformer(data_params=None, embd_file=None, logger=logging, is_variational=False)
 
     out = model.forward(input_seq=x, prev_output=y, src_lang=0, tgt_lang=1, src_mask=src_m, tgt_mask=tgt_m)
     print(out)
 
+    # compare sample_z with the former full covariance multivariate normals
+    model = Transformer(data_params=None, embd_file=None, logger=logging, is_variational=True)
+    z = torch.randn(20, 5, model.d_model, dtype=torch.float64)
+    model.double()
+    z_samples, kl_div = model.sample_z(z, n_samples=3)
+    assert z_samples.shape == (60, 5, model.d_model)
+
+    sent_emb = torch.mean(z, dim=1)
+    sigma = model.compute_sigma(sent_emb)
+    covariance = torch.diag_embed(sigma)
+    posterior = torch.distributions.MultivariateNormal(loc=sent_emb, covariance_matrix=covariance)
+    prior = torch.distributions.MultivariateNormal(loc=torch.zeros_like(sent_emb[0]),
+                                                   covariance_matrix=torch.eye(model.d_model, dtype=torch.float64))
+    assert torch.allclose(kl_div, torch.mean(kl_divergence(prior, posterior)))
+
+    # the shifts are the same for the positions of a sentence, with variance sigma
+    shift = (z_samples.view(3, 20, 5, -1) - z.unsqueeze(0))
+    assert torch.allclose(shift, shift[:, :, :1])
+    shift = model.sample_z(z[:1, :1].expand(20000, 1, -1), n_samples=1)[0][:, 0] - z[0, 0]
+    print("variance ratio", (shift.var(dim=0) / model.compute_sigma(z[0, 0])).mean().item())
+
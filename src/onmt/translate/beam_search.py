@@ -28,6 +28,7 @@ class BeamSearch(DecodeStrategy):
         exclusion_tokens (set[int]): See base.
         memory_lengths (LongTensor): Lengths of encodings. Used for
             masking attentions.
+        max_lengths (LongTensor or NoneType): See base.
 
     Attributes:
         top_beam_finished (ByteTensor): Shape ``(B,)``.
@@ -49,18 +50,29 @@ class BeamSearch(DecodeStrategy):
             ``(B, beam_size)``. Initialized to ``None``.
         _coverage (FloatTensor or NoneType): Shape
             ``(1, B x beam_size, inp_seq_len)``.
-        hypotheses (list[list[Tuple[Tensor]]]): Contains a tuple
-            of score (float), sequence (long), and attention (float or None)
+        hyp_scores (FloatTensor): Shape ``(batch_size, n_best)``. Scores
+            of the best finished hypotheses of each batch entry, sorted in
+            decreasing order, ``-inf`` for empty slots.
+        hyp_seqs (LongTensor): Shape ``(batch_size, n_best, max_length)``.
+            Sequences of the best finished hypotheses, without the start
+            token, padded with ``pad``.
+        hyp_lengths (LongTensor): Shape ``(batch_size, n_best)``. Lengths
+            of the sequences in ``hyp_seqs``.
+        hyp_count (LongTensor): Shape ``(batch_size,)``. Number of
+            hypotheses that finished for each batch entry.
+        hyp_attn (FloatTensor or NoneType): Shape
+            ``(batch_size, n_best, max_length, inp_seq_len)``, attention of
+            the hypotheses in ``hyp_seqs``, when attention is tracked.
     """
 
     def __init__(self, beam_size, batch_size, pad, bos, eos, n_best, mb_device,
                  global_scorer, min_length, max_length, return_attention,
                  block_ngram_repeat, exclusion_tokens, memory_lengths,
-                 stepwise_penalty, ratio):
+                 stepwise_penalty, ratio, max_lengths=None):
         super(BeamSearch, self).__init__(
             pad, bos, eos, batch_size, mb_device, beam_size, min_length,
             block_ngram_repeat, exclusion_tokens, return_attention,
-            max_length)
+            max_length, max_lengths)
         # beam parameters
         self.global_scorer = global_scorer
         self.beam_size = beam_size
@@ -68,15 +80,26 @@ class BeamSearch(DecodeStrategy):
         self.batch_size = batch_size
         self.ratio = ratio
 
-        # result caching
-        self.hypotheses = [[] for _ in range(batch_size)]
+        # result caching, the best n_best finished hypotheses of each batch
+        # entry are kept in preallocated buffers
+        self.hyp_scores = torch.full([batch_size, n_best], float("-inf"),
+                                     dtype=torch.float, device=mb_device)
+        self.hyp_seqs = torch.full([batch_size, n_best, max_length], pad,
+                                   dtype=torch.long, device=mb_device)
+        self.hyp_lengths = torch.zeros([batch_size, n_best], dtype=torch.long,
+                                       device=mb_device)
+        self.hyp_count = torch.zeros([batch_size], dtype=torch.long,
+                                     device=mb_device)
+        self.hyp_attn = None
 
         # beam state
-        self.top_beam_finished = torch.zeros([batch_size], dtype=torch.uint8)
+        self.top_beam_finished = torch.zeros([batch_size], dtype=torch.bool,
+                                             device=mb_device)
         self.best_scores = torch.full([batch_size], -1e10, dtype=torch.float,
                                       device=mb_device)
 
-        self._batch_offset = torch.arange(batch_size, dtype=torch.long)
+        self._batch_offset = torch.arange(batch_size, dtype=torch.long,
+                                          device=mb_device)
         self._beam_offset = torch.arange(
             0, batch_size * beam_size, step=beam_size, dtype=torch.long,
             device=mb_device)
@@ -163,7 +186,8 @@ class BeamSearch(DecodeStrategy):
         torch.mul(self.topk_scores, length_penalty, out=self.topk_log_probs)
 
         # Resolve beam origin and map to batch index flat representation.
-        torch.div(self.topk_ids, vocab_size, out=self._batch_index)
+        torch.div(self.topk_ids, vocab_size, rounding_mode='floor',
+                  out=self._batch_index)
         self._batch_index += self._beam_offset[:_B].unsqueeze(1)
         self.select_indices = self._batch_index.view(_B * self.beam_size)
 
@@ -173,6 +197,7 @@ class BeamSearch(DecodeStrategy):
         self.alive_seq = torch.cat(
             [self.alive_seq.index_select(0, self.select_indices),
              self.topk_ids.view(_B * self.beam_size, 1)], -1)
+        self.select_ngram_state(self.select_indices)
         if self.return_attention or self._cov_pen:
             current_attn = attn.index_select(1, self.select_indices)
             if step == 1:
@@ -204,60 +229,92 @@ class BeamSearch(DecodeStrategy):
         self.is_finished = self.topk_ids.eq(self.eos)
         self.ensure_max_length()
 
+    def store_finished(self, predictions, attention):
+        """Merge the hypotheses that finished at this step into the
+        ``n_best`` best hypotheses of their batch entries.
+
+        The stored hypotheses come first in the stable sort, so on equal
+        scores the earliest finished hypothesis ranks first.
+        """
+        _B = self.is_finished.size(0)
+        step = predictions.size(-1)
+        b = self._batch_offset
+
+        stored = (torch.arange(self.n_best, device=b.device).unsqueeze(0)
+                  < self.hyp_count[b].unsqueeze(1))
+        valid = torch.cat([stored, self.is_finished], 1)
+        scores = torch.cat([self.hyp_scores[b], self.topk_scores], 1)
+        scores = scores.masked_fill(~valid, float("-inf"))
+        _, order = torch.sort(scores, dim=1, descending=True, stable=True)
+        order = order[:, :self.n_best]
+
+        # sequences without the start token, padded to max_length
+        seqs = torch.full([_B, self.beam_size, self.max_length], self.pad,
+                          dtype=torch.long, device=b.device)
+        seqs[:, :, :step - 1] = predictions[:, :, 1:]
+        seqs = torch.cat([self.hyp_seqs[b], seqs], 1)
+        lengths = torch.cat(
+            [self.hyp_lengths[b], torch.full_like(self.topk_ids, step - 1)], 1)
+
+        self.hyp_scores[b] = scores.gather(1, order)
+        self.hyp_seqs[b] = seqs.gather(
+            1, order.unsqueeze(-1).expand(_B, self.n_best, self.max_length))
+        self.hyp_lengths[b] = lengths.gather(1, order)
+        self.hyp_count[b] += self.is_finished.sum(1)
+
+        if attention is not None:
+            # shape: (_B, beam_size, step - 1, inp_seq_len)
+            inp_seq_len = attention.size(-1)
+            if self.hyp_attn is None:
+                self.hyp_attn = torch.zeros(
+                    [self.batch_size, self.n_best, self.max_length,
+                     inp_seq_len], device=b.device)
+            attn = torch.zeros([_B, self.beam_size, self.max_length,
+                                inp_seq_len], device=b.device)
+            attn[:, :, :step - 1] = attention.permute(1, 2, 0, 3)
+            attn = torch.cat([self.hyp_attn[b], attn], 1)
+            self.hyp_attn[b] = attn.gather(
+                1, order.view(_B, self.n_best, 1, 1).expand(
+                    _B, self.n_best, self.max_length, inp_seq_len))
+
     def update_finished(self):
         # Penalize beams that finished.
         _B_old = self.topk_log_probs.shape[0]
         step = self.alive_seq.shape[-1]  # 1 greater than the step in advance
         self.topk_log_probs.masked_fill_(self.is_finished, -1e10)
-        # on real data (newstest2017) with the pretrained transformer,
-        # it's faster to not move this back to the original device
-        self.is_finished = self.is_finished.to('cpu')
-        self.top_beam_finished |= self.is_finished[:, 0].eq(1)
+        self.top_beam_finished |= self.is_finished[:, 0]
         predictions = self.alive_seq.view(_B_old, self.beam_size, step)
         attention = (
             self.alive_attn.view(
                 step - 1, _B_old, self.beam_size, self.alive_attn.size(-1))
             if self.alive_attn is not None else None)
-        non_finished_batch = []
-        for i in range(self.is_finished.size(0)):
-            b = self._batch_offset[i]
-            finished_hyp = self.is_finished[i].nonzero().view(-1)
-            # Store finished hypotheses for this batch.
-            for j in finished_hyp:
-                if self.ratio > 0:
-                    s = self.topk_scores[i, j] / (step + 1)
-                    if self.best_scores[b] < s:
-                        self.best_scores[b] = s
-                self.hypotheses[b].append((
-                    self.topk_scores[i, j],
-                    predictions[i, j, 1:],  # Ignore start_token.
-                    attention[:, i, j, :self._memory_lengths[i]]
-                    if attention is not None else None))
-            # End condition is the top beam finished and we can return
-            # n_best hypotheses.
-            if self.ratio > 0:
-                pred_len = self._memory_lengths[i] * self.ratio
-                finish_flag = ((self.topk_scores[i, 0] / pred_len)
-                               <= self.best_scores[b]) or \
-                    self.is_finished[i].all()
-            else:
-                finish_flag = self.top_beam_finished[i] != 0
-            if finish_flag and len(self.hypotheses[b]) >= self.n_best:
-                best_hyp = sorted(
-                    self.hypotheses[b], key=lambda x: x[0], reverse=True)
-                for n, (score, pred, attn) in enumerate(best_hyp):
-                    if n >= self.n_best:
-                        break
-                    self.scores[b].append(score)
-                    self.predictions[b].append(pred)
-                    self.attention[b].append(
-                        attn if attn is not None else [])
-            else:
-                non_finished_batch.append(i)
-        non_finished = torch.tensor(non_finished_batch)
+
+        # Store finished hypotheses for this batch.
+        if self.ratio > 0:
+            s = (self.topk_scores / (step + 1)).masked_fill(
+                ~self.is_finished, -1e10).max(1)[0]
+            self.best_scores[self._batch_offset] = torch.max(
+                self.best_scores[self._batch_offset], s)
+        self.store_finished(predictions, attention)
+
+        # End condition is the top beam finished and we can return
+        # n_best hypotheses.
+        if self.ratio > 0:
+            pred_len = self._memory_lengths[:_B_old] * self.ratio
+            finish_flag = ((self.topk_scores[:, 0] / pred_len)
+                           <= self.best_scores[self._batch_offset]) | \
+                self.is_finished.all(1)
+        else:
+            finish_flag = self.top_beam_finished
+        finish_flag = finish_flag & (
+            self.hyp_count[self._batch_offset] >= self.n_best)
+
+        # the only host / device synchronization of the step
+        non_finished = (~finish_flag).nonzero().view(-1)
         # If all sentences are translated, no need to go further.
         if len(non_finished) == 0:
             self.done = True
+            self.finalize()
             return
 
         _B_new = non_finished.shape[0]
@@ -265,13 +322,17 @@ class BeamSearch(DecodeStrategy):
         self.top_beam_finished = self.top_beam_finished.index_select(
             0, non_finished)
         self._batch_offset = self._batch_offset.index_select(0, non_finished)
-        non_finished = non_finished.to(self.topk_ids.device)
         self.topk_log_probs = self.topk_log_probs.index_select(0,
                                                                non_finished)
         self._batch_index = self._batch_index.index_select(0, non_finished)
         self.select_indices = self._batch_index.view(_B_new * self.beam_size)
         self.alive_seq = predictions.index_select(0, non_finished) \
             .view(-1, self.alive_seq.size(-1))
+        self.select_ngram_state(
+            (non_finished.unsqueeze(1) * self.beam_size
+             + torch.arange(self.beam_size, device=non_finished.device))
+            .view(-1))
+        self.select_max_lengths(non_finished)
         self.topk_scores = self.topk_scores.index_select(0, non_finished)
         self.topk_ids = self.topk_ids.index_select(0, non_finished)
         if self.alive_attn is not None:
@@ -286,3 +347,15 @@ class BeamSearch(DecodeStrategy):
                 if self._stepwise_cov_pen:
                     self._prev_penalty = self._prev_penalty.index_select(
                         0, non_finished)
+
+    def finalize(self):
+        """Fill ``predictions``, ``scores`` and ``attention`` from the
+        finished hypothesis buffers, best hypothesis first."""
+        lengths = self.hyp_lengths.tolist()
+        for b in range(self.batch_size):
+            self.scores[b] = list(self.hyp_scores[b].unbind())
+            self.predictions[b] = [self.hyp_seqs[b, n, :lengths[b][n]]
+                                   for n in range(self.n_best)]
+            self.attention[b] = [self.hyp_attn[b, n, :lengths[b][n]]
+                                 if self.hyp_attn is not None else []
+                                 for n in range(self.n_best)]
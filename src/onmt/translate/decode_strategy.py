@@ -24,6 +24,10 @@ class DecodeStrategy(object):
             tokens, it may repeat.
         return_attention (bool): Whether to work with attention too. If this
             is true, it is assumed that the decoder is attentional.
+        max_lengths (LongTensor or NoneType): Shape ``(batch_size,)``.
+            Longest acceptable sequence of each batch entry, capped by
+            ``max_length``. Paths of a batch entry are finished individually
+            when they reach its max length.
 
     Attributes:
         pad (int): See above.
@@ -52,11 +56,16 @@ class DecodeStrategy(object):
         exclusion_tokens (set[int]): See above.
         return_attention (bool): See above.
         done (bool): See above.
+        _repeated_ngram (BoolTensor): Shape ``(B x parallel_paths,)``.
+            Whether each path already repeats a ``block_ngram_repeat``-gram.
+            Reordered along with ``alive_seq``.
+        _max_lengths (LongTensor or NoneType): Shape ``(B,)``. Max length
+            of the batch entries left.
     """
 
     def __init__(self, pad, bos, eos, batch_size, device, parallel_paths,
                  min_length, block_ngram_repeat, exclusion_tokens,
-                 return_attention, max_length):
+                 return_attention, max_length, max_lengths=None):
 
         # magic indices
         self.pad = pad
@@ -78,8 +87,15 @@ class DecodeStrategy(object):
 
         self.min_length = min_length
         self.max_length = max_length
+        self._max_lengths = None
+        if max_lengths is not None:
+            self._max_lengths = max_lengths.to(device).clamp(max=max_length)
         self.block_ngram_repeat = block_ngram_repeat
         self.exclusion_tokens = exclusion_tokens
+        self._exclusion_tokens = torch.tensor(
+            sorted(exclusion_tokens), dtype=torch.long, device=device)
+        self._repeated_ngram = torch.zeros(
+            [batch_size * parallel_paths], dtype=torch.bool, device=device)
         self.return_attention = return_attention
 
         self.done = False
@@ -96,27 +112,45 @@ class DecodeStrategy(object):
         # this implies it hasn't been found.
         if len(self) == self.max_length + 1:
             self.is_finished.fill_(1)
+        elif self._max_lengths is not None:
+            reached = self._max_lengths < len(self)
+            self.is_finished |= reached.unsqueeze(1).to(self.is_finished.dtype)
 
     def block_ngram_repeats(self, log_probs):
+        """Block the paths whose sequence (without BOS) contains a repeated
+        ``block_ngram_repeat``-gram. Grams with an excluded token may repeat.
+
+        Paths inherit the state of the path they extend, so only the newest
+        gram of each path is compared with its earlier grams at each step.
+        """
+        n = self.block_ngram_repeat
         cur_len = len(self)
-        if self.block_ngram_repeat > 0 and cur_len > 1:
-            for path_idx in range(self.alive_seq.shape[0]):
-                # skip BOS
-                hyp = self.alive_seq[path_idx, 1:]
-                ngrams = set()
-                fail = False
-                gram = []
-                for i in range(cur_len - 1):
-                    # Last n tokens, n = block_ngram_repeat
-                    gram = (gram + [hyp[i].item()])[-self.block_ngram_repeat:]
-                    # skip the blocking if any token in gram is excluded
-                    if set(gram) & self.exclusion_tokens:
-                        continue
-                    if tuple(gram) in ngrams:
-                        fail = True
-                    ngrams.add(tuple(gram))
-                if fail:
-                    log_probs[path_idx] = -10e20
+        if n <= 0 or cur_len <= 1:
+            return
+
+        # skip BOS, at least two grams are needed for a repeat
+        hyp = self.alive_seq[:, 1:]
+        if hyp.size(1) > n:
+            grams = hyp.unfold(1, n, 1)
+            excluded = (hyp.unsqueeze(-1) == self._exclusion_tokens).any(-1)
+            excluded = excluded.unfold(1, n, 1).any(-1)
+
+            same = (grams[:, :-1] == grams[:, -1:]).all(-1) & ~excluded[:, :-1]
+            self._repeated_ngram |= same.any(1) & ~excluded[:, -1]
+
+        log_probs.masked_fill_(self._repeated_ngram.unsqueeze(1), -10e20)
+
+    def select_ngram_state(self, indices):
+        """Follow the paths selected by ``indices`` (LongTensor or
+        BoolTensor over the current paths)."""
+        if self.block_ngram_repeat > 0:
+            self._repeated_ngram = self._repeated_ngram[indices]
+
+    def select_max_lengths(self, indices):
+        """Follow the batch entries selected by ``indices`` (LongTensor or
+        BoolTensor over the current batch entries)."""
+        if self._max_lengths is not None:
+            self._max_lengths = self._max_lengths[indices]
 
     def advance(self, log_probs, attn):
         """DecodeStrategy subclasses should override :func:`advance()`.
@@ -135,3 +169,48 @@ class DecodeStrategy(object):
         """
 
         raise NotImplementedError()
+
+
+if __name__ == "__main__":
+
+    # compare with the former loop over paths and positions
+    def loop_block_ngram_repeats(alive_seq, block_ngram_repeat,
+                                 exclusion_tokens):
+        blocked = []
+        for path_idx in range(alive_seq.shape[0]):
+            hyp = alive_seq[path_idx, 1:]
+            ngrams = set()
+            fail = False
+            gram = []
+            for i in range(alive_seq.shape[1] - 1):
+                gram = (gram + [hyp[i].item()])[-block_ngram_repeat:]
+                if set(gram) & exclusion_tokens:
+                    continue
+                if tuple(gram) in ngrams:
+                    fail = True
+                ngrams.add(tuple(gram))
+            blocked.append(fail)
+        return torch.tensor(blocked)
+
+    for n in [1, 2, 3]:
+        strategy = DecodeStrategy(pad=0, bos=1, eos=2, batch_size=8,
+                                  device='cpu', parallel_paths=4,
+                                  min_length=0, block_ngram_repeat=n,
+                                  exclusion_tokens={5}, return_attention=False,
+                                  max_length=40)
+        n_paths = strategy.alive_seq.size(0)
+        for step in range(40):
+            log_probs = torch.zeros(n_paths, 10)
+            strategy.block_ngram_repeats(log_probs)
+            blocked = log_probs[:, 0] < 0
+            expected = loop_block_ngram_repeats(
+                strategy.alive_seq, n, strategy.exclusion_tokens)
+            assert (blocked == expected).all(), (n, step)
+
+            # paths extend random paths with a random token
+            indices = torch.randint(n_paths, (n_paths,))
+            strategy.alive_seq = torch.cat(
+                [strategy.alive_seq[indices],
+                 torch.randint(3, 10, (n_paths, 1))], -1)
+            strategy.select_ngram_state(indices)
+    print("n-gram blocking ok")
@@ -81,16 +81,17 @@ class RandomSampling(DecodeStrategy):
             :func:`~onmt.translate.random_sampling.sample_with_temperature()`.
         memory_length (LongTensor): Lengths of encodings. Used for
             masking attention.
+        max_lengths (LongTensor or NoneType): See base.
     """
 
     def __init__(self, pad, bos, eos, batch_size, device,
                  min_length, block_ngram_repeat, exclusion_tokens,
                  return_attention, max_length, sampling_temp, keep_topk,
-                 memory_length):
+                 memory_length, max_lengths=None):
         super(RandomSampling, self).__init__(
             pad, bos, eos, batch_size, device, 1,
             min_length, block_ngram_repeat, exclusion_tokens,
-            return_attention, max_length)
+            return_attention, max_length, max_lengths)
         self.sampling_temp = sampling_temp
         self.keep_topk = keep_topk
         self.topk_scores = None
@@ -145,6 +146,8 @@ class RandomSampling(DecodeStrategy):
             return
         is_alive = ~self.is_finished.view(-1)
         self.alive_seq = self.alive_seq[is_alive]
+        self.select_ngram_state(is_alive)
+        self.select_max_lengths(is_alive)
         if self.alive_attn is not None:
             self.alive_attn = self.alive_attn[:, is_alive]
         self.select_indices = is_alive.nonzero().view(-1)
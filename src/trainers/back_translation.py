@@ -0,0 +1,231 @@
+from logging import getLogger
+import threading
+import queue
+import copy
+import torch
+
+from src.model.beam_search_wrapper import MyBeamSearch
+
+logger = getLogger()
+
+
+class BackTranslationWorker(object):
+    """
+    Generates back-translation batches in a background thread, with its own copy of the model.
+
+    The copy is refreshed with the weights of the trained model by update_weights,
+    which stages a snapshot of the weights, loaded by the worker thread between two batches.
+    Each batch records the step of the weights it was generated with,
+    and get_batch drops the batches older than max_staleness steps.
+    """
+
+    def __init__(self, trainer, directions, queue_size=2, max_staleness=50, seed=0):
+        """
+        :param trainer: UnsupervisedTrainer, provides the model, monolingual iterators, noise and masks
+        :param directions: list of (src_lang, tgt_lang) ids to generate batches for
+        :param queue_size: number of batches generated ahead for each direction
+        :param max_staleness: maximum number of steps between the weights used to generate a batch and
+                              the current weights
+        """
+        self.trainer = trainer
+        self.directions = directions
+        self.max_staleness = max_staleness
+        self.device = trainer.device
+
+        # copy the model, but share the data it holds
+        model = getattr(trainer.transformer, 'module', trainer.transformer)
+        memo = {id(getattr(model, k)): getattr(model, k) for k in ['data', 'data_params', 'dictionaries', 'logger']
+                if hasattr(model, k)}
+        self.model = copy.deepcopy(model, memo).eval()
+        for p in self.model.parameters():
+            p.requires_grad_(False)
+        self.version = trainer.step
+
+        # weights staged by update_weights, the lock is only held to stage or take them
+        self.staged = None
+        self.staged_version = trainer.step
+        self.lock = threading.Lock()
+
+        beam_search = trainer.beam_search
+        self.beam_search = MyBeamSearch(self.model, beam_size=beam_search.beam_size, n_best=beam_search.n_best,
+                                        encoding_lengths=beam_search.encoding_lengths,
+                                        max_length=beam_search.max_length, logger=beam_search.logger,
+                                        decoding=beam_search.decoding, sampling_temp=beam_search.sampling_temp,
+                                        keep_topk=beam_search.keep_topk, bucket_size=beam_search.bucket_size,
+                                        max_len_a=beam_search.max_len_a, max_len_b=beam_search.max_len_b)
+
+        # generation runs on its own stream, to overlap with training
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        if self.stream is not None:
+            # the copy of the model is made on the current stream
+            self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        self.generator = torch.Generator(self.device)
+        self.generator.manual_seed(seed)
+
+        # clean monolingual batches, noise is only added to the generated sentences
+        self.get_iterators = {src_lang: trainer.get_lm_iterator(lang_id=src_lang, add_noise=False)
+                              for src_lang, _ in directions}
+        self.iterators = {src_lang: get_iterator() for src_lang, get_iterator in self.get_iterators.items()}
+
+        self.queues = {direction: queue.Queue(queue_size) for direction in directions}
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def update_weights(self, step):
+        """
+        Stage a snapshot of the weights of the trained model, used for the batches generated from now on.
+        The snapshot is taken on the current stream, it doesn't wait for the batch being generated.
+        """
+        model = getattr(self.trainer.transformer, 'module', self.trainer.transformer)
+        state_dict = {k: v.detach().clone() for k, v in model.state_dict().items()}
+
+        event = None
+        if self.stream is not None:
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(self.device))
+
+        with self.lock:
+            self.staged = (step, state_dict, event)
+            self.staged_version = step
+
+    def load_staged_weights(self):
+        """
+        Load the weights staged by update_weights, in the worker thread between two batches
+        """
+        with self.lock:
+            staged, self.staged = self.staged, None
+        if staged is None:
+            return
+
+        step, state_dict, event = staged
+        if self.stream is not None:
+            # copy on the worker stream, once the snapshot is taken, after the decoding kernels already queued
+            self.stream.wait_event(event)
+            with torch.cuda.stream(self.stream):
+                self.model.load_state_dict(state_dict)
+            # the snapshot is freed in this thread, tell the allocator it is used on the worker stream
+            for t in state_dict.values():
+                t.record_stream(self.stream)
+
+        else:
+            self.model.load_state_dict(state_dict)
+        self.version = step
+
+    def next_batch(self, src_lang):
+        try:
+            return next(self.iterators[src_lang])
+
+        except StopIteration:
+            # restart the iterator
+            self.iterators[src_lang] = self.get_iterators[src_lang]()
+            return next(self.iterators[src_lang])
+
+    def generate(self, src_lang, tgt_lang):
+        """
+        translate a monolingual batch from src_lang to tgt_lang
+        :return: back-translation batch dict, with the translation as the source,
+                 the original sentences, and their translations
+        """
+        batch_dict = self.next_batch(src_lang)
+        x = batch_dict["tgt_batch"]
+
+        self.load_staged_weights()
+        version = self.version
+
+        # autocast is thread local, enter it in the worker thread
+        with self.trainer.autocast():
+            y, len = self.beam_search(x, self.trainer.get_src_mask(x), src_lang=src_lang, tgt_lang=tgt_lang)
+
+        y_noise, len_noise = self.trainer.noise_model.add_noise(y, len, tgt_lang, self.generator)
+
+        # only the source elements change
+        batch_dict["src_batch"] = y_noise
+        batch_dict["src_mask"] = self.trainer.get_src_mask(y_noise)
+        batch_dict["src_l"] = len_noise
+        return version, batch_dict, x, y
+
+    def put(self, direction, item, event):
+        """
+        Put a generated batch in the queue of its direction, gives up when the worker is closed
+        """
+        while not self.stop.is_set():
+            try:
+                self.queues[direction].put((item, event), timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        """
+        Body of the background thread, its monolingual iterators are closed when it ends
+        """
+        try:
+            self.generate_batches()
+
+        finally:
+            # stop the prefetchers of the monolingual iterators
+            for iterator in self.iterators.values():
+                iterator.close()
+
+    def generate_batches(self):
+        """
+        Generate batches for each direction in turn, the queues block the thread when they are full
+        """
+        while not self.stop.is_set():
+            for direction in self.directions:
+                try:
+                    if self.stream is not None:
+                        with torch.cuda.stream(self.stream):
+                            item = self.generate(*direction)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+
+                    else:
+                        item = self.generate(*direction)
+                        event = None
+
+                except Exception as e:
+                    # the trainer gets the exception in place of the next batch, whatever the direction
+                    logger.exception("message")
+                    for d in self.directions:
+                        self.put(d, e, None)
+                    return
+
+                self.put(direction, item, event)
+
+    def get_batch(self, src_lang, tgt_lang, step):
+        """
+        :param step: current step of the trainer
+        :return: back-translation batch dict, the original sentences x and their translations y,
+                 generated with weights at most max_staleness steps old
+        """
+        while True:
+            item, event = self.queues[(src_lang, tgt_lang)].get()
+            if isinstance(item, Exception):
+                raise item
+
+            version, batch_dict, x, y = item
+            if step - version <= self.max_staleness:
+                break
+
+            # refresh the weights, so the next batches can be used
+            logger.info("Dropping back-translation batch generated at step %i, at step %i" % (version, step))
+            if step - self.staged_version > self.max_staleness:
+                self.update_weights(step)
+
+        if event is not None:
+            # wait for the generation, and tell the allocator the tensors are used on this stream
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            for t in list(batch_dict.values()) + [x, y]:
+                if torch.is_tensor(t):
+                    t.record_stream(current_stream)
+
+        return batch_dict, x, y
+
+    def close(self):
+        """
+        Stop the background thread
+        """
+        self.stop.set()
@@ -1,11 +1,19 @@
 from abc import ABC, abstractmethod
+import contextlib
+import math
 
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 
 from src.data.dataset import *
 from src.data.loader import *
+from src.data.prefetcher import Prefetcher
 from src.model.noise_model import NoiseModel
+from src.model.masks import Masks
+
+# autocast dtype of the forward passes for each --precision, None runs them in fp32
+PRECISIONS = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
 
 
 class Trainer(ABC):
@@ -20,7 +28,25 @@ class Trainer(ABC):
         self.parallel = parallel
         self.is_variational = self.transformer.is_variational
 
-        if torch.cuda.is_available() and not parallel:
+        # set by init_distributed, one process per device
+        self.world_size = getattr(transformer.data_params, 'world_size', 1)
+        self.rank = getattr(transformer.data_params, 'rank', 0)
+        self.is_master = self.rank == 0
+        self.distributed = self.world_size > 1
+
+        if self.distributed:
+            # gradients are all-reduced during the backward pass, each language only uses
+            # its own embeddings and output layer, so some parameters get no gradient
+            local_rank = transformer.data_params.local_rank
+            self.device = torch.device('cuda', local_rank) if torch.cuda.is_available() else torch.device('cpu')
+            self.logger.info("Process %i of %i, on %s" % (self.rank, self.world_size, self.device))
+            self.transformer.to(self.device)
+            self.transformer = DistributedDataParallel(self.transformer,
+                                                       device_ids=[local_rank] if self.device.type == 'cuda' else None,
+                                                       find_unused_parameters=True)
+            self.parallel = False
+
+        elif torch.cuda.is_available() and not parallel:
             self.device = torch.device('cuda')
             self.transformer.cuda()
 
@@ -43,11 +69,19 @@ class Trainer(ABC):
         self.noise_model = NoiseModel(data=self.data, params=self.data_params)
         self.max_len = 175
 
+        # background batch preparation, seeded for reproducibility
+        self.prefetch_workers = getattr(self.data_params, 'prefetch_workers', 1)
+        self.prefetch_batches = getattr(self.data_params, 'prefetch_batches', 2)
+        self.rng = np.random.RandomState(getattr(self.data_params, 'seed', 0) + self.rank)
+
         self.pad_index = transformer.pad_index
         self.eos_index = transformer.eos_index
         self.bos_index = transformer.bos_index
         self.id2lang = transformer.id2lang
 
+        # attention masks, built on the device of the batches
+        self.masks = Masks(self.pad_index, self.max_len)
+
         # label smoothing parameters
         self.smoothing = 0.1
         self.confidence = 1.0 - self.smoothing
@@ -61,16 +95,24 @@ class Trainer(ABC):
         self.opt = torch.optim.Adam(self.transformer.parameters(),
                                     lr=0.0,  betas=(0.9, 0.98), eps=1e-9)
 
+        # mixed precision, fp16 needs the loss to be scaled so small gradients don't underflow
+        self.precision = getattr(self.data_params, 'precision', 'fp32')
+        assert self.precision in PRECISIONS
+        assert self.precision != 'fp16' or self.device.type == 'cuda', "fp16 requires a GPU, use bf16 on CPU"
+        self.amp_dtype = PRECISIONS[self.precision]
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.precision == 'fp16')
+
         # save training details to resume
         self.state = {'iter': self.step,
                       'state_dict': self.transformer.state_dict(),
-                      'optimizer': self.opt.state_dict()}
-
-        # Todo: decide if you want to size_average, it reduces the loss a lot
-        self.kl_div_loss = torch.nn.KLDivLoss(size_average=False, reduce=True)
+                      'optimizer': self.opt.state_dict(),
+                      'scaler': self.scaler.state_dict()}
 
     def save_model(self, path):
 
+        if not self.is_master:
+            return
+
         try:
             torch.save(self.transformer.state_dict(), path)
 
@@ -87,10 +129,15 @@ class Trainer(ABC):
 
     def checkpoint(self, filename):
 
+        # the weights are the same in every process
+        if not self.is_master:
+            return
+
         try:
             self.state = {'iter': self.step,
                           'state_dict': self.transformer.state_dict(),
-                          'optimizer': self.opt.state_dict()}
+                          'optimizer': self.opt.state_dict(),
+                          'scaler': self.scaler.state_dict()}
 
             torch.save(self.state, filename)
 
@@ -108,6 +155,10 @@ class Trainer(ABC):
             self.transformer.load_state_dict(state_dict=model_state_dict)
             self.opt.load_state_dict(state_dict=opt_state_dict)
 
+            # checkpoints from before mixed precision have no scaler
+            if "scaler" in self.state:
+                self.scaler.load_state_dict(self.state["scaler"])
+
         except Exception as e:
             self.logger.exception("message")
 
@@ -121,81 +172,117 @@ class Trainer(ABC):
             for p in self.opt.param_groups:
                 p['lr'] = lr
 
-            self.opt.step()
+            # unscales the gradients, and skips the step if they overflowed
+            self.scaler.step(self.opt)
+            self.scaler.update()
 
         except Exception as e:
             self.logger.exception("message")
 
+    def log_peak_memory(self):
+        """
+        log the peak GPU memory allocated since the last call, e.g. during an optimizer step
+        """
+        if self.device.type != 'cuda':
+            return
+
+        self.logger.info("step %i: peak memory %.1f MB" %
+                         (self.step, torch.cuda.max_memory_allocated(self.device) / 2 ** 20))
+        torch.cuda.reset_peak_memory_stats(self.device)
+
+    def autocast(self):
+        """
+        :return: context in which the forward passes run in the precision of the run
+        """
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype,
+                              enabled=self.amp_dtype is not None)
+
+    def no_sync(self, sync):
+        """
+        :param sync: all-reduce the gradients of the backward passes, in distributed training
+        :return: context in which the gradients of the forward / backward passes are only accumulated
+                 in this process, they are all-reduced with the gradients of the next synced backward pass
+        """
+        if self.distributed and not sync:
+            return self.transformer.no_sync()
+        return contextlib.nullcontext()
+
+    def backward(self, loss):
+        """
+        backward pass of the loss, scaled in fp16
+        """
+        self.scaler.scale(loss).backward()
+
 
     def compute_kl_div_loss(self, x, target, lang):
         """
+        label smoothed KL divergence between the output distribution and the smoothed target,
+        summed over the tokens and divided by the number of tokens (padding included)
 
-        :param x: shape = batch_size, sent_len, vocab_size
+        the smoothed target puts confidence on the target word, 0 on the pad index,
+        and smoothing / vocab_size on the other words, rows of padding targets are 0.
+        the loss of a row is then
+        conf * log(conf) + n_other * eps * log(eps) - conf * x[tgt] - eps * (sum(x) - x[tgt] - x[pad])
+        where x are the log probabilities, which are computed from the logits and their logsumexp,
+        so no (tokens, vocab_size) tensor is created besides the logits
+
+        :param x: logits, shape = batch_size, sent_len, vocab_size
         :param target: shape = batch_size, sent_len, 1
         :param lang:
         :return:
         """
 
         try:
-            # apply softmax on last dim, corresponding to words
-            x = F.log_softmax(x, dim=-1)
-
-            # reshape to index word by word on dim 0
-            x = x.reshape(-1, x.size(-1))
-            target = target.reshape(-1, 1)
+            # reshape to index word by word on dim 0, the loss is computed in fp32 in mixed precision
+            x = x.reshape(-1, x.size(-1)).float()
+            target = target.reshape(-1)
 
             # get number of tokens, to scale loss
             normalize = target.size(0)
 
-            # same device and dtype as x, requires_grad = false
-            smooth_target = torch.zeros_like(x)
-            smooth_target.fill_(self.smoothing / self.vocab_size[lang])
+            eps = self.smoothing / self.vocab_size[lang]
+            n_other = x.size(-1) - 2
 
-            if self.parallel:
-                smooth_target.scatter_(dim=1, index=target.data, value=self.confidence)
+            # sum over the words of p * log(p), the same for every row
+            entropy = n_other * eps * math.log(eps) if eps > 0 else 0.
+            entropy += self.confidence * math.log(self.confidence) if self.confidence > 0 else 0.
 
-            # zero the pad_index for each vector of probabilities
-            smooth_target[:, self.pad_index] = 0
+            # log_softmax of the target, pad and all words, from the logits
+            lse = torch.logsumexp(x, dim=-1)
+            x_tgt = x.gather(1, target.unsqueeze(1)).squeeze(1) - lse
+            x_pad = x[:, self.pad_index] - lse
+            x_sum = x.sum(dim=-1) - x.size(-1) * lse
 
-            # find where the target word is a pad symbol, returns indices along dim 0
-            mask = torch.nonzero(target.squeeze().data == self.pad_index)
+            loss = entropy - self.confidence * x_tgt - eps * (x_sum - x_tgt - x_pad)
 
-            if mask.size(0) != 0:
-                # print("mask ", mask.size())
-                # fill the entries of pad symbols with 0 prob
-                smooth_target.index_fill_(0, mask.squeeze(), 0.0)
+            # the entries of pad symbols have 0 prob
+            loss = loss.masked_fill(target == self.pad_index, 0.).sum()
 
-            if torch.isnan(self.kl_div_loss(x, smooth_target)).item():
+            if torch.isnan(loss).item():
                 self.logger.debug("loss is nan")
                 self.logger.debug("x", x)
-                self.logger.debug("smooth target ", smooth_target)
 
-            return self.kl_div_loss(x, smooth_target) / normalize
+            return loss / normalize
 
         except Exception as e:
             self.logger.exception("message")
 
     def get_src_mask(self, src_batch):
 
-        mask = torch.ones_like(src_batch)
-        mask.masked_fill_(src_batch == self.pad_index, 0).unsqueeze_(-2).unsqueeze_(-2)
-        #print("mask", mask)
-        return mask
+        return self.masks.get_src_mask(src_batch)
 
     def get_tgt_mask(self, tgt_batch):
 
-        batch_size, sent_len = tgt_batch.shape
+        return self.masks.get_tgt_mask(tgt_batch)
 
-        # hide future words
-        tgt_m = np.tril(np.ones((batch_size, sent_len, sent_len)), k=0).astype(np.uint8)
-        #print("tgt_m", tgt_m)
-
-        tgt_m = torch.from_numpy(tgt_m)
-
-        # hide padding
-        tgt_m.masked_fill_(tgt_batch.unsqueeze(-1) == self.pad_index, 0).unsqueeze_(1)
-        #print("tgt_m", tgt_m)
-        return tgt_m
+    def add_masks(self, batch_dict):
+        """
+        adds the attention masks to a batch dict, once it is on the device
+        """
+        batch_dict["src_mask"] = self.get_src_mask(batch_dict["src_batch"])
+        # create mask based on input to the decoder
+        batch_dict["tgt_mask"] = self.get_tgt_mask(batch_dict["prev_output"])
+        return batch_dict
 
     def compute_sent_len(self, sentences):
         """
@@ -217,10 +304,76 @@ class Trainer(ABC):
     def train(n_iter):
         pass
 
+    def get_prefetcher(self, batch_iterator, prepare):
+        """
+        prepares the batches of batch_iterator in background threads, see Prefetcher
+        each prefetcher gets its own seed, drawn from the trainer's random state
+        """
+        return Prefetcher(batch_iterator, prepare, self.device,
+                          n_workers=self.prefetch_workers,
+                          prefetch=self.prefetch_batches,
+                          seed=self.rng.randint(2 ** 31))
+
+    def prepare_lm_batch(self, batch, lang_id, add_noise, generator=None):
+        """
+        creates the batch dict for a language modeling batch, on the CPU
+        masks are added once the batch is on the device
+
+        :param batch: sentences, lengths from a monolingual dataset
+        :param generator: torch.Generator to draw the noise from
+        :return:
+        """
+        tgt_batch, tgt_l = batch
+
+        if add_noise:
+            src_batch, src_l = self.noise_model.add_noise(tgt_batch, tgt_l, lang_id, generator)
+
+        else:
+            src_batch = tgt_batch
+            src_l = tgt_l
+
+        # does not create new tensor, input to the decoder during training, without eos token
+        prev_output = tgt_batch[:, :-1]
+        tgt_batch = tgt_batch[:, 1:]
+
+        return {"src_batch": src_batch,
+                "tgt_batch": tgt_batch,
+                "prev_output": prev_output,
+                "src_l": src_l,
+                "tgt_l": tgt_l}
+
+    def prepare_para_batch(self, batch, lang_id, add_noise, generator=None):
+        """
+        creates the batch dict for a parallel batch, on the CPU
+        masks are added once the batch is on the device
+
+        :param batch: (sentences, lengths) pairs from a parallel dataset
+        :param lang_id: source language, for the noise
+        :param generator: torch.Generator to draw the noise from
+        :return:
+        """
+        src, tgt = batch
+
+        src_batch, src_l = src
+        tgt_batch, tgt_l = tgt
+
+        if add_noise:
+            src_batch, src_l = self.noise_model.add_noise(src_batch, src_l, lang_id, generator)
+
+        # does not create new tensor
+        prev_output = tgt_batch[:, :-1]
+        tgt_batch = tgt_batch[:, 1:]
+
+        return {"src_batch": src_batch,
+                "tgt_batch": tgt_batch,
+                "prev_output": prev_output,
+                "src_l": src_l,
+                "tgt_l": tgt_l}
+
     def get_lm_iterator(self, lang_id, train=True, add_noise=True):
         """
         returns batch with relevant masks
-        moves everything to device
+        batches are prepared in the background, and moved to device
 
         :param lang:
         :param add_noise:
@@ -229,56 +382,36 @@ class Trainer(ABC):
 
         lang = self.id2lang[lang_id]
 
+        # batches going to the GPU are built in pinned memory
+        pin_memory = self.device.type == 'cuda'
         if train:
             assert (self.data['mono'][lang]['train'] is not None)
-            get_src_iterator = self.data['mono'][lang]['train'].get_iterator(shuffle=True, group_by_size=True)
+            get_src_iterator = self.data['mono'][lang]['train'].get_iterator(
+                shuffle=True, group_by_size=True, pin_memory=pin_memory)
 
         else:
             assert (self.data['mono'][lang]['valid'] is not None)
-            get_src_iterator = self.data['mono'][lang]['valid'].get_iterator(shuffle=True, group_by_size=True)
+            get_src_iterator = self.data['mono'][lang]['valid'].get_iterator(
+                shuffle=True, group_by_size=True, pin_memory=pin_memory)
 
-        src_iterator = get_src_iterator()
+        def prepare(batch, generator):
+            return self.prepare_lm_batch(batch, lang_id, add_noise, generator)
 
         def iterator():
-            for tgt_batch, tgt_l in src_iterator:
-
-                tgt_batch.transpose_(0, 1)
-                if add_noise:
-                    src_batch, src_l = self.noise_model.add_noise(tgt_batch, tgt_l, lang_id)
-
-                else:
-                    src_batch = tgt_batch
-                    src_l = tgt_l
-
-                # does not create new tensor, input to the decoder during training, without eos token
-                prev_output = tgt_batch[:, :-1]
-                tgt_batch = tgt_batch[:, 1:]
-
-                src_mask = self.get_src_mask(src_batch)
-                # create mask based on input to the decoder
-                tgt_mask = self.get_tgt_mask(prev_output)
-
-                # move to cuda
-                tgt_batch = tgt_batch.to(self.device)
-                src_batch = src_batch.to(self.device)
-                src_mask = src_mask.to(self.device)
-                tgt_mask = tgt_mask.to(self.device)
-                src_l = src_l.to(self.device)
-                tgt_l = tgt_l.to(self.device)
-
-                yield {"src_batch": src_batch,
-                       "tgt_batch": tgt_batch,
-                       "prev_output": prev_output,
-                       "src_mask": src_mask,
-                       "tgt_mask": tgt_mask,
-                       "src_l": src_l,
-                       "tgt_l": tgt_l}
+            prefetcher = self.get_prefetcher(get_src_iterator(), prepare)
+            try:
+                for batch_dict in prefetcher:
+                    yield self.add_masks(batch_dict)
+            finally:
+                # the threads of the prefetcher hold it, stop them when the iterator is closed or dropped
+                prefetcher.close()
 
         return iterator
 
     def get_para_iterator(self, lang1, lang2, train=True, add_noise=False):
         """
         returns training batches to translate from lang1 to lang2
+        batches are prepared in the background, and moved to device
         :param lang1:
         :param lang2:
         :param train:
@@ -289,51 +422,29 @@ class Trainer(ABC):
         src_lang = self.id2lang[lang1]
         tgt_lang = self.id2lang[lang2]
 
+        # batches going to the GPU are built in pinned memory
+        pin_memory = self.device.type == 'cuda'
         if train:
             assert (self.data['para'][(src_lang, tgt_lang)]['train'] is not None)
-            get_iterator = self.data['para'][(src_lang, tgt_lang)]['train'].get_iterator(shuffle=True, group_by_size=True)
+            get_iterator = self.data['para'][(src_lang, tgt_lang)]['train'].get_iterator(
+                shuffle=True, group_by_size=True, pin_memory=pin_memory)
 
         else:
             assert (self.data['para'][(src_lang, tgt_lang)]['valid'] is not None)
-            get_iterator = self.data['para'][(src_lang, tgt_lang)]['valid'].get_iterator(shuffle=True, group_by_size=True)
+            get_iterator = self.data['para'][(src_lang, tgt_lang)]['valid'].get_iterator(
+                shuffle=True, group_by_size=True, pin_memory=pin_memory)
 
-        batch_iterator = get_iterator()
+        def prepare(batch, generator):
+            return self.prepare_para_batch(batch, lang1, add_noise, generator)
 
         def iterator():
-
-            for src, tgt in batch_iterator:
-
-                src_batch, src_l = src
-                tgt_batch, tgt_l = tgt
-
-                tgt_batch.transpose_(0, 1)
-                src_batch.transpose_(0, 1)
-
-                if add_noise:
-                    src_batch, src_l = self.noise_model.add_noise(src_batch, src_l, lang1)
-
-                # does not create new tensor
-                prev_output = tgt_batch[:, :-1]
-                tgt_batch = tgt_batch[:, 1:]
-
-                src_mask = self.get_src_mask(src_batch)
-                tgt_mask = self.get_tgt_mask(prev_output)
-
-                # move to cuda
-                tgt_batch = tgt_batch.to(self.device)
-                src_batch = src_batch.to(self.device)
-                src_mask = src_mask.to(self.device)
-                tgt_mask = tgt_mask.to(self.device)
-                src_l = src_l.to(self.device)
-                tgt_l = tgt_l.to(self.device)
-
-                yield {"src_batch": src_batch,
-                       "tgt_batch": tgt_batch,
-                       "prev_output": prev_output,
-                       "src_mask": src_mask,
-                       "tgt_mask": tgt_mask,
-                       "src_l": src_l,
-                       "tgt_l": tgt_l}
+            prefetcher = self.get_prefetcher(get_iterator(), prepare)
+            try:
+                for batch_dict in prefetcher:
+                    yield self.add_masks(batch_dict)
+            finally:
+                # the threads of the prefetcher hold it, stop them when the iterator is closed or dropped
+                prefetcher.close()
 
         return iterator
 
@@ -451,16 +562,15 @@ class Trainer(ABC):
 
 if __name__ == "__main__":
 
-    # test kl_div_loss
-    def compute_kl_div_loss(x, target, lang):
+    # test kl_div_loss against the dense smoothed target
+    def compute_kl_div_loss(x, target, smoothing, vocab_size, pad_index):
 
-        smoothing = 0.1
-        vocab_size = 30
         confidence = 1.0 - smoothing
-        pad_index = 3
         kl_div_loss = torch.nn.KLDivLoss(size_average=False, reduce=True)
 
         x = F.log_softmax(x, dim=-1)
+        x = x.reshape(-1, x.size(-1))
+        target = target.reshape(-1, 1)
 
         # same device and dtype as x, requires_grad = false
         smooth_target = torch.zeros_like(x)
@@ -469,33 +579,43 @@ if __name__ == "__main__":
 
         # zero the pad_index for each vector of probabilities
         smooth_target[:, pad_index] = 0
-        print("smooth target", smooth_target)
 
         # find where the target word is a pad symbol, returns indices along dim 0
         mask = torch.nonzero(target.squeeze().data == pad_index)
-        print("mask", mask)
 
-        if mask.dim() > 0:
+        if mask.size(0) != 0:
             # fill the entries of pad symbols with 0 prob
-            smooth_target.index_fill_(dim=0, index=mask.squeeze(), value=0.0)
-
-        print("smooth target", smooth_target)
-        return kl_div_loss(x, smooth_target)
-
-    x = torch.rand(3, 2, 5)
-    target = torch.tensor([[[1], [1]], [[2], [2]], [[3], [3]]])
+            smooth_target.index_fill_(dim=0, index=mask.squeeze(1), value=0.0)
 
-    print(x)
-    print(target)
+        return kl_div_loss(x, smooth_target) / target.size(0)
 
-    x = x.reshape(-1, 5)
-    target = target.reshape(-1, 1)
-
-    print(x)
-    print(target)
-
-    print(x.shape)
-    print(target.shape)
-
-    loss = compute_kl_div_loss(x, target, lang=0)
-    print("loss", loss)
+    class TestTrainer(object):
+        smoothing = 0.1
+        confidence = 0.9
+        vocab_size = [300]
+        pad_index = 2
+        logger = getLogger()
+
+    trainer = TestTrainer()
+    for _ in range(10):
+        x = torch.randn(8, 13, 300, dtype=torch.float64, requires_grad=True)
+        target = torch.randint(0, 300, (8, 13, 1))
+        target[:, 9:] = trainer.pad_index
+
+        loss = Trainer.compute_kl_div_loss(trainer, x, target, lang=0)
+        grad, = torch.autograd.grad(loss, x)
+        dense_loss = compute_kl_div_loss(x, target, trainer.smoothing, 300, trainer.pad_index)
+        dense_grad, = torch.autograd.grad(dense_loss, x)
+
+        assert torch.allclose(loss, dense_loss), (loss, dense_loss)
+        assert torch.allclose(grad, dense_grad)
+
+    print("loss", loss.item(), "dense loss", dense_loss.item())
+
+    # mixed precision logits, the loss is computed in fp32
+    x = torch.randn(8, 13, 300).bfloat16()
+    loss = Trainer.compute_kl_div_loss(trainer, x, target, lang=0)
+    assert loss.dtype == torch.float32
+    assert torch.allclose(loss.double(), compute_kl_div_loss(x.double(), target, trainer.smoothing, 300,
+                                                             trainer.pad_index))
+    print("bf16 loss", loss.item())
@@ -114,7 +114,7 @@ class LanguageModeling(Trainer):
                     #print("iter ", i, "loss: ", loss)
                     self.logger.info("iter %i: loss %40.1f" %(i, loss.item()))
 
-                loss.backward()
+                self.backward(loss)
                 self.opt_step()
 
             except Exception as e:
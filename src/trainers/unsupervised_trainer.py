@@ -3,9 +3,11 @@ from src.data.loader import *
 from src.model.transformer import Transformer
 from src.utils.data_loading import get_parser
 from src.utils.logger import create_logger
+from src.utils.distributed import init_distributed
 import logging
 from .basic_trainer import Trainer
 from src.model.beam_search_wrapper import MyBeamSearch
+from .back_translation import BackTranslationWorker
 import copy
 
 class UnsupervisedTrainer(Trainer):
@@ -19,8 +21,16 @@ class UnsupervisedTrainer(Trainer):
         self.use_distance_loss = use_distance_loss
         self.acc_steps = acc_steps
 
-        self.beam_search = MyBeamSearch(self.transformer, beam_size=1, logger=logging,
-                                        n_best=1, encoding_lengths=512, max_length=175)
+        # decoding of the back-translations, trades quality for generation throughput
+        self.beam_search = MyBeamSearch(self.transformer,
+                                        beam_size=getattr(self.data_params, 'bt_beam_size', 1),
+                                        logger=logging, n_best=1, encoding_lengths=512, max_length=175,
+                                        decoding=getattr(self.data_params, 'bt_decoding', 'beam'),
+                                        sampling_temp=getattr(self.data_params, 'bt_sampling_temp', 1.0),
+                                        keep_topk=getattr(self.data_params, 'bt_keep_topk', -1),
+                                        bucket_size=getattr(self.data_params, 'bt_bucket_size', 0),
+                                        max_len_a=getattr(self.data_params, 'bt_max_len_a', 0),
+                                        max_len_b=getattr(self.data_params, 'bt_max_len_b', 10))
 
         # if self.parallel:
         #     # self.device is the main device where stuff is aggregated
@@ -38,6 +48,11 @@ class UnsupervisedTrainer(Trainer):
         if load_from_checkpoint:
             self.load_checkpoint(exp_name+".pth")
 
+        # during training, the back-translations can be generated in the background,
+        # with weights refreshed every bt_refresh_steps, see train
+        self.back_translator = None
+        self.bt_refresh_steps = getattr(self.data_params, 'bt_refresh_steps', 10)
+
     def reconstruction_loss(self, batch_dict, lang1, lang2):
 
         tgt_mask = batch_dict["tgt_mask"]
@@ -51,27 +66,30 @@ class UnsupervisedTrainer(Trainer):
             if self.is_variational:
 
                 # returns decoded samples and kl divergence between prior and posterior
-                output_seq, kl_div, latent = self.transformer(input_seq=src_batch,
-                                              prev_output=prev_output,
-                                              src_mask=src_mask,
-                                              tgt_mask=tgt_mask,
-                                              src_lang=lang1,
-                                              tgt_lang=lang2)
-
+                with self.autocast():
+                    output_seq, kl_div, latent = self.transformer(input_seq=src_batch,
+                                                  prev_output=prev_output,
+                                                  src_mask=src_mask,
+                                                  tgt_mask=tgt_mask,
+                                                  src_lang=lang1,
+                                                  tgt_lang=lang2)
+
+                # the losses are computed in fp32
                 loss = self.compute_kl_div_loss(x=output_seq, target=tgt_batch, lang=lang2)
 
-                kl_div = torch.mean(kl_div)
+                kl_div = torch.mean(kl_div.float())
                 logging.info("kl_div %10.2f, kl_cost %10.5f" % (kl_div.item(), self.kl_cost))
                 loss += kl_div*self.kl_cost
 
             else:
 
-                output_seq = self.transformer(input_seq=src_batch,
-                                              prev_output=prev_output,
-                                              src_mask=src_mask,
-                                              tgt_mask=tgt_mask,
-                                              src_lang=lang1,
-                                              tgt_lang=lang2)
+                with self.autocast():
+                    output_seq = self.transformer(input_seq=src_batch,
+                                                  prev_output=prev_output,
+                                                  src_mask=src_mask,
+                                                  tgt_mask=tgt_mask,
+                                                  src_lang=lang1,
+                                                  tgt_lang=lang2)
 
                 loss = self.compute_kl_div_loss(x=output_seq, target=tgt_batch, lang=lang2)
 
@@ -92,6 +110,38 @@ class UnsupervisedTrainer(Trainer):
 
         return torch.sum(torch.norm(latent_2 - latent_1, p=2, dim=-1))
 
+    def compute_distance_loss(self, x, y, src_lang, tgt_lang):
+        """
+        :param x: sentences in src_lang
+        :param y: their translations in tgt_lang
+        :return: distance between the embeddings of x and y, scaled by distance_cost
+        """
+        if not self.use_distance_loss:
+            return 0
+
+        model = getattr(self.transformer, 'module', self.transformer)
+        with self.autocast():
+            src_z = model.get_emb(input_seq=x, src_mask=self.get_src_mask(x), src_lang=src_lang)
+            tgt_z = model.get_emb(input_seq=y, src_mask=self.get_src_mask(y), src_lang=tgt_lang)
+
+        distance_penalty = self.distance_loss(src_z.float(), tgt_z.float()) * self.distance_cost
+        self.logger.info("distance penalty %40.2f" % (distance_penalty.item()))
+        return distance_penalty
+
+    def get_backtranslation_batch(self, batch_dict, src_lang, tgt_lang):
+        """
+        back-translation batch from the background worker if there is one,
+        otherwise translate batch_dict now
+
+        :param batch_dict: from language modeling, in src_lang
+        :return: batch_dict with the translation to tgt_lang as the source, distance penalty
+        """
+        if self.back_translator is None:
+            return self.create_backtranslation_batch(batch_dict=batch_dict, src_lang=src_lang, tgt_lang=tgt_lang)
+
+        back_batch_dict, x, y = self.back_translator.get_batch(src_lang, tgt_lang, self.step)
+        return back_batch_dict, self.compute_distance_loss(x, y, src_lang, tgt_lang)
+
     def create_backtranslation_batch(self, batch_dict, src_lang, tgt_lang, add_noise=True):
         """
         translate from src_lang to tgt_lang,
@@ -105,29 +155,17 @@ class UnsupervisedTrainer(Trainer):
         x = batch_dict["tgt_batch"]
 
         src_mask = self.get_src_mask(x)
-        y, len = self.generate_parallel(src_batch=x,
-                                        src_mask=src_mask,
-                                        src_lang=src_lang,
-                                        tgt_lang=tgt_lang)
-
-        # we have to penalize the distance between the source's emb and the output's emb
-        distance_penalty = 0
-        if self.use_distance_loss:
-            src_z = self.transformer.module.get_emb(input_seq=x,
+        with self.autocast():
+            y, len = self.generate_parallel(src_batch=x,
                                             src_mask=src_mask,
-                                            src_lang=src_lang)
+                                            src_lang=src_lang,
+                                            tgt_lang=tgt_lang)
 
-            tgt_z = self.transformer.module.get_emb(input_seq=y,
-                                            src_mask=self.get_src_mask(y),
-                                            src_lang=tgt_lang)
-
-            distance_penalty = self.distance_loss(src_z, tgt_z) * self.distance_cost
-            self.logger.info("distance penalty %40.2f" % (distance_penalty.item()))
+        # we have to penalize the distance between the source's emb and the output's emb
+        distance_penalty = self.compute_distance_loss(x, y, src_lang, tgt_lang)
 
         if add_noise:
-            y, len = self.noise_model.add_noise(y.cpu(), len.cpu(), tgt_lang)
-            y = y.to(self.device)
-            len = len.to(self.device)
+            y, len = self.noise_model.add_noise(y, len, tgt_lang)
 
         # only the source elements change
         src_mask = self.get_src_mask(y)
@@ -139,6 +177,23 @@ class UnsupervisedTrainer(Trainer):
         return new_batch_dict, distance_penalty
 
     def train(self, n_iter):
+        """
+        train for n_iter iterations, the background back-translation worker runs until training ends
+        """
+        if getattr(self.data_params, 'bt_async', False):
+            self.back_translator = BackTranslationWorker(self, directions=[(0, 1), (1, 0)],
+                                                         queue_size=getattr(self.data_params, 'bt_queue_size', 2),
+                                                         max_staleness=getattr(self.data_params, 'bt_max_staleness', 50),
+                                                         seed=self.rng.randint(2 ** 31))
+        try:
+            self.train_iterations(n_iter)
+
+        finally:
+            if self.back_translator is not None:
+                self.back_translator.close()
+                self.back_translator = None
+
+    def train_iterations(self, n_iter):
 
         lang1 = 0
         lang2 = 1
@@ -170,55 +225,63 @@ class UnsupervisedTrainer(Trainer):
                 lm_iterators[0] = get_lm_iterators[0]()
                 lang_batch_dict = next(lm_iterators[0])
 
+            # each loss term is backpropagated as soon as it is computed,
+            # so the activations of only one of them are alive at a time
+            # in distributed training, the gradients are only all-reduced with the last term of the step,
+            # the forward passes run in the same context as their backward pass
+
             # get lm loss for lang 1
-            loss = self.reconstruction_loss(batch_dict=lang_batch_dict, lang1=lang1, lang2=lang1)
-            logging.info("iter %i: reconstruction loss %40.1f" % (i, loss.item()))
+            with self.no_sync(sync=False):
+                loss = self.accumulate(self.reconstruction_loss(batch_dict=lang_batch_dict, lang1=lang1, lang2=lang1))
+            logging.info("iter %i: reconstruction loss %40.1f" % (i, loss))
 
             # the same for back-translation
-            back_batch_dict, distance_loss = self.create_backtranslation_batch(batch_dict=lang_batch_dict,
-                                                              src_lang=lang1,
-                                                              tgt_lang=lang2)
+            with self.no_sync(sync=False):
+                back_batch_dict, distance_loss = self.get_backtranslation_batch(batch_dict=lang_batch_dict,
+                                                                                src_lang=lang1,
+                                                                                tgt_lang=lang2)
 
-            loss += self.reconstruction_loss(batch_dict=back_batch_dict, lang1=lang2, lang2=lang1) + distance_loss
-            logging.info("iter %i: back translation loss %40.1f" % (i, loss.item()))
+                loss += self.accumulate(self.reconstruction_loss(batch_dict=back_batch_dict, lang1=lang2, lang2=lang1)
+                                        + distance_loss)
+            logging.info("iter %i: back translation loss %40.1f" % (i, loss))
 
             try:
                 lang_batch_dict = next(lm_iterators[1])
 
             except StopIteration:
                 # restart the iterator
-                get_lm_iterators[1] = self.get_lm_iterator(lang_id=lang1, add_noise=True)
+                get_lm_iterators[1] = self.get_lm_iterator(lang_id=lang2, add_noise=True)
                 lm_iterators[1] = get_lm_iterators[1]()
                 lang_batch_dict = next(lm_iterators[1])
 
             # get lm loss for lang 2
-            loss += self.reconstruction_loss(batch_dict=lang_batch_dict, lang1=lang2, lang2=lang2)
-            logging.info("iter %i: reconstruction loss %40.1f" % (i, loss.item()))
-
-            # the same for back-translation
-            back_batch_dict, distance_loss = self.create_backtranslation_batch(batch_dict=lang_batch_dict,
-                                                                src_lang=lang2,
-                                                                tgt_lang=lang1)
+            with self.no_sync(sync=False):
+                loss += self.accumulate(self.reconstruction_loss(batch_dict=lang_batch_dict, lang1=lang2, lang2=lang2))
+            logging.info("iter %i: reconstruction loss %40.1f" % (i, loss))
 
-            loss += self.reconstruction_loss(batch_dict=back_batch_dict, lang1=lang1, lang2=lang2) + distance_loss
-            logging.info("iter %i: backtranslation loss %40.1f" % (i, loss.item()))
+            # the same for back-translation, the last term of the step all-reduces the accumulated gradients
+            with self.no_sync(sync=(i + 1) % self.acc_steps == 0):
+                back_batch_dict, distance_loss = self.get_backtranslation_batch(batch_dict=lang_batch_dict,
+                                                                                src_lang=lang2,
+                                                                                tgt_lang=lang1)
 
-            try:
-                loss.backward()
+                loss += self.accumulate(self.reconstruction_loss(batch_dict=back_batch_dict, lang1=lang1, lang2=lang2)
+                                        + distance_loss)
+            logging.info("iter %i: backtranslation loss %40.1f" % (i, loss))
 
-                # only update params and zero grads after we process a whole batch
-                if i % self.acc_steps == 0:
-                    self.opt_step()
-                    self.opt.zero_grad()
+            # only update params and zero grads after we process acc_steps batches
+            if (i + 1) % self.acc_steps == 0:
+                self.opt_step()
+                self.opt.zero_grad()
+                self.log_peak_memory()
 
-            except Exception as e:
-                logging.debug("Exception in training loop")
-                logging.exception("message")
+                if self.back_translator is not None and self.step % self.bt_refresh_steps == 0:
+                    self.back_translator.update_weights(self.step)
 
             if i % 200 == 0:
                 # print("iter ", i, "loss: ", loss)
-                logging.info("iter %i: loss %40.1f" % (i, loss.item()))
-                trainer.checkpoint(self.exp_name+".pth")
+                logging.info("iter %i: loss %40.1f" % (i, loss))
+                self.checkpoint(self.exp_name+".pth")
 
             try:
                 para_batch_dict = next(para_iterator)
@@ -229,18 +292,38 @@ class UnsupervisedTrainer(Trainer):
                 para_iterator = get_para_iterator()
                 para_batch_dict = next(para_iterator)
 
-            val_loss = self.reconstruction_loss(para_batch_dict, lang1=lang1, lang2=lang2)
+            with torch.no_grad():
+                val_loss = self.reconstruction_loss(para_batch_dict, lang1=lang1, lang2=lang2)
             logging.info("iter %i: val_loss %40.1f" % (i, val_loss.item()))
 
-    def generate_parallel(self, src_batch, src_mask, src_lang, tgt_lang):
+    def accumulate(self, loss):
+        """
+        backpropagate a loss term, its activations are freed right away
+        the gradients of the acc_steps batches of an optimizer step are averaged
+
+        :param loss: loss term of one batch
+        :return: value of the loss term
+        """
+        try:
+            self.backward(loss / self.acc_steps)
+            return loss.item()
+
+        except Exception as e:
+            logging.debug("Exception in training loop")
+            logging.exception("message")
+            return 0.
+
+    def generate_parallel(self, src_batch, src_mask, src_lang, tgt_lang, decoding=None):
         """
-        generate sentences for back-translation using greedy decoding
+        generate sentences for back-translation
         :param batch_dict: dict of src batch and src mask
         :param src_lang:
         :param tgt_lang:
+        :param decoding: greedy, sample or beam, defaults to the --bt_decoding of the run
         :return:
         """
-        output, len = self.beam_search(src_batch, src_mask, src_lang=src_lang, tgt_lang=tgt_lang)
+        output, len = self.beam_search(src_batch, src_mask, src_lang=src_lang, tgt_lang=tgt_lang,
+                                       decoding=decoding)
 
         # For verification, what does an output sample look like?
         self.indices_to_words(output[0, :].unsqueeze_(0), tgt_lang)
@@ -286,7 +369,12 @@ if __name__ == "__main__":
     use_distance_loss = data_params.use_distance_loss > 0
     load_from_checkpoint = data_params.load_from_checkpoint > 0
 
-    logging.basicConfig(filename="logs/"+exp_name+".log", level=logging.DEBUG)
+    # with several processes, only the first one logs, the others only keep their warnings
+    init_distributed(data_params)
+    if data_params.is_master:
+        logging.basicConfig(filename="logs/"+exp_name+".log", level=logging.DEBUG)
+    else:
+        logging.basicConfig(filename="logs/"+exp_name+"_rank%i.log" % data_params.rank, level=logging.WARNING)
 
     model = Transformer(data_params=data_params, logger=logging,
                         init_emb=True,
@@ -294,6 +382,7 @@ if __name__ == "__main__":
                         is_variational=is_variational)
 
     trainer = UnsupervisedTrainer(model, exp_name,
+                                 acc_steps=data_params.acc_steps,
                                  use_distance_loss=use_distance_loss,
                                  load_from_checkpoint=load_from_checkpoint)
 
@@ -37,6 +37,10 @@ flags.DEFINE_float(
     "word_drop", default=0.2, help="dropout parameter"
 )
 
+flags.DEFINE_bool(
+    "use_sdpa", default=True, help="use the fused scaled_dot_product_attention of torch, when available"
+)
+
 
 FLAGS = flags.FLAGS
 params = FLAGS.flag_values_dict()
@@ -18,7 +18,15 @@ def get_parser():
                         help="Vocabulary minimum word count")
 
     parser.add_argument("--mono_dataset", type=str, default="",
-                        help="Monolingual dataset (lang1:train1,valid1,test1;lang2:train2,valid2,test2)")
+                        help="Monolingual dataset (lang1:train1,valid1,test1;lang2:train2,valid2,test2), "
+                             "train can be a glob pattern of binarized shards, e.g. train.*.en.pth")
+
+    parser.add_argument("--shuffle_buffer", type=int, default=1000000,
+                        help="Number of sentences of sharded monolingual datasets batches are built from")
+
+    parser.add_argument("--shard_order", type=str, default="shuffle", choices=["sorted", "shuffle", "rotate"],
+                        help="Order the shards of sharded monolingual datasets are read in at each epoch "
+                             "(sorted, random order, or sorted starting from a random shard)")
 
     parser.add_argument("--para_dataset", type=str, default="",
                         help="Parallel dataset (lang1-lang2:train12,valid12,test12;lang1-lang3:train13,valid13,test13)")
@@ -57,6 +65,48 @@ def get_parser():
     parser.add_argument("--batch_size", type=int, default=32,
                         help="Batch size")
 
+    parser.add_argument("--max_tokens", type=int, default=-1,
+                        help="Maximum number of tokens per batch, including padding (-1 to use batch_size)")
+
+    parser.add_argument("--prefetch_workers", type=int, default=1,
+                        help="Number of threads preparing batches in the background")
+    parser.add_argument("--prefetch_batches", type=int, default=2,
+                        help="Number of batches prepared ahead by each prefetch thread")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the batch preparation (noise)")
+    parser.add_argument("--acc_steps", type=int, default=1,
+                        help="Number of batches the gradients are accumulated over, before an optimizer step")
+    parser.add_argument("--dist_backend", type=str, default="", choices=["", "nccl", "gloo"],
+                        help="Backend of distributed training, launched with torchrun --nproc_per_node=N "
+                             "(nccl on GPU and gloo on CPU by default)")
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "fp16", "bf16"],
+                        help="Precision of the forward passes, fp16 and bf16 use mixed precision "
+                             "(fp16 requires a GPU)")
+
+    # back-translation parameters
+    parser.add_argument("--bt_decoding", type=str, default="beam", choices=["greedy", "sample", "beam"],
+                        help="Decoding of the back-translations")
+    parser.add_argument("--bt_beam_size", type=int, default=1,
+                        help="Beam size of the back-translations, for beam decoding")
+    parser.add_argument("--bt_sampling_temp", type=float, default=1.0,
+                        help="Temperature of the back-translations, for sample decoding")
+    parser.add_argument("--bt_keep_topk", type=int, default=-1,
+                        help="Sample back-translations among the k best words (-1 for all words)")
+    parser.add_argument("--bt_bucket_size", type=int, default=0,
+                        help="Decode the back-translations in buckets of n sentences of similar lengths (0 to disable)")
+    parser.add_argument("--bt_max_len_a", type=float, default=0,
+                        help="Back-translations are at most a * source length + b words long (0 for a fixed max length)")
+    parser.add_argument("--bt_max_len_b", type=int, default=10,
+                        help="Back-translations are at most a * source length + b words long")
+    parser.add_argument("--bt_async", type=int, default=0,
+                        help="Generate the back-translations in a background thread, with a copy of the model")
+    parser.add_argument("--bt_queue_size", type=int, default=2,
+                        help="Number of back-translation batches generated ahead, for each direction")
+    parser.add_argument("--bt_refresh_steps", type=int, default=10,
+                        help="Copy the trained weights to the back-translation model every n optimizer steps")
+    parser.add_argument("--bt_max_staleness", type=int, default=50,
+                        help="Drop the back-translation batches generated with weights older than n steps")
+
     parser.add_argument("--variational", type=int, default=1)
     parser.add_argument("--use_distance_loss", type=int, default=1)
     parser.add_argument("--load_from_checkpoint", type=int, default=0)
@@ -0,0 +1,28 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(params):
+    """
+    Join the process group of the run, when launched with one process per device, e.g.
+    torchrun --nproc_per_node=N -m src.trainers.unsupervised_trainer ...
+    the launcher sets RANK, LOCAL_RANK and WORLD_SIZE, without it the run has a single process
+
+    sets params.rank, params.local_rank, params.world_size, and params.is_master, true for rank 0,
+    which is the only one that logs and saves checkpoints
+    """
+    params.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    params.rank = int(os.environ.get('RANK', 0))
+    params.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    params.is_master = params.rank == 0
+
+    if params.world_size == 1:
+        return
+
+    # nccl on GPU, gloo on CPU, e.g. to test distributed training without GPUs
+    backend = getattr(params, 'dist_backend', '') or ('nccl' if torch.cuda.is_available() else 'gloo')
+    if torch.cuda.is_available():
+        torch.cuda.set_device(params.local_rank)
+
+    dist.init_process_group(backend=backend, init_method='env://')
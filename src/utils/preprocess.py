@@ -12,25 +12,32 @@ import os
 import sys
 
 from logger import create_logger
-from data.dictionary import Dictionary
+from data.dictionary import Dictionary, MMAP_SUFFIX
 
 
 if __name__ == '__main__':
 
     logger = create_logger(None)
 
+    # usage: preprocess.py VOCAB_PATH TXT_PATH [pth|mmap] [N_WORKERS]
     voc_path = sys.argv[1]
     txt_path = sys.argv[2]
-    bin_path = sys.argv[2] + '.pth'
+    bin_format = sys.argv[3] if len(sys.argv) > 3 else 'pth'
+    n_workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    assert bin_format in ['pth', 'mmap']
+    bin_path = sys.argv[2] + ('.pth' if bin_format == 'pth' else MMAP_SUFFIX)
     assert os.path.isfile(voc_path)
     assert os.path.isfile(txt_path)
 
     dico = Dictionary.read_vocab(voc_path)
     logger.info("")
 
-    data = Dictionary.index_data(txt_path, bin_path, dico)
+    data = Dictionary.index_data(txt_path, bin_path, dico, n_workers=n_workers)
+
+    # sentences are separated by -1 in the pth format only
+    n_words = len(data['sentences']) - (len(data['positions']) if bin_format == 'pth' else 0)
     logger.info("%i words (%i unique) in %i sentences." % (
-        len(data['sentences']) - len(data['positions']),
+        n_words,
         len(data['dico']),
         len(data['positions'])
     ))
@@ -38,7 +45,7 @@ if __name__ == '__main__':
         logger.info("%i unknown words (%i unique), covering %.2f%% of the data." % (
             sum(data['unk_words'].values()),
             len(data['unk_words']),
-            sum(data['unk_words'].values()) * 100. / (len(data['sentences']) - len(data['positions']))
+            sum(data['unk_words'].values()) * 100. / n_words
         ))
         if len(data['unk_words']) < 30:
             for w, c in sorted(data['unk_words'].items(), key=lambda x: x[1])[::-1]: